@@ -14,6 +14,8 @@ Registries:
 .. autosummary::
    :toctree: .
 
+   AchillesAnalysis
+   AchillesResult
    CareSite
    CdmSource
    Cohort
@@ -35,10 +37,13 @@ Registries:
    Episode
    EpisodeEvent
    FactRelationship
+   LoadCheckpoint
    Location
    Measurement
    Metadata
+   NlpCheckpoint
    Note
+   NoteBlob
    NoteNlp
    Observation
    ObservationPeriod
@@ -52,6 +57,32 @@ Registries:
    VisitDetail
    VisitOccurrence
    Vocabulary
+
+Modules:
+
+.. autosummary::
+   :toctree: .
+
+   aio
+   characterization
+   concepts
+   costs
+   doses
+   episodes
+   events
+   facts
+   geo
+   integrity
+   load
+   nlp
+   notes
+   partitioning
+   profiling
+   query
+   routing
+   search
+   sharding
+   standardize
 """
 
 __version__ = "0.2.1"  # denote a pre-release for 0.1.0 with 0.1rc1
@@ -71,7 +102,31 @@ if _check_instance_setup():
     import lamindb
 
     del __getattr__  # delete so that imports work out
+    from . import (
+        aio,
+        characterization,
+        concepts,
+        costs,
+        doses,
+        episodes,
+        events,
+        facts,
+        geo,
+        integrity,
+        load,
+        nlp,
+        notes,
+        partitioning,
+        profiling,
+        query,
+        routing,
+        search,
+        sharding,
+        standardize,
+    )
     from .models import (
+        AchillesAnalysis,
+        AchillesResult,
         CareSite,
         CdmSource,
         Cohort,
@@ -93,10 +148,13 @@ if _check_instance_setup():
         Episode,
         EpisodeEvent,
         FactRelationship,
+        LoadCheckpoint,
         Location,
         Measurement,
         Metadata,
+        NlpCheckpoint,
         Note,
+        NoteBlob,
         NoteNlp,
         Observation,
         ObservationPeriod,
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+import numpy as np
+import pandas as pd
+from django.db import connections
+from django.db.models import F, FloatField, QuerySet
+from django.db.models.functions import Cast
+
+from ._utils import get_registry
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+    from django.db.models import Field
+    from lamindb.models import Record
+
+# fields of the lamindb base classes that omop registries inherit
+BOOKKEEPING_FIELDS = {
+    "_aux",
+    "_branch_code",
+    "created_at",
+    "created_by",
+    "run",
+    "space",
+    "updated_at",
+}
+
+INTEGER_TYPES = {
+    "AutoField",
+    "BigAutoField",
+    "BigIntegerField",
+    "IntegerField",
+    "PositiveIntegerField",
+    "PositiveSmallIntegerField",
+    "SmallAutoField",
+    "SmallIntegerField",
+}
+
+
+class Select(NamedTuple):
+    """A compiled `SELECT` statement with the value kinds of its columns."""
+
+    sql: str
+    params: tuple
+    db: str
+    columns: list[str]
+    kinds: list[str]
+
+
+def as_queryset(queryset: QuerySet | type[Record] | str) -> QuerySet:
+    if isinstance(queryset, QuerySet):
+        return queryset
+    return get_registry(queryset).filter()
+
+
+def omop_fields(registry: type[Record]) -> list[str]:
+    """Column names of the fields declared by an omop registry itself."""
+    return [
+        field.attname
+        for field in registry._meta.concrete_fields
+        if field.name not in BOOKKEEPING_FIELDS
+    ]
+
+
+def resolve_field(registry: type[Record], name: str) -> Field:
+    """Resolve a possibly related column name like `person__year_of_birth`."""
+    opts = registry._meta
+    *path, last = name.split("__")
+    for part in path:
+        opts = opts.get_field(part).related_model._meta
+    field = opts.get_field(last)
+    if field.is_relation:
+        # selecting a foreign key yields the primary key of the related record
+        field = field.target_field
+    return field
+
+
+def value_kind(field: Field) -> str:
+    internal_type = field.get_internal_type()
+    if internal_type in INTEGER_TYPES:
+        return "int"
+    if internal_type in {"DecimalField", "FloatField"}:
+        return "float"
+    if internal_type == "DateField":
+        return "date"
+    if internal_type == "DateTimeField":
+        return "datetime"
+    if internal_type == "BooleanField":
+        return "bool"
+    if internal_type in {"CharField", "TextField"}:
+        return "str"
+    return "object"
+
+
+def compile_select(queryset: QuerySet, columns: Iterable[str] | None = None) -> Select:
+    """Compile a queryset into a plain `SELECT` of the given columns.
+
+    Decimal columns are cast to floating point in the database so that the driver
+    never constructs `Decimal` objects.
+    """
+    registry = queryset.model
+    columns = omop_fields(registry) if columns is None else list(columns)
+    expressions, kinds = [], []
+    for column in columns:
+        field = resolve_field(registry, column)
+        kind = value_kind(field)
+        if field.get_internal_type() == "DecimalField":
+            expressions.append(Cast(column, FloatField()))
+        else:
+            # an expression rather than a field name keeps the column order
+            expressions.append(F(column))
+        kinds.append(kind)
+    queryset = queryset.values_list(*expressions)
+    db = queryset.db
+    sql, params = queryset.query.get_compiler(using=db).as_sql()
+    return Select(sql, tuple(params), db, columns, kinds)
+
+
+def fetch_batches(select: Select, batch_size: int) -> Iterator[list[tuple]]:
+    """Yield row batches from a server-side cursor where the backend supports it."""
+    with connections[select.db].chunked_cursor() as cursor:
+        cursor.execute(select.sql, select.params)
+        while rows := cursor.fetchmany(batch_size):
+            yield rows
+
+
+def _integers(values: tuple) -> Any:
+    try:
+        return np.array(values, dtype=np.int64)
+    except TypeError:
+        # contains None, go through float to build the mask without a Python loop
+        data = np.array(values, dtype=np.float64)
+        mask = np.isnan(data)
+        return pd.arrays.IntegerArray(np.where(mask, 0, data).astype(np.int64), mask)
+
+
+# proleptic Gregorian ordinal of 1970-01-01
+UNIX_EPOCH_ORDINAL = 719_163
+
+
+def _dates(values: tuple) -> np.ndarray:
+    # NumPy parses `datetime.date` objects one by one, ordinals are ~20x faster
+    try:
+        days = np.fromiter(
+            (value.toordinal() for value in values), dtype=np.int64, count=len(values)
+        )
+    except AttributeError:
+        # contains None
+        return np.array(values, dtype="datetime64[D]")
+    return (days - UNIX_EPOCH_ORDINAL).astype("datetime64[D]")
+
+
+def to_array(values: tuple, kind: str) -> Any:
+    if kind == "int":
+        return _integers(values)
+    if kind == "float":
+        return np.array(values, dtype=np.float64)
+    if kind == "date":
+        return _dates(values)
+    if kind == "datetime":
+        return pd.to_datetime(
+            pd.Series(values, dtype=object), utc=True, format="ISO8601"
+        )
+    if kind == "bool":
+        return pd.array(values, dtype="boolean")
+    return np.array(values, dtype=object)
+
+
+def to_frame(rows: list[tuple], select: Select) -> pd.DataFrame:
+    """Convert row tuples column by column into a DataFrame."""
+    if not rows:
+        return pd.DataFrame(
+            {column: np.array([], dtype=object) for column in select.columns}
+        )
+    columns = zip(*rows)
+    return pd.DataFrame(
+        {
+            column: to_array(values, kind)
+            for column, kind, values in zip(select.columns, select.kinds, columns)
+        }
+    )
+
+
+def _nullable(values: np.ndarray, mask: np.ndarray) -> list:
+    # object arrays of NumPy scalars convert to plain Python values
+    values = values.astype(object)
+    values[mask] = None
+    return values.tolist()
+
+
+def to_db_values(series: pd.Series, field: Field, connection: Any) -> list:
+    """Convert a column into Python values that the database driver accepts."""
+    kind = value_kind(field)
+    mask = series.isna().to_numpy()
+    if kind == "int":
+        return _nullable(series.astype("Int64").to_numpy(np.int64, na_value=0), mask)
+    if kind == "float":
+        return _nullable(series.to_numpy(np.float64, na_value=np.nan), mask)
+    if kind == "date":
+        dates = pd.to_datetime(series).dt.date.to_numpy(object)
+        return [
+            None if is_null else connection.ops.adapt_datefield_value(value)
+            for value, is_null in zip(dates, mask)
+        ]
+    if kind == "datetime":
+        datetimes = pd.to_datetime(series, utc=True).dt.to_pydatetime()
+        return [
+            None if is_null else connection.ops.adapt_datetimefield_value(value)
+            for value, is_null in zip(datetimes, mask)
+        ]
+    if kind == "str":
+        return _nullable(series.astype(str).to_numpy(object), mask)
+    if kind == "bool":
+        return _nullable(series.astype("boolean").to_numpy(bool, na_value=False), mask)
+    return [
+        None if is_null else field.get_db_prep_save(value, connection)
+        for value, is_null in zip(series.to_numpy(object), mask)
+    ]
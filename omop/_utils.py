@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Any
+
+import lamindb_setup as ln_setup
+from django.apps import apps
+from django.db import connections, models
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+    from pathlib import Path
+
+    from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+    from lamindb.models import Record
+
+
+def omop_registries() -> list[type[Record]]:
+    """All registries of the `omop` schema module, sorted by name."""
+    return sorted(apps.get_app_config("omop").get_models(), key=lambda m: m.__name__)
+
+
+def get_registry(registry: type[Record] | str) -> type[Record]:
+    """Resolve a registry passed by name, e.g. `"Measurement"`."""
+    if isinstance(registry, str):
+        return apps.get_model("omop", registry)
+    return registry
+
+
+def unfiltered(registry: type[Record]) -> models.QuerySet:
+    """A plain Django queryset that bypasses the default `_branch_code` filter."""
+    return models.QuerySet(model=registry)
+
+
+def state_path(name: str) -> Path:
+    """Path of a local state file for the current instance."""
+    slug = ln_setup.settings.instance.slug.replace("/", "--")
+    path = ln_setup.settings.cache_dir / "omop" / slug / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def replace_directory(build: Path, path: Path) -> None:
+    """Move a completely written directory into place, replacing `path`.
+
+    Processes that mapped files of the old directory keep their open mappings.
+    """
+    if path.exists():
+        old = path.with_name(f".{path.name}-old")
+        shutil.rmtree(old, ignore_errors=True)
+        path.rename(old)
+        build.rename(path)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        build.rename(path)
+
+
+def read_state(name: str) -> dict[str, Any]:
+    path = state_path(name)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_state(name: str, state: dict[str, Any]) -> None:
+    with open(state_path(name), "w") as f:
+        json.dump(state, f, indent=2, default=str)
+
+
+def _start_method() -> str:
+    methods = multiprocessing.get_all_start_methods()
+    return "fork" if "fork" in methods else "spawn"
+
+
+def _init_instance(slug: str, payload: bytes) -> None:
+    # the initializer of the pool can only be unpickled once the instance is set up
+    ln_setup.connect(slug)
+    initializer, initargs = pickle.loads(payload)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def process_pool(
+    max_workers: int | None,
+    initializer: Callable[..., None] | None = None,
+    initargs: tuple = (),
+) -> ProcessPoolExecutor:
+    """A pool of worker processes that use the instance of this process.
+
+    Workers are forked where the platform supports it and inherit the set-up
+    instance, regardless of the default start method. Elsewhere, spawned workers
+    connect to the instance before running `initializer`. Close the connections
+    of this process before the first submission, forked workers must not share
+    them.
+    """
+    start_method = _start_method()
+    context = multiprocessing.get_context(start_method)
+    if start_method == "fork":
+        return ProcessPoolExecutor(
+            max_workers,
+            mp_context=context,
+            initializer=initializer,
+            initargs=initargs,
+        )
+    return ProcessPoolExecutor(
+        max_workers,
+        mp_context=context,
+        initializer=_init_instance,
+        initargs=(
+            ln_setup.settings.instance.slug,
+            pickle.dumps((initializer, initargs)),
+        ),
+    )
+
+
+def primary_key_columns(registry: type[Record], using: str = "default") -> list[str]:
+    """Columns of the primary key constraint, which can span partition keys."""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(
+            cursor, registry._meta.db_table
+        )
+    return next(c["columns"] for c in constraints.values() if c["primary_key"])
+
+
+def partition_strategy(registry: type[Record]) -> str | None:
+    """Partitioning strategy of a Postgres table, `"hash"`, `"list"` or `"range"`."""
+    connection = connections["default"]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT partstrat FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+            [registry._meta.db_table],
+        )
+        row = cursor.fetchone()
+    return None if row is None else {"h": "hash", "l": "list", "r": "range"}[row[0]]
+
+
+def partition_names(registry: type[Record]) -> list[str]:
+    """Names of the partitions of a Postgres table."""
+    with connections["default"].cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits"
+            " JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+            " WHERE pg_inherits.inhparent = %s::regclass ORDER BY child.relname",
+            [registry._meta.db_table],
+        )
+        return [name for (name,) in cursor.fetchall()]
+
+
+def dependent_objects(registry: type[Record]) -> list[str]:
+    """Tables with foreign keys to a Postgres table and views that select from it."""
+    with connections["default"].cursor() as cursor:
+        cursor.execute(
+            "SELECT conrelid::regclass::text FROM pg_constraint"
+            " WHERE contype = 'f' AND confrelid = %s::regclass"
+            " AND conrelid <> confrelid"
+            " UNION SELECT rewrite.ev_class::regclass::text FROM pg_depend"
+            " JOIN pg_rewrite rewrite ON rewrite.oid = pg_depend.objid"
+            " WHERE pg_depend.refobjid = %s::regclass"
+            " AND rewrite.ev_class <> pg_depend.refobjid"
+            " ORDER BY 1",
+            [registry._meta.db_table] * 2,
+        )
+        return [name for (name,) in cursor.fetchall()]
+
+
+def rebuild_table(
+    editor: BaseDatabaseSchemaEditor,
+    registry: type[Record],
+    *,
+    partition_by: str | None = None,
+    partitions: Iterable[tuple[str, str]] = (),
+    key: Iterable[str] = (),
+) -> None:
+    """Recreate a Postgres table with its records, partitioned or not.
+
+    Foreign keys to the table and views on it would have to be dropped with the
+    old table, hence the table is not rebuilt if it has any.
+
+    Args:
+        editor: The schema editor of the default connection.
+        registry: The registry whose table to recreate.
+        partition_by: The partitioning clause, e.g. `"HASH (person_id)"`.
+        partitions: Pairs of partition name and bound clause.
+        key: Columns appended to the primary key, partition keys need to be part of it.
+    """
+    qn = editor.quote_name
+    table = registry._meta.db_table
+    dependents = dependent_objects(registry)
+    if dependents:
+        raise ValueError(
+            f"{table} is referenced by {', '.join(dependents)}, drop their foreign"
+            " keys and views first"
+        )
+    old = f"{table}_old"
+    editor.execute(f"ALTER TABLE {qn(table)} RENAME TO {qn(old)}")
+    editor.execute(
+        f"CREATE TABLE {qn(table)} (LIKE {qn(old)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        + (f" PARTITION BY {partition_by}" if partition_by else "")
+    )
+    for name, bound in partitions:
+        editor.execute(f"CREATE TABLE {qn(name)} PARTITION OF {qn(table)} {bound}")
+    editor.execute(f"INSERT INTO {qn(table)} SELECT * FROM {qn(old)}")
+    # dropping the old table frees the names of its constraints and indexes
+    editor.execute(f"DROP TABLE {qn(old)}")
+    pk_columns = [registry._meta.pk.column, *key]
+    editor.execute(
+        f"ALTER TABLE {qn(table)} ADD PRIMARY KEY ({', '.join(map(qn, pk_columns))})"
+    )
+    for sql in editor._model_indexes_sql(registry):
+        editor.execute(sql)
+    for field in registry._meta.local_concrete_fields:
+        if field.remote_field and field.db_constraint:
+            editor.execute(
+                editor._create_fk_sql(registry, field, "_fk_%(to_table)s_%(to_column)s")
+            )
@@ -0,0 +1,319 @@
+"""Asynchronous read paths for the omop registries.
+
+Django's own async queryset methods like `aget()` run the synchronous ORM in a
+thread pool, blocking one thread per query. The functions here execute the SQL of
+a queryset on a pool of natively asynchronous connections instead, so that an
+event loop can have hundreds of queries in flight: `psycopg` on Postgres and
+`aiosqlite` on SQLite, see the `async` extra of the package.
+
+One pool of up to `POOL_SIZE` connections is opened per database and event
+loop on first use. Call :func:`close` before the event loop shuts down.
+
+.. autosummary::
+   :toctree: .
+
+   afilter
+   aget
+   astream
+   atimeline
+   close
+"""
+
+from __future__ import annotations
+
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, Literal
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models.query import ModelIterable
+
+from ._columnar import Select, as_queryset, compile_select, to_frame
+from .events import _event_tables, _timeline_frame, _timeline_select
+from .query import _check_format
+from .sharding import ALIAS_PREFIX, INSTANCE_SCHEMA, n_shards
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Iterable
+
+    import pandas as pd
+    import pyarrow as pa
+    from django.db.models import QuerySet
+    from lamindb.models import Record
+
+# maximal number of connections per database and event loop
+POOL_SIZE = 20
+
+# the result of `get()` is ambiguous beyond the first two records
+MAX_GET_RESULTS = 2
+
+
+class _SQLitePool:
+    def __init__(self, alias: str, size: int) -> None:
+        self.alias = alias
+        self.size = size
+        # connections of the backend have the SQL functions that Django registers
+        self._wrapper = connections[alias]
+        self._params = self._wrapper.get_connection_params()
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._open: list = []
+
+    async def _connect(self) -> Any:
+        import aiosqlite
+
+        connection = await aiosqlite.Connection(
+            lambda: self._wrapper.get_new_connection(self._params), iter_chunk_size=64
+        )
+        if self.alias.startswith(ALIAS_PREFIX):
+            # shards join registries of the instance database, see omop.sharding
+            await connection.execute(
+                f"ATTACH DATABASE ? AS {INSTANCE_SCHEMA}",
+                [connections["default"].settings_dict["NAME"]],
+            )
+        return connection
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Any]:
+        if self._idle.empty() and len(self._open) < self.size:
+            self._open.append(None)
+            try:
+                connection = await self._connect()
+            except BaseException:
+                self._open.pop()
+                raise
+            self._open[-1] = connection
+        else:
+            connection = await self._idle.get()
+        try:
+            yield connection
+        finally:
+            self._idle.put_nowait(connection)
+
+    @staticmethod
+    def _convert(sql: str) -> str:
+        from django.db.backends.sqlite3.base import FORMAT_QMARK_REGEX
+
+        return FORMAT_QMARK_REGEX.sub("?", sql).replace("%%", "%")
+
+    async def fetchall(self, sql: str, params: tuple) -> list[tuple]:
+        async with self.connection() as connection:
+            async with connection.execute(self._convert(sql), params) as cursor:
+                return await cursor.fetchall()
+
+    async def fetch_batches(
+        self, sql: str, params: tuple, batch_size: int
+    ) -> AsyncIterator[list[tuple]]:
+        async with self.connection() as connection:
+            async with connection.execute(self._convert(sql), params) as cursor:
+                while rows := await cursor.fetchmany(batch_size):
+                    yield rows
+
+    async def close(self) -> None:
+        for connection in self._open:
+            if connection is not None:
+                await connection.close()
+        self._open.clear()
+
+
+class _PostgresPool:
+    def __init__(self, alias: str, size: int) -> None:
+        import psycopg
+        from psycopg.client_cursor import ClientCursorMixin
+        from psycopg_pool import AsyncConnectionPool
+
+        # bind parameters on the client like Django does, its SQL relies on that
+        class ServerCursor(ClientCursorMixin, psycopg.AsyncServerCursor):
+            pass
+
+        self._server_cursor = ServerCursor
+        params = connections[alias].get_connection_params()
+        params["cursor_factory"] = psycopg.AsyncClientCursor
+        self._pool = AsyncConnectionPool(
+            kwargs=params, min_size=1, max_size=size, open=False
+        )
+        self._opened = False
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Any]:
+        if not self._opened:
+            self._opened = True
+            await self._pool.open()
+        async with self._pool.connection() as connection:
+            yield connection
+
+    async def fetchall(self, sql: str, params: tuple) -> list[tuple]:
+        async with self.connection() as connection:
+            cursor = await connection.execute(sql, params)
+            return await cursor.fetchall()
+
+    async def fetch_batches(
+        self, sql: str, params: tuple, batch_size: int
+    ) -> AsyncIterator[list[tuple]]:
+        async with self.connection() as connection:
+            async with self._server_cursor(connection, f"omop_{uuid4().hex}") as cursor:
+                await cursor.execute(sql, params)
+                while rows := await cursor.fetchmany(batch_size):
+                    yield rows
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+
+_pools: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[str, _SQLitePool | _PostgresPool]
+] = weakref.WeakKeyDictionary()
+
+
+def _pool(alias: str) -> _SQLitePool | _PostgresPool:
+    pools = _pools.setdefault(asyncio.get_running_loop(), {})
+    if alias not in pools:
+        vendor = connections[alias].vendor
+        if vendor == "sqlite":
+            pools[alias] = _SQLitePool(alias, POOL_SIZE)
+        elif vendor == "postgresql":
+            pools[alias] = _PostgresPool(alias, POOL_SIZE)
+        else:
+            raise NotImplementedError(f"no asynchronous driver for {vendor}")
+    return pools[alias]
+
+
+async def close() -> None:
+    """Close the connection pools of the running event loop.
+
+    Examples:
+        >>> await omop.aio.close()
+    """
+    pools = _pools.pop(asyncio.get_running_loop(), {})
+    await asyncio.gather(*(pool.close() for pool in pools.values()))
+
+
+def _queryset(
+    queryset: QuerySet | type[Record] | str, expressions: dict[str, Any]
+) -> QuerySet:
+    queryset = as_queryset(queryset)
+    if queryset._iterable_class is not ModelIterable:
+        raise ValueError("pass a queryset of records, not of values()")
+    return queryset.filter(**expressions) if expressions else queryset
+
+
+async def _records(queryset: QuerySet) -> list[Record]:
+    db = queryset.db
+    compiler = queryset.query.get_compiler(using=db)
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        return []
+    rows = await _pool(db).fetchall(sql, tuple(params))
+    # the columns of the registry itself, see django.db.models.query.ModelIterable
+    select_fields = compiler.klass_info["select_fields"]
+    start, end = select_fields[0], select_fields[-1] + 1
+    init_list = [column[0].target.attname for column in compiler.select[start:end]]
+    return [
+        queryset.model.from_db(db, init_list, row[start:end])
+        for row in compiler.results_iter(results=[rows])
+    ]
+
+
+async def afilter(
+    queryset: QuerySet | type[Record] | str, **expressions: Any
+) -> list[Record]:
+    """Records that match the filter expressions.
+
+    The asynchronous counterpart of `list(registry.filter(**expressions))`. Related
+    records are not prefetched, accessing them runs a synchronous query.
+
+    Args:
+        queryset: A registry or a queryset to filter further, e.g. with
+            `.order_by()` or a slice.
+        **expressions: Field lookups like in `.filter()`.
+
+    Examples:
+        >>> persons = await omop.aio.afilter(omop.Person, year_of_birth__gte=1980)
+        >>> visits = await omop.aio.afilter(
+        ...     omop.VisitOccurrence.filter(person_id=42).order_by("-visit_start_date")[:10]
+        ... )
+    """
+    return await _records(_queryset(queryset, expressions))
+
+
+async def aget(queryset: QuerySet | type[Record] | str, **expressions: Any) -> Record:
+    """The single record that matches the filter expressions.
+
+    Args:
+        queryset: A registry or a queryset.
+        **expressions: Field lookups like in `.get()`.
+
+    Raises:
+        DoesNotExist: No record matches.
+        MultipleObjectsReturned: More than one record matches.
+
+    Examples:
+        >>> person = await omop.aio.aget(omop.Person, person_source_value="P001")
+    """
+    queryset = _queryset(queryset, expressions)
+    registry = queryset.model
+    records = await _records(queryset[:MAX_GET_RESULTS])
+    if not records:
+        raise registry.DoesNotExist(
+            f"{registry._meta.object_name} matching query does not exist."
+        )
+    if len(records) > 1:
+        raise registry.MultipleObjectsReturned(
+            f"get() returned more than one {registry._meta.object_name}."
+        )
+    return records[0]
+
+
+async def _fetchall(select: Select) -> list[tuple]:
+    return await _pool(select.db).fetchall(select.sql, select.params)
+
+
+async def astream(
+    queryset: QuerySet | type[Record] | str,
+    columns: Iterable[str] | None = None,
+    *,
+    batch_size: int = 100_000,
+    format: Literal["pandas", "arrow"] = "pandas",
+) -> AsyncIterator[pd.DataFrame | pa.RecordBatch]:
+    """Stream query results in batches, see :func:`omop.query.stream`.
+
+    Rows are read from a server-side cursor on Postgres.
+
+    Examples:
+        >>> queryset = omop.Measurement.filter(measurement_concept_id=3004501)
+        >>> async for df in omop.aio.astream(queryset, ["person_id", "value_as_number"]):
+        ...     ...
+    """
+    _check_format(format)
+    select = compile_select(as_queryset(queryset), columns)
+    if format == "arrow":
+        import pyarrow as pa
+    batches = _pool(select.db).fetch_batches(select.sql, select.params, batch_size)
+    async for rows in batches:
+        df = to_frame(rows, select)
+        if format == "arrow":
+            yield pa.RecordBatch.from_pandas(df, preserve_index=False)
+        else:
+            yield df
+
+
+async def atimeline(
+    person_id: int, registries: Iterable[type | str] | None = None
+) -> pd.DataFrame:
+    """All events of a person, see :func:`omop.events.timeline`.
+
+    The event registries are queried concurrently.
+
+    Examples:
+        >>> df = await omop.aio.atimeline(42)
+    """
+    # routing to shards needs their number, looked up once per process
+    await sync_to_async(n_shards)()
+    tables = _event_tables(registries)
+    selects = [_timeline_select(table, person_id) for table in tables]
+    results = await asyncio.gather(*(_fetchall(select) for select in selects))
+    return _timeline_frame(tables, selects, results)
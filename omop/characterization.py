@@ -0,0 +1,300 @@
+"""Database characterization in the style of OHDSI Achilles.
+
+Analyses compute aggregate counts with single-pass `GROUP BY` queries or, for
+histograms, with streaming aggregation. Results are stored in
+:class:`~omop.AchillesResult` keyed by analysis id. :func:`refresh` recomputes only
+the analyses whose source registries changed since their last computation.
+
+Analysis ids follow the numbering scheme of Achilles, in which the leading digits
+denote the domain, e.g. `4xx` for conditions and `18xx` for measurements.
+
+.. autosummary::
+   :toctree: .
+
+   analyses
+   refresh
+   results
+"""
+
+from __future__ import annotations
+
+from itertools import islice
+from typing import TYPE_CHECKING, Callable, NamedTuple
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+from django.db.models import Count, FloatField, Max, Min
+from django.db.models.functions import Cast
+from django.utils import timezone
+from lamin_utils import logger
+
+from ._utils import get_registry, unfiltered
+from .models import AchillesAnalysis, AchillesResult
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+N_BINS = 20
+CHUNK_SIZE = 100_000
+
+
+class Analysis(NamedTuple):
+    analysis_id: int
+    analysis_name: str
+    registries: tuple[str, ...]
+    compute: Callable[[], Iterable[tuple]]
+    """Yields rows of up to four strata followed by the count."""
+
+
+def _group_by(registry: str, *fields: str, distinct_persons: bool = False):
+    def compute() -> Iterator[tuple]:
+        count = Count("person_id", distinct=True) if distinct_persons else Count("pk")
+        queryset = unfiltered(get_registry(registry))
+        if not fields:
+            yield (queryset.aggregate(count_value=count)["count_value"],)
+            return
+        yield from (
+            queryset.values(*fields)
+            .annotate(count_value=count)
+            .order_by(*fields)
+            .values_list(*fields, "count_value")
+        )
+
+    return compute
+
+
+def _value_histogram(
+    registry: str, concept_field: str, unit_field: str, value_field: str
+):
+    def compute() -> Iterator[tuple]:
+        queryset = unfiltered(get_registry(registry)).filter(
+            **{f"{value_field}__isnull": False}
+        )
+        value = Cast(value_field, FloatField())
+        keys = [concept_field, unit_field]
+        groups = pd.DataFrame(
+            queryset.values(*keys)
+            .annotate(low=Min(value), high=Max(value))
+            .order_by(*keys)
+            .values_list(*keys, "low", "high"),
+            columns=[*keys, "low", "high"],
+        )
+        if groups.empty:
+            return
+        groups["group"] = np.arange(len(groups))
+        counts = np.zeros(len(groups) * N_BINS, dtype=np.int64)
+        # second pass: stream the values and bin them chunk by chunk
+        rows = queryset.values_list(*keys, value_field).iterator(chunk_size=CHUNK_SIZE)
+        while chunk := list(islice(rows, CHUNK_SIZE)):
+            df = pd.DataFrame(chunk, columns=[*keys, "value"])
+            df["value"] = df["value"].astype(float)
+            df = df.merge(groups, on=keys, how="left")
+            width = (df["high"] - df["low"]).to_numpy()
+            position = np.divide(
+                df["value"].to_numpy() - df["low"].to_numpy(),
+                width,
+                out=np.zeros(len(df)),
+                where=width > 0,
+            )
+            bins = np.clip((position * N_BINS).astype(np.int64), 0, N_BINS - 1)
+            counts += np.bincount(
+                df["group"].to_numpy() * N_BINS + bins, minlength=len(counts)
+            )
+        for group in groups.itertuples():
+            edges = np.linspace(group.low, group.high, N_BINS + 1)
+            for i in np.flatnonzero(counts[group.group * N_BINS :][:N_BINS]):
+                yield (
+                    getattr(group, concept_field),
+                    getattr(group, unit_field),
+                    float(edges[i]),
+                    float(edges[i + 1]),
+                    int(counts[group.group * N_BINS + i]),
+                )
+
+    return compute
+
+
+ANALYSES: dict[int, Analysis] = {
+    analysis.analysis_id: analysis
+    for analysis in [
+        Analysis(0, "Number of persons", ("Person",), _group_by("Person")),
+        Analysis(
+            2,
+            "Number of persons by gender",
+            ("Person",),
+            _group_by("Person", "gender_concept_id"),
+        ),
+        Analysis(
+            3,
+            "Number of persons by year of birth",
+            ("Person",),
+            _group_by("Person", "year_of_birth"),
+        ),
+        Analysis(
+            10,
+            "Number of persons by year of birth and gender",
+            ("Person",),
+            _group_by("Person", "year_of_birth", "gender_concept_id"),
+        ),
+        Analysis(
+            200,
+            "Number of persons with at least one visit occurrence, by visit_concept_id",
+            ("VisitOccurrence",),
+            _group_by("VisitOccurrence", "visit_concept_id", distinct_persons=True),
+        ),
+        Analysis(
+            201,
+            "Number of visit occurrence records, by visit_concept_id",
+            ("VisitOccurrence",),
+            _group_by("VisitOccurrence", "visit_concept_id"),
+        ),
+        Analysis(
+            202,
+            "Number of visit occurrence records, by visit_concept_id and visit_type_concept_id",
+            ("VisitOccurrence",),
+            _group_by("VisitOccurrence", "visit_concept_id", "visit_type_concept_id"),
+        ),
+    ]
+}
+
+# concept prevalence per domain
+for _offset, _registry, _table, _concept_field in [
+    (400, "ConditionOccurrence", "condition occurrence", "condition_concept_id"),
+    (600, "ProcedureOccurrence", "procedure occurrence", "procedure_concept_id"),
+    (700, "DrugExposure", "drug exposure", "drug_concept_id"),
+    (800, "Observation", "observation", "observation_concept_id"),
+    (1800, "Measurement", "measurement", "measurement_concept_id"),
+    (2100, "DeviceExposure", "device exposure", "device_concept_id"),
+]:
+    ANALYSES[_offset] = Analysis(
+        _offset,
+        f"Number of persons with at least one {_table} record, by {_concept_field}",
+        (_registry,),
+        _group_by(_registry, _concept_field, distinct_persons=True),
+    )
+    ANALYSES[_offset + 1] = Analysis(
+        _offset + 1,
+        f"Number of {_table} records, by {_concept_field}",
+        (_registry,),
+        _group_by(_registry, _concept_field),
+    )
+
+ANALYSES[1815] = Analysis(
+    1815,
+    f"Histogram of value_as_number in {N_BINS} bins, by measurement_concept_id and unit_concept_id",
+    ("Measurement",),
+    _value_histogram(
+        "Measurement", "measurement_concept_id", "unit_concept_id", "value_as_number"
+    ),
+)
+
+
+def _source_state(registry: str) -> dict:
+    state = unfiltered(get_registry(registry)).aggregate(
+        n_records=Count("pk"), updated_at=Max("updated_at")
+    )
+    if state["updated_at"] is not None:
+        state["updated_at"] = state["updated_at"].isoformat()
+    return state
+
+
+def analyses() -> pd.DataFrame:
+    """Available analyses and when they were last computed.
+
+    Examples:
+        >>> omop.characterization.analyses()
+    """
+    computed = dict(unfiltered(AchillesAnalysis).values_list("pk", "updated_at"))
+    return pd.DataFrame(
+        [
+            (
+                analysis.analysis_id,
+                analysis.analysis_name,
+                list(analysis.registries),
+                computed.get(analysis.analysis_id),
+            )
+            for analysis in ANALYSES.values()
+        ],
+        columns=["analysis_id", "analysis_name", "registries", "computed_at"],
+    ).set_index("analysis_id")
+
+
+def refresh(
+    analysis_ids: Iterable[int] | None = None, *, force: bool = False
+) -> list[int]:
+    """Compute analyses whose source registries changed since their last run.
+
+    The state of a source registry is its number of records and the latest
+    `updated_at`, both retrieved in a single aggregate query.
+
+    Args:
+        analysis_ids: Analyses to consider, defaults to all.
+        force: Whether to recompute regardless of the state of the sources.
+
+    Returns:
+        The ids of the recomputed analyses.
+
+    Examples:
+        >>> omop.characterization.refresh()
+        >>> omop.characterization.refresh([2, 3], force=True)
+    """
+    selected = (
+        list(ANALYSES.values())
+        if analysis_ids is None
+        else [ANALYSES[analysis_id] for analysis_id in analysis_ids]
+    )
+    registries = {registry for analysis in selected for registry in analysis.registries}
+    states = {registry: _source_state(registry) for registry in registries}
+    stored = dict(unfiltered(AchillesAnalysis).values_list("pk", "source_state"))
+    refreshed = []
+    for analysis in selected:
+        source_state = {registry: states[registry] for registry in analysis.registries}
+        if not force and stored.get(analysis.analysis_id) == source_state:
+            continue
+        results = [
+            AchillesResult(
+                analysis_id=analysis.analysis_id,
+                **{
+                    f"stratum_{i + 1}": None if stratum is None else str(stratum)
+                    for i, stratum in enumerate(row[:-1])
+                },
+                count_value=row[-1],
+            )
+            for row in analysis.compute()
+        ]
+        with transaction.atomic():
+            unfiltered(AchillesAnalysis).update_or_create(
+                pk=analysis.analysis_id,
+                defaults={
+                    "analysis_name": analysis.analysis_name,
+                    "source_state": source_state,
+                    "updated_at": timezone.now(),
+                },
+            )
+            unfiltered(AchillesResult).filter(analysis_id=analysis.analysis_id).delete()
+            AchillesResult.objects.bulk_create(results, batch_size=1000)
+        refreshed.append(analysis.analysis_id)
+    logger.info(f"refreshed {len(refreshed)} of {len(selected)} analyses")
+    return refreshed
+
+
+def results(analysis_id: int) -> pd.DataFrame:
+    """Stored results of an analysis.
+
+    Strata that are not used by the analysis are dropped.
+
+    Examples:
+        >>> omop.characterization.results(2)  # persons by gender
+    """
+    columns = ["stratum_1", "stratum_2", "stratum_3", "stratum_4", "count_value"]
+    df = pd.DataFrame(
+        unfiltered(AchillesResult)
+        .filter(analysis_id=analysis_id)
+        .order_by("pk")
+        .values_list(*columns),
+        columns=columns,
+    )
+    if df.empty:
+        return df
+    return df.dropna(axis=1, how="all")
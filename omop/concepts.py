@@ -0,0 +1,452 @@
+"""Resolve the concept foreign keys of the omop registries in bulk.
+
+Every event registry has several foreign keys to :class:`~omop.Concept`, e.g.
+`measurement_concept`, `unit_concept` and `value_as_concept` of
+:class:`~omop.Measurement`. Accessing them on records runs one query per record
+and foreign key. :func:`select_concepts` joins the concepts that a caller will
+read in the query of the records, and :func:`decode` adds concept names to
+DataFrames from :func:`omop.query.fetch` with a fixed number of queries, looking
+the names up in a process-wide cache of the `NAMES_CACHE_SIZE` most recently used
+concepts.
+
+Workers that decode many concepts share a :class:`ConceptCache` instead: the
+attributes of all concepts are written once by :func:`build_cache` into columnar
+files, which every process maps into memory read-only with :func:`attach_cache`.
+The operating system keeps a single copy of the mapped pages for all processes.
+
+.. autosummary::
+   :toctree: .
+
+   select_concepts
+   decode
+   concept_names
+   concept_fields
+   clear_cache
+   build_cache
+   attach_cache
+   ConceptCache
+"""
+
+from __future__ import annotations
+
+import json
+import tempfile
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+from django.db.models import ForeignObjectRel
+from django.db.models.signals import post_save
+from lamin_utils import logger
+
+from ._columnar import as_queryset
+from ._utils import get_registry, replace_directory, state_path
+from .query import stream
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+    from django.db.models import QuerySet
+    from lamindb.models import Record
+
+# concept ids per query, below the limit of bound parameters of SQLite
+BATCH_SIZE = 10_000
+
+# concepts whose names are kept by this process
+NAMES_CACHE_SIZE = 1_000_000
+
+
+class _NameCache(OrderedDict):
+    """Names of concepts, the least recently used beyond `maxsize` are evicted."""
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def lookup(self, concept_ids: Iterable[int]) -> dict[int, str]:
+        found = {}
+        for concept_id in concept_ids:
+            if concept_id in self:
+                self.move_to_end(concept_id)
+                found[concept_id] = self[concept_id]
+        return found
+
+    def add(self, items: Iterator[tuple[int, str]]) -> None:
+        for concept_id, name in items:
+            self[concept_id] = name
+            self.move_to_end(concept_id)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# names of the concepts looked up so far
+_names = _NameCache(NAMES_CACHE_SIZE)
+
+# columns of the concept cache with few distinct values, stored as codes
+CATEGORICAL_COLUMNS = [
+    "domain_id",
+    "vocabulary_id",
+    "concept_class",
+    "standard_concept",
+]
+
+# the concept cache attached by this process
+_cache: ConceptCache | None = None
+
+
+def concept_fields(registry: type[Record] | str) -> list[str]:
+    """Names of the foreign keys of a registry to :class:`~omop.Concept`.
+
+    Examples:
+        >>> omop.concepts.concept_fields(omop.Measurement)
+        ['measurement_concept', 'measurement_type_concept', 'operator_concept', ...]
+    """
+    registry = get_registry(registry)
+    concept = get_registry("Concept")
+    return [
+        field.name
+        for field in registry._meta.concrete_fields
+        if field.many_to_one and field.related_model is concept
+    ]
+
+
+def _relation_path(registry: type[Record], name: str) -> tuple[str, bool] | None:
+    """The relations traversed by a field path and whether all are single-valued."""
+    opts = registry._meta
+    relations: list[str] = []
+    single_valued = True
+    for part in name.split("__"):
+        field = opts.get_field(part)
+        # selecting `person_id` doesn't traverse the foreign key
+        if not field.is_relation or part != field.name:
+            break
+        # prefetching reverse relations needs their accessor, e.g. `*_set`
+        relations.append(
+            field.get_accessor_name() if isinstance(field, ForeignObjectRel) else part
+        )
+        single_valued &= bool(field.many_to_one or field.one_to_one)
+        opts = field.related_model._meta
+    if not relations:
+        return None
+    return "__".join(relations), single_valued
+
+
+def select_concepts(
+    queryset: QuerySet | type[Record] | str, fields: Iterable[str] | None = None
+) -> QuerySet:
+    """Fetch the related records that will be read together with the records.
+
+    Forward foreign keys are joined with `select_related()`, other relations are
+    prefetched with `prefetch_related()`, so that reading them doesn't run a
+    query per record.
+
+    Args:
+        queryset: A queryset or a registry.
+        fields: The fields the caller will read, e.g. `"unit_concept__concept_name"`
+            or `"person__gender_concept"`. Defaults to all concept foreign keys of
+            the registry, see :func:`concept_fields`.
+
+    Examples:
+        >>> queryset = omop.concepts.select_concepts(
+        ...     omop.Measurement.filter(person_id=42),
+        ...     ["measurement_concept__concept_name", "unit_concept__concept_name"],
+        ... )
+        >>> [(m.measurement_concept.concept_name, m.unit_concept) for m in queryset]
+    """
+    queryset = as_queryset(queryset)
+    if fields is None:
+        fields = concept_fields(queryset.model)
+    select, prefetch = [], []
+    for name in fields:
+        path = _relation_path(queryset.model, name)
+        if path is None:
+            continue
+        relation, single_valued = path
+        paths = select if single_valued else prefetch
+        if relation not in paths:
+            paths.append(relation)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
+
+
+def concept_names(concept_ids: Iterable[int]) -> dict[int, str]:
+    """Names of concepts, querying only those that are not cached yet.
+
+    Ids without a concept are missing from the result.
+
+    Examples:
+        >>> omop.concepts.concept_names([3004501, 8532])
+        {3004501: 'Glucose [Mass/volume] in Serum or Plasma', 8532: 'FEMALE'}
+    """
+    concept_ids = {int(concept_id) for concept_id in concept_ids}
+    # the attached cache holds the names outside of the memory of this process
+    names = {} if _cache is None else _cache.names(concept_ids)
+    names.update(_names.lookup(concept_ids - names.keys()))
+    missing = sorted(concept_ids - names.keys())
+    concept = get_registry("Concept")
+    for start in range(0, len(missing), BATCH_SIZE):
+        rows = list(
+            concept.filter(
+                concept_id__in=missing[start : start + BATCH_SIZE]
+            ).values_list("concept_id", "concept_name")
+        )
+        names.update(rows)
+        _names.add(iter(rows))
+    return names
+
+
+def decode(
+    df: pd.DataFrame, columns: Iterable[str] | None = None, *, suffix: str = "_name"
+) -> pd.DataFrame:
+    """Add the concept names of concept id columns.
+
+    Costs one query per 10,000 distinct concepts that are not cached yet,
+    independent of the number of rows, and none for concepts of an attached
+    :class:`ConceptCache`.
+
+    Args:
+        df: A DataFrame, e.g. from :func:`omop.query.fetch`.
+        columns: Concept id columns, defaults to all integer columns whose name
+            ends with `concept_id`.
+        suffix: Replaces the `_id` suffix of a column in the name of its name column.
+
+    Returns:
+        A copy of `df` with a column of names next to every concept id column,
+        e.g. `unit_concept_name` next to `unit_concept_id`. Names of nulls and of
+        ids without a concept are null.
+
+    Examples:
+        >>> df = omop.query.fetch(omop.Measurement.filter(person_id=42))
+        >>> omop.concepts.decode(df)
+    """
+    if columns is None:
+        columns = [
+            column
+            for column in df.columns
+            if column.endswith("concept_id")
+            and pd.api.types.is_integer_dtype(df[column])
+        ]
+    columns = list(columns)
+    codes = {column: pd.factorize(df[column]) for column in columns}
+    names = concept_names(
+        np.concatenate([uniques for _, uniques in codes.values()]).tolist()
+        if columns
+        else []
+    )
+    df = df.copy()
+    for column in columns:
+        column_codes, uniques = codes[column]
+        # the last entry is the name of nulls, which have the code -1
+        lookup = np.array(
+            [names.get(int(concept_id)) for concept_id in uniques] + [None],
+            dtype=object,
+        )
+        name = column.removesuffix("_id") + suffix
+        df.insert(df.columns.get_loc(column) + 1, name, lookup[column_codes])
+    return df
+
+
+def clear_cache() -> None:
+    """Forget the cached concept names and detach the concept cache.
+
+    Saving a concept and writing concepts with :func:`omop.load.merge` or
+    :func:`omop.load.load_csv` invalidate the cached names, call this after
+    changing concepts otherwise, e.g. with `QuerySet.update()`.
+
+    Examples:
+        >>> omop.concepts.clear_cache()
+    """
+    global _cache
+    _names.clear()
+    _cache = None
+
+
+class ConceptCache:
+    """Attributes of all concepts in memory-mapped columnar arrays.
+
+    Concepts are looked up by a binary search over their sorted ids. The cache is
+    a snapshot of the :class:`~omop.Concept` registry, rebuild it with
+    :func:`build_cache` after loading a vocabulary.
+
+    Args:
+        path: The directory written by :func:`build_cache`.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        with open(self.path / "meta.json") as f:
+            self.meta = json.load(f)
+        self.concept_ids: np.ndarray = np.load(
+            self.path / "concept_id.npy", mmap_mode="r"
+        )
+        self._offsets = np.load(self.path / "concept_name.offsets.npy", mmap_mode="r")
+        data = self.path / "concept_name.data"
+        # empty files cannot be mapped
+        self._data = (
+            np.memmap(data, mode="r")
+            if data.stat().st_size
+            else np.zeros(0, dtype=np.uint8)
+        )
+        self._codes = {
+            column: np.load(self.path / f"{column}.codes.npy", mmap_mode="r")
+            for column in CATEGORICAL_COLUMNS
+        }
+        # the last entry is the value of the code -1 of nulls
+        self._categories = {
+            column: np.array([*self.meta["categories"][column], None], dtype=object)
+            for column in CATEGORICAL_COLUMNS
+        }
+
+    def __len__(self) -> int:
+        return len(self.concept_ids)
+
+    def _positions(self, concept_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        if not len(self):
+            return np.zeros(len(concept_ids), dtype=np.int64), np.zeros(
+                len(concept_ids), dtype=bool
+            )
+        positions = np.searchsorted(self.concept_ids, concept_ids)
+        positions[positions == len(self)] = 0
+        return positions, self.concept_ids[positions] == concept_ids
+
+    def _names_at(self, positions: np.ndarray) -> list[str]:
+        starts = self._offsets[positions].tolist()
+        ends = self._offsets[positions + 1].tolist()
+        # slicing a memoryview is several times faster than slicing the array
+        data = memoryview(self._data)
+        return [str(data[start:end], "utf-8") for start, end in zip(starts, ends)]
+
+    def names(self, concept_ids: Iterable[int]) -> dict[int, str]:
+        """Names of the cached concepts among the ids."""
+        concept_ids = np.fromiter(concept_ids, dtype=np.int64)
+        positions, found = self._positions(concept_ids)
+        return dict(zip(concept_ids[found].tolist(), self._names_at(positions[found])))
+
+    def lookup(
+        self, concept_ids: Iterable[int], columns: Iterable[str] | None = None
+    ) -> pd.DataFrame:
+        """Attributes of concepts, one row per id.
+
+        Args:
+            concept_ids: Ids to look up, may repeat.
+            columns: Attributes to return, defaults to `concept_name` and the
+                columns of `CATEGORICAL_COLUMNS`.
+
+        Returns:
+            A DataFrame with a column `concept_id` and the attributes, which are null
+            for ids without a cached concept.
+
+        Examples:
+            >>> cache = omop.concepts.attach_cache()
+            >>> cache.lookup(df["measurement_concept_id"], ["concept_name", "domain_id"])
+        """
+        columns = ["concept_name", *CATEGORICAL_COLUMNS] if columns is None else columns
+        codes, uniques = pd.factorize(np.asarray(concept_ids, dtype=np.int64))
+        positions, found = self._positions(uniques)
+        df = pd.DataFrame({"concept_id": uniques[codes]})
+        for column in columns:
+            if column == "concept_name":
+                values = np.full(len(uniques), None, dtype=object)
+                values[found] = self._names_at(positions[found])
+            elif column in self._codes:
+                value_codes = np.where(found, self._codes[column][positions], -1)
+                values = self._categories[column][value_codes]
+            else:
+                raise ValueError(f"the concept cache holds no column {column}")
+            df[column] = values[codes]
+        return df
+
+
+def _cache_path(path: str | Path | None) -> Path:
+    return state_path("concepts") if path is None else Path(path)
+
+
+def build_cache(path: str | Path | None = None, *, batch_size: int = 100_000) -> Path:
+    """Write the attributes of all concepts into a cache for :func:`attach_cache`.
+
+    The files are written into a temporary directory that replaces an existing
+    cache when it is complete, so that processes never attach a partial cache.
+
+    Args:
+        path: The directory of the cache, defaults to the cache directory of the
+            instance.
+        batch_size: Number of concepts read at a time.
+
+    Examples:
+        >>> omop.concepts.build_cache()
+    """
+    path = _cache_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    build = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}-"))
+    ids, lengths = [], []
+    categories: dict[str, dict[str, int]] = {c: {} for c in CATEGORICAL_COLUMNS}
+    codes: dict[str, list[np.ndarray]] = {c: [] for c in CATEGORICAL_COLUMNS}
+    queryset = get_registry("Concept").filter().order_by("concept_id")
+    with open(build / "concept_name.data", "wb") as data:
+        for df in stream(
+            queryset,
+            ["concept_id", "concept_name", *CATEGORICAL_COLUMNS],
+            batch_size=batch_size,
+        ):
+            ids.append(df["concept_id"].to_numpy(np.int64))
+            encoded = [name.encode() for name in df["concept_name"]]
+            lengths.append(np.fromiter(map(len, encoded), np.int64, len(encoded)))
+            data.write(b"".join(encoded))
+            for column in CATEGORICAL_COLUMNS:
+                mapping = categories[column]
+                for value in df[column].dropna().unique():
+                    mapping.setdefault(value, len(mapping))
+                codes[column].append(
+                    df[column].map(mapping).fillna(-1).to_numpy(np.int32)
+                )
+    concept_ids = np.concatenate(ids) if ids else np.array([], dtype=np.int64)
+    np.save(build / "concept_id.npy", concept_ids)
+    offsets = np.zeros(len(concept_ids) + 1, dtype=np.int64)
+    if lengths:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    np.save(build / "concept_name.offsets.npy", offsets)
+    for column in CATEGORICAL_COLUMNS:
+        column_codes = codes[column] or [np.array([], dtype=np.int32)]
+        np.save(build / f"{column}.codes.npy", np.concatenate(column_codes))
+    meta = {
+        "n_concepts": len(concept_ids),
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "categories": {
+            column: list(categories[column]) for column in CATEGORICAL_COLUMNS
+        },
+    }
+    with open(build / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+    replace_directory(build, path)
+    logger.success(f"cached {len(concept_ids)} concepts in {path}")
+    return path
+
+
+def attach_cache(path: str | Path | None = None) -> ConceptCache:
+    """Map a concept cache into memory and use it in :func:`decode`.
+
+    Args:
+        path: The directory of the cache, defaults to the cache directory of the
+            instance.
+
+    Examples:
+        >>> cache = omop.concepts.attach_cache()
+        >>> omop.concepts.decode(df)  # doesn't query the database
+    """
+    global _cache
+    _cache = ConceptCache(_cache_path(path))
+    return _cache
+
+
+def _on_post_save(sender: type[Record], instance: Record, **kwargs) -> None:
+    if sender._meta.app_label == "omop" and sender.__name__ == "Concept":
+        _names.pop(instance.concept_id, None)
+
+
+post_save.connect(_on_post_save, dispatch_uid="omop_concept_names")
@@ -0,0 +1,318 @@
+"""Rollups of the monetary columns of :class:`~omop.Cost`.
+
+:func:`rollup` sums `total_charge`, `total_cost`, `paid_by_payer` and the other
+monetary columns of costs per level of `LEVELS`, in the currency of the costs:
+
+- `domain`: per `cost_domain_id`, with a single `GROUP BY` query.
+- `visit`: per visit occurrence of the costed event.
+- `person_year`: per person and year of the start date of the costed event.
+
+A cost points at its event through `cost_event_id` and `cost_domain_id`, see
+:func:`omop.events.resolve`. The visit and person-year rollups join the event in
+the database with one `GROUP BY` query per event registry.
+
+Rollups are materialized in the cache directory of the instance. :func:`refresh`
+only aggregates the costs added since the last refresh, as long as older costs
+were neither changed nor deleted, and recomputes the rollups otherwise. Changes
+are detected by `updated_at`, which :func:`omop.load.merge` refreshes, and by the
+sums of the `CHECKSUM_COLUMNS`, which also change when a saved record doesn't
+refresh `updated_at`. Changes of the costed events are not detected, refresh with
+`force=True` after them.
+
+.. autosummary::
+   :toctree: .
+
+   rollup
+   refresh
+   clear_cache
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pandas as pd
+from django.db.models import (
+    Count,
+    F,
+    FloatField,
+    IntegerField,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+)
+from django.db.models.functions import Cast, ExtractYear, Length, Ord, Right
+from lamin_utils import logger
+
+from ._utils import get_registry, read_state, state_path, unfiltered, write_state
+from .events import DOMAIN_TABLES, EVENT_TABLES
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from pathlib import Path
+
+    from django.db.models import QuerySet
+
+MONETARY_COLUMNS = [
+    "total_charge",
+    "total_cost",
+    "total_paid",
+    "paid_by_payer",
+    "paid_by_patient",
+    "paid_patient_copay",
+    "paid_patient_coinsurance",
+    "paid_patient_deductible",
+    "paid_by_primary",
+    "paid_ingredient_cost",
+    "paid_dispensing_fee",
+    "amount_allowed",
+]
+
+# columns whose sums detect changes of costs that don't refresh `updated_at`
+CHECKSUM_COLUMNS = [
+    *MONETARY_COLUMNS,
+    "cost_event_id",
+    "currency_concept_id",
+    "cost_domain_id",
+]
+
+# the group keys of every level, all are also grouped by currency
+LEVELS = {
+    "domain": ["cost_domain_id"],
+    "visit": ["visit_occurrence_id"],
+    "person_year": ["person_id", "year"],
+}
+
+STATE_FILE = "costs.json"
+
+
+def _cache_path(level: str) -> Path:
+    return state_path(f"costs/{level}.pickle")
+
+
+def _sums() -> dict:
+    return {
+        "n_records": Count("pk"),
+        **{column: Sum(Cast(column, FloatField())) for column in MONETARY_COLUMNS},
+    }
+
+
+def _group_by(queryset: QuerySet, keys: list[str]) -> pd.DataFrame:
+    keys = [*keys, "currency_concept_id"]
+    columns = [*keys, "n_records", *MONETARY_COLUMNS]
+    rows = queryset.values(*keys).annotate(**_sums()).order_by().values_list(*columns)
+    return pd.DataFrame(list(rows), columns=columns)
+
+
+def _missing_keys(queryset: QuerySet, level: str) -> QuerySet:
+    return queryset.annotate(
+        **{key: Value(None, output_field=IntegerField()) for key in LEVELS[level]}
+    )
+
+
+def _event_groups(costs: QuerySet, level: str) -> list[pd.DataFrame]:
+    """Aggregate the costs of every event registry by attributes of their events.
+
+    Costs of an unknown domain, and costs of events without a visit in the visit
+    level, are grouped with missing keys.
+    """
+    domain_ids = costs.values_list("cost_domain_id", flat=True).distinct()
+    frames = []
+    for domain_id in sorted(domain_ids):
+        queryset = costs.filter(cost_domain_id=domain_id)
+        table = EVENT_TABLES.get(DOMAIN_TABLES.get(domain_id))
+        if table is None:
+            frames.append(_group_by(_missing_keys(queryset, level), LEVELS[level]))
+            continue
+        registry = get_registry(table.registry)
+        events = unfiltered(registry).filter(pk=OuterRef("cost_event_id"))
+        if level == "visit":
+            if registry.__name__ == "VisitOccurrence":
+                queryset = queryset.annotate(visit_occurrence_id=F("cost_event_id"))
+            elif any(f.name == "visit_occurrence" for f in registry._meta.fields):
+                queryset = queryset.annotate(
+                    visit_occurrence_id=Subquery(
+                        events.values("visit_occurrence_id")[:1]
+                    )
+                )
+            else:
+                queryset = _missing_keys(queryset, level)
+        else:
+            years = events.annotate(year=ExtractYear(table.start_date))
+            queryset = queryset.annotate(
+                person_id=Subquery(events.values("person_id")[:1]),
+                year=Subquery(years.values("year")[:1]),
+            )
+        frames.append(_group_by(queryset, LEVELS[level]))
+    return frames
+
+
+def _aggregate(costs: QuerySet, level: str) -> pd.DataFrame:
+    if level == "domain":
+        frames = [_group_by(costs, LEVELS[level])]
+    else:
+        frames = _event_groups(costs, level)
+    return _combine(frames, level)
+
+
+def _combine(frames: list[pd.DataFrame], level: str) -> pd.DataFrame:
+    """Sum the groups of several frames that share keys."""
+    keys = [*LEVELS[level], "currency_concept_id"]
+    columns = [*keys, "n_records", *MONETARY_COLUMNS]
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)
+    df[MONETARY_COLUMNS] = df[MONETARY_COLUMNS].astype("float64")
+    # integer keys with missing values, e.g. of costs without a visit
+    for key in keys:
+        if key != "cost_domain_id":
+            df[key] = df[key].astype("Int64")
+    # sums of groups without any values stay missing
+    df = df.groupby(keys, dropna=False, sort=True).sum(min_count=1).reset_index()
+    df["n_records"] = df["n_records"].astype("int64")
+    return df[columns]
+
+
+def _checksum_value(column: str):
+    if column == "cost_domain_id":
+        # a number per domain from its first and last characters and length
+        return Ord(column) * 65536 + Ord(Right(column, 1)) * 256 + Length(column)
+    return Cast(column, FloatField())
+
+
+def _checksums(filter: Q | None = None) -> dict:
+    return {
+        f"sum_{column}": Sum(_checksum_value(column), filter=filter)
+        for column in CHECKSUM_COLUMNS
+    }
+
+
+def _source_state() -> dict:
+    state = unfiltered(get_registry("Cost")).aggregate(
+        n_records=Count("pk"),
+        max_cost_id=Max("pk"),
+        updated_at=Max("updated_at"),
+        **_checksums(),
+    )
+    if state["updated_at"] is not None:
+        state["updated_at"] = state["updated_at"].isoformat()
+    return state
+
+
+def _until(costs: QuerySet, state: dict) -> QuerySet:
+    """The costs up to a state, without costs added after it was taken."""
+    if state["max_cost_id"] is None:
+        return costs.none()
+    return costs.filter(pk__lte=state["max_cost_id"])
+
+
+def _appended_only(stored: dict, state: dict) -> bool:
+    """Whether the costs only changed by new costs after the stored state."""
+    if stored.get("max_cost_id") is None:
+        return stored.get("n_records") == 0
+    old = Q(pk__lte=stored["max_cost_id"])
+    counts = _until(unfiltered(get_registry("Cost")), state).aggregate(
+        n_new=Count("pk", filter=~old),
+        n_updated=Count("pk", filter=old & Q(updated_at__gt=stored["updated_at"])),
+        **_checksums(old),
+    )
+    n_deleted = stored["n_records"] + counts["n_new"] - state["n_records"]
+    # the old costs still sum to the stored checksums
+    unchanged = all(counts[key] == stored.get(key) for key in _checksums())
+    return counts["n_updated"] == 0 and n_deleted == 0 and unchanged
+
+
+def refresh(
+    levels: Iterable[str] | None = None, *, force: bool = False
+) -> dict[str, str]:
+    """Update the materialized rollups with the current costs.
+
+    The state of the costs is their number, the largest `cost_id`, the latest
+    `updated_at` and the sums of the `CHECKSUM_COLUMNS`, retrieved in a single
+    aggregate query. Rollups only aggregate the costs up to the largest `cost_id`
+    of the state, costs added while refreshing are left to the next refresh.
+
+    Args:
+        levels: Levels to refresh, defaults to all of `LEVELS`.
+        force: Whether to recompute the rollups regardless of the state.
+
+    Returns:
+        How every rollup was refreshed, `"unchanged"`, `"incremental"` or
+        `"full"`.
+
+    Examples:
+        >>> omop.costs.refresh()
+        {'domain': 'incremental', 'visit': 'incremental', 'person_year': 'incremental'}
+    """
+    levels = list(LEVELS) if levels is None else list(levels)
+    for level in levels:
+        if level not in LEVELS:
+            raise ValueError(f"unknown level {level}, choose from {list(LEVELS)}")
+    state = _source_state()
+    costs = _until(unfiltered(get_registry("Cost")), state)
+    stored_states = read_state(STATE_FILE)
+    refreshed = {}
+    for level in levels:
+        path = _cache_path(level)
+        stored = stored_states.get(level)
+        if not force and stored is not None and path.exists():
+            if stored == state:
+                refreshed[level] = "unchanged"
+                continue
+            if _appended_only(stored, state):
+                new = costs
+                if stored["max_cost_id"] is not None:
+                    new = costs.filter(pk__gt=stored["max_cost_id"])
+                df = _combine(
+                    [pd.read_pickle(path), _aggregate(new, level)],
+                    level,
+                )
+                refreshed[level] = "incremental"
+        if level not in refreshed:
+            df = _aggregate(costs, level)
+            refreshed[level] = "full"
+        df.to_pickle(path)
+        stored_states[level] = state
+        write_state(STATE_FILE, stored_states)
+    logger.info(
+        "refreshed cost rollups: "
+        + ", ".join(f"{level} ({how})" for level, how in refreshed.items())
+    )
+    return refreshed
+
+
+def rollup(level: str, *, cached: bool = False) -> pd.DataFrame:
+    """Sums of the monetary columns of costs per group of a level.
+
+    Args:
+        level: One of `LEVELS`, `"domain"`, `"visit"` or `"person_year"`.
+        cached: Whether to return the materialized rollup as is, without
+            :func:`refresh` before reading it.
+
+    Returns:
+        A DataFrame with the keys of the level, `currency_concept_id`,
+        `n_records` and the float64 sums of the `MONETARY_COLUMNS`. Costs whose
+        event doesn't exist are grouped with missing keys.
+
+    Examples:
+        >>> omop.costs.rollup("person_year")
+        >>> omop.costs.rollup("domain", cached=True)
+    """
+    if not cached or not _cache_path(level).exists():
+        refresh([level])
+    return pd.read_pickle(_cache_path(level))
+
+
+def clear_cache() -> None:
+    """Delete the materialized rollups.
+
+    Examples:
+        >>> omop.costs.clear_cache()
+    """
+    for level in LEVELS:
+        _cache_path(level).unlink(missing_ok=True)
+    write_state(STATE_FILE, {})
@@ -0,0 +1,262 @@
+"""Daily doses of drug exposures per ingredient.
+
+The daily dose of an ingredient in a :class:`~omop.DrugExposure` follows from the
+:class:`~omop.DrugStrength` of the drug, the `quantity` and the days of supply,
+with the formulas of the OHDSI DrugUtilisation package for the pattern of the
+strength:
+
+- `fixed_amount`, e.g. 500 mg tablets: `quantity * amount_value / days`.
+- `concentration`, e.g. 5 mg/mL oral solution: `quantity * numerator_value /
+  days`, with the quantity in the unit of the denominator.
+- `quantified`, e.g. a 10 mL syringe of 50 mg: `quantity * numerator_value /
+  days`, with the quantity in packages.
+- `time_based`, e.g. a 5 mg/16 h patch: `numerator_value * 24 /
+  denominator_value` if the denominator exceeds 24 hours, `numerator_value`
+  otherwise, and `numerator_value * 24` without a denominator.
+
+The days are `days_supply`, or the days from the start to the end of the
+exposure. An exposure uses the strengths whose validity period includes its start
+date, and of several versions of the strength of an ingredient the valid one with
+the latest `valid_start_date`. Amounts are normalized to milligrams, milliliters and international
+units where their unit allows.
+
+:func:`stream` joins batches of exposures with the drug strengths in memory and
+computes the doses of a batch with array operations, so that any number of
+exposures is processed with constant memory.
+
+.. autosummary::
+   :toctree: .
+
+   fetch
+   stream
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+
+from ._columnar import as_queryset
+from ._utils import get_registry
+from .query import fetch as fetch_frame
+from .query import stream as stream_frames
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+    from django.db.models import QuerySet
+    from lamindb.models import Record
+
+DOSE_COLUMNS = [
+    "drug_exposure_id",
+    "person_id",
+    "drug_concept_id",
+    "ingredient_concept_id",
+    "drug_exposure_start_date",
+    "drug_exposure_end_date",
+    "pattern",
+    "daily_dose",
+    "unit_concept_id",
+]
+
+EXPOSURE_COLUMNS = [
+    "drug_exposure_id",
+    "person_id",
+    "drug_concept_id",
+    "drug_exposure_start_date",
+    "drug_exposure_end_date",
+    "quantity",
+    "days_supply",
+]
+
+STRENGTH_COLUMNS = [
+    "drug_concept_id",
+    "ingredient_concept_id",
+    "amount_value",
+    "amount_unit_concept_id",
+    "numerator_value",
+    "numerator_unit_concept_id",
+    "denominator_value",
+    "denominator_unit_concept_id",
+    "valid_start_date",
+    "valid_end_date",
+    "invalid_reason",
+]
+
+MILLIGRAM = 8576
+MILLILITER = 8587
+INTERNATIONAL_UNIT = 8718
+HOUR = 8505
+
+# units and the factor that converts them to the unit of doses
+UNITS = {
+    MILLIGRAM: (MILLIGRAM, 1.0),
+    9655: (MILLIGRAM, 1e-3),  # microgram
+    8504: (MILLIGRAM, 1e3),  # gram
+    MILLILITER: (MILLILITER, 1.0),
+    8519: (MILLILITER, 1e3),  # liter
+    INTERNATIONAL_UNIT: (INTERNATIONAL_UNIT, 1.0),
+    9439: (INTERNATIONAL_UNIT, 1e6),  # mega-international unit
+}
+
+
+def _normalize_units(unit_concept_ids: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """The units of doses and the factors to convert values into them."""
+    units = unit_concept_ids.to_numpy(dtype="float64", na_value=np.nan)
+    normalized, factors = units.copy(), np.ones(len(units))
+    for unit, (dose_unit, factor) in UNITS.items():
+        mask = units == unit
+        normalized[mask] = dose_unit
+        factors[mask] = factor
+    return normalized, factors
+
+
+def _strengths(ingredient_concept_ids: Iterable[int] | None) -> pd.DataFrame:
+    queryset = get_registry("DrugStrength").filter()
+    if ingredient_concept_ids is not None:
+        queryset = queryset.filter(ingredient_concept_id__in=ingredient_concept_ids)
+    df = fetch_frame(queryset, STRENGTH_COLUMNS)
+    df.columns = STRENGTH_COLUMNS
+    amount_units, amount_factors = _normalize_units(df["amount_unit_concept_id"])
+    numerator_units, numerator_factors = _normalize_units(
+        df["numerator_unit_concept_id"]
+    )
+    amount = df["amount_value"].to_numpy(dtype="float64", na_value=np.nan)
+    numerator = df["numerator_value"].to_numpy(dtype="float64", na_value=np.nan)
+    denominator = df["denominator_value"].to_numpy(dtype="float64", na_value=np.nan)
+    hourly = df["denominator_unit_concept_id"].to_numpy(
+        dtype="float64", na_value=np.nan
+    ) == float(HOUR)
+    has_amount = ~np.isnan(amount) & np.isnan(numerator)
+    has_numerator = ~np.isnan(numerator)
+    conditions = [
+        has_amount,
+        has_numerator & hourly,
+        has_numerator & np.isnan(denominator),
+        has_numerator & ~np.isnan(denominator),
+    ]
+    patterns = ["fixed_amount", "time_based", "concentration", "quantified"]
+    strengths = pd.DataFrame(
+        {
+            "drug_concept_id": df["drug_concept_id"],
+            "ingredient_concept_id": df["ingredient_concept_id"],
+            "pattern": np.select(conditions, patterns, default=None),
+            # the normalized amount per unit of quantity, or per day if time based
+            "strength": np.select(
+                conditions,
+                [
+                    amount * amount_factors,
+                    numerator
+                    * numerator_factors
+                    * np.where(
+                        np.isnan(denominator),
+                        24.0,
+                        np.where(denominator > 24, 24 / denominator, 1.0),
+                    ),
+                    numerator * numerator_factors,
+                    numerator * numerator_factors,
+                ],
+                default=np.nan,
+            ),
+            "unit_concept_id": pd.array(
+                np.select(
+                    [has_amount, has_numerator],
+                    [amount_units, numerator_units],
+                    default=np.nan,
+                ),
+                dtype="Int64",
+            ),
+            "valid_start_date": pd.to_datetime(df["valid_start_date"]),
+            "valid_end_date": pd.to_datetime(df["valid_end_date"]),
+            "invalid": df["invalid_reason"].notna(),
+        }
+    )
+    return strengths
+
+
+def _daily_doses(exposures: pd.DataFrame, strengths: pd.DataFrame) -> pd.DataFrame:
+    df = exposures.merge(strengths, on="drug_concept_id", how="inner")
+    start = pd.to_datetime(df["drug_exposure_start_date"])
+    df = df[(df["valid_start_date"] <= start) & (start <= df["valid_end_date"])]
+    # the preferred version of the strength of every ingredient
+    df = (
+        df.sort_values(
+            ["invalid", "valid_start_date"], ascending=[True, False], kind="stable"
+        )
+        .drop_duplicates(["drug_exposure_id", "ingredient_concept_id"])
+        .sort_index()
+    )
+    quantity = df["quantity"].to_numpy(dtype="float64", na_value=np.nan)
+    days_supply = df["days_supply"].to_numpy(dtype="float64", na_value=np.nan)
+    exposed = (
+        df["drug_exposure_end_date"] - df["drug_exposure_start_date"]
+    ).dt.days.to_numpy(dtype="float64", na_value=np.nan) + 1
+    days = np.where(days_supply > 0, days_supply, exposed)
+    days[days <= 0] = np.nan
+    strength = df["strength"].to_numpy(dtype="float64")
+    df["daily_dose"] = np.where(
+        df["pattern"].to_numpy() == "time_based",
+        strength,
+        quantity * strength / days,
+    )
+    return df[DOSE_COLUMNS]
+
+
+def stream(
+    queryset: QuerySet | type[Record] | str | None = None,
+    *,
+    ingredient_concept_ids: Iterable[int] | None = None,
+    batch_size: int = 100_000,
+) -> Iterator[pd.DataFrame]:
+    """Stream the daily doses of drug exposures in batches.
+
+    Args:
+        queryset: The drug exposures, defaults to all of them.
+        ingredient_concept_ids: Only doses of these ingredients, defaults to all
+            ingredients.
+        batch_size: Number of exposures per batch.
+
+    Yields:
+        DataFrames with one row per exposure and ingredient of its drug strength,
+        with the columns `drug_exposure_id`, `person_id`, `drug_concept_id`,
+        `ingredient_concept_id`, the dates of the exposure, the `pattern` of the
+        strength, the `daily_dose` and its `unit_concept_id`. The dose is missing
+        if the strength matches no pattern or the quantity or days are missing.
+        Exposures of drugs without a strength are skipped.
+
+    Examples:
+        >>> for df in omop.doses.stream(ingredient_concept_ids=[1503297]):
+        ...     df.groupby("person_id")["daily_dose"].mean()
+    """
+    queryset = as_queryset("DrugExposure" if queryset is None else queryset)
+    strengths = _strengths(
+        None if ingredient_concept_ids is None else list(ingredient_concept_ids)
+    )
+    for exposures in stream_frames(queryset, EXPOSURE_COLUMNS, batch_size=batch_size):
+        exposures.columns = EXPOSURE_COLUMNS
+        yield _daily_doses(exposures, strengths)
+
+
+def fetch(
+    queryset: QuerySet | type[Record] | str | None = None,
+    *,
+    ingredient_concept_ids: Iterable[int] | None = None,
+    batch_size: int = 100_000,
+) -> pd.DataFrame:
+    """The daily doses of drug exposures, see :func:`stream`.
+
+    Examples:
+        >>> omop.doses.fetch(omop.DrugExposure.filter(person_id=42))
+    """
+    frames = list(
+        stream(
+            queryset,
+            ingredient_concept_ids=ingredient_concept_ids,
+            batch_size=batch_size,
+        )
+    )
+    if not frames:
+        return pd.DataFrame(columns=DOSE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
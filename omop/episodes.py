@@ -0,0 +1,154 @@
+"""Episodes of persons as trees, with the events they comprise.
+
+An :class:`~omop.Episode` refines its parent through `episode_parent_id`, e.g. a
+treatment line of a cancer, and is linked to its clinical events by
+:class:`~omop.EpisodeEvent`. :func:`trees` loads the episodes of many persons at
+once and assembles their hierarchy in memory, with a fixed number of queries per
+10,000 persons: one for the episodes, and those of :func:`omop.events.resolve`
+for their events.
+
+.. autosummary::
+   :toctree: .
+
+   trees
+   EpisodeNode
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, NamedTuple
+
+import numpy as np
+import pandas as pd
+from lamin_utils import logger
+
+from ._utils import get_registry
+from .events import BATCH_SIZE, RESOLVED_COLUMNS, resolve
+from .query import fetch
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from datetime import datetime
+
+EPISODE_COLUMNS = [
+    "episode_id",
+    "person_id",
+    "episode_parent_id",
+    "episode_number",
+    "episode_concept_id",
+    "episode_object_concept_id",
+    "episode_start_date",
+    "episode_end_date",
+]
+
+
+class EpisodeNode(NamedTuple):
+    """An episode with its events and the episodes that refine it."""
+
+    episode_id: int
+    episode_number: int | None
+    episode_concept_id: int
+    episode_object_concept_id: int
+    episode_start_date: datetime
+    episode_end_date: datetime | None
+    events: pd.DataFrame
+    children: list[EpisodeNode]
+
+
+def _event_frames(episode_ids: np.ndarray, events: pd.DataFrame) -> list[pd.DataFrame]:
+    """The events of every episode, in the order of `episode_ids`."""
+    events = events.sort_values(["episode_id", "start_date"], ignore_index=True)
+    linked = events["episode_id"].to_numpy()
+    starts = np.searchsorted(linked, episode_ids, side="left")
+    ends = np.searchsorted(linked, episode_ids, side="right")
+    events = events[RESOLVED_COLUMNS]
+    return [events.iloc[start:end] for start, end in zip(starts, ends)]
+
+
+def trees(
+    person_ids: Iterable[int], *, events: bool = True
+) -> dict[int, list[EpisodeNode]]:
+    """The episodes of persons as trees.
+
+    Siblings are ordered by `episode_number`, start date and id. Episodes whose
+    parent is not an episode of the same person are roots.
+
+    Args:
+        person_ids: The ids of the persons.
+        events: Whether to attach the events of the episodes, resolved through
+            `event_id` and `episode_event_field_concept` of
+            :class:`~omop.EpisodeEvent`.
+
+    Returns:
+        The root episodes of every person with episodes. The events of an episode
+        are a DataFrame with the columns of :func:`omop.events.resolve`.
+
+    Examples:
+        >>> trees = omop.episodes.trees([1, 2])
+        >>> for episode in trees[1]:
+        ...     print(episode.episode_concept_id, len(episode.children))
+    """
+    person_ids = sorted({int(person_id) for person_id in person_ids})
+    episode = get_registry("Episode")
+    episode_event = get_registry("EpisodeEvent")
+    frames, event_frames = [], []
+    for start in range(0, len(person_ids), BATCH_SIZE):
+        batch = person_ids[start : start + BATCH_SIZE]
+        frames.append(fetch(episode.filter(person_id__in=batch), EPISODE_COLUMNS))
+        if events:
+            event_frames.append(
+                resolve(
+                    episode_event.filter(episode__person_id__in=batch),
+                    columns=["episode_id"],
+                )
+            )
+    if not frames:
+        return {}
+    df = pd.concat(frames, ignore_index=True)
+    df = df.sort_values(
+        ["person_id", "episode_number", "episode_start_date", "episode_id"],
+        na_position="last",
+        ignore_index=True,
+    )
+    if events:
+        linked = _event_frames(
+            df["episode_id"].to_numpy(), pd.concat(event_frames, ignore_index=True)
+        )
+    else:
+        empty = pd.DataFrame(columns=RESOLVED_COLUMNS)
+        linked = [empty] * len(df)
+    nodes: dict[int, EpisodeNode] = {}
+    persons: dict[int, int] = {}
+    for row, episode_events in zip(df.itertuples(index=False), linked):
+        episode_id = int(row.episode_id)
+        nodes[episode_id] = EpisodeNode(
+            episode_id,
+            None if pd.isna(row.episode_number) else int(row.episode_number),
+            int(row.episode_concept_id),
+            int(row.episode_object_concept_id),
+            row.episode_start_date,
+            None if pd.isna(row.episode_end_date) else row.episode_end_date,
+            episode_events,
+            [],
+        )
+        persons[episode_id] = int(row.person_id)
+    result: dict[int, list[EpisodeNode]] = {}
+    for episode_id, parent_id in zip(
+        df["episode_id"].tolist(), df["episode_parent_id"].tolist()
+    ):
+        parent = None if pd.isna(parent_id) else nodes.get(int(parent_id))
+        if parent is None or persons[parent.episode_id] != persons[episode_id]:
+            result.setdefault(persons[episode_id], []).append(nodes[episode_id])
+        else:
+            parent.children.append(nodes[episode_id])
+    # episodes in a cycle of parents are not reachable from a root
+    n_reachable = sum(_count(node) for roots in result.values() for node in roots)
+    if n_reachable < len(nodes):
+        logger.warning(
+            f"skipped {len(nodes) - n_reachable} episodes in cycles of parents"
+        )
+    return result
+
+
+def _count(node: EpisodeNode) -> int:
+    return 1 + sum(_count(child) for child in node.children)
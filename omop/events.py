@@ -0,0 +1,352 @@
+"""Clinical events of a person across the event registries.
+
+Several registries point at events of other registries with an untyped integer
+id: `cost_event_id` of :class:`~omop.Cost`, `measurement_event_id` of
+:class:`~omop.Measurement`, `observation_event_id` of :class:`~omop.Observation`,
+`note_event_id` of :class:`~omop.Note`, `event_id` of :class:`~omop.EpisodeEvent`
+and `fact_id_1` and `fact_id_2` of :class:`~omop.FactRelationship`. The registry
+of the event is identified by a domain or a field concept next to the id.
+:func:`resolve` looks up the events of many records with one query per event
+registry.
+
+.. autosummary::
+   :toctree: .
+
+   timeline
+   resolve
+   EventTable
+   EventPointer
+"""
+
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING, Literal, NamedTuple
+
+import pandas as pd
+
+from ._columnar import Select, as_queryset, compile_select, fetch_batches, to_frame
+from ._utils import get_registry
+from .concepts import concept_names
+from .query import fetch
+from .sharding import for_person, shards
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from django.db.models import QuerySet
+    from lamindb.models import Record
+
+TIMELINE_COLUMNS = ["registry", "event_id", "concept_id", "start_date", "end_date"]
+RESOLVED_COLUMNS = [
+    "registry",
+    "event_id",
+    "person_id",
+    "concept_id",
+    "start_date",
+    "end_date",
+]
+
+# event ids per query, below the limit of bound parameters of SQLite
+BATCH_SIZE = 10_000
+
+
+class EventTable(NamedTuple):
+    """A registry that records events of persons, and its event columns."""
+
+    registry: str
+    concept: str
+    start_date: str
+    end_date: str | None = None
+
+
+EVENT_TABLES: dict[str, EventTable] = {
+    table.registry: table
+    for table in [
+        EventTable(
+            "ConditionOccurrence",
+            "condition_concept_id",
+            "condition_start_date",
+            "condition_end_date",
+        ),
+        EventTable("Death", "cause_concept_id", "death_date"),
+        EventTable(
+            "DeviceExposure",
+            "device_concept_id",
+            "device_exposure_start_date",
+            "device_exposure_end_date",
+        ),
+        EventTable(
+            "DrugExposure",
+            "drug_concept_id",
+            "drug_exposure_start_date",
+            "drug_exposure_end_date",
+        ),
+        EventTable(
+            "Episode", "episode_concept_id", "episode_start_date", "episode_end_date"
+        ),
+        EventTable("Measurement", "measurement_concept_id", "measurement_date"),
+        EventTable("Note", "note_class_concept_id", "note_date"),
+        EventTable("Observation", "observation_concept_id", "observation_date"),
+        EventTable(
+            "ProcedureOccurrence",
+            "procedure_concept_id",
+            "procedure_date",
+            "procedure_end_date",
+        ),
+        EventTable("Specimen", "specimen_concept_id", "specimen_date"),
+        EventTable(
+            "VisitDetail",
+            "visit_detail_concept_id",
+            "visit_detail_start_date",
+            "visit_detail_end_date",
+        ),
+        EventTable(
+            "VisitOccurrence",
+            "visit_concept_id",
+            "visit_start_date",
+            "visit_end_date",
+        ),
+    ]
+}
+
+
+class EventPointer(NamedTuple):
+    """A column that points at events of several registries.
+
+    The registry of an event is identified by the `target` column, which holds a
+    `domain_id` of :class:`~omop.Domain`, the concept of a domain, or a field
+    concept of the CDM vocabulary named like `"drug_exposure.drug_exposure_id"`.
+    """
+
+    registry: str
+    event_id: str
+    target: str
+    kind: Literal["domain", "domain_concept", "field_concept"]
+
+
+EVENT_POINTERS: dict[str, list[EventPointer]] = {
+    "Cost": [EventPointer("Cost", "cost_event_id", "cost_domain", "domain")],
+    "EpisodeEvent": [
+        EventPointer(
+            "EpisodeEvent", "event_id", "episode_event_field_concept", "field_concept"
+        )
+    ],
+    "FactRelationship": [
+        EventPointer(
+            "FactRelationship", "fact_id_1", "domain_concept_id_1", "domain_concept"
+        ),
+        EventPointer(
+            "FactRelationship", "fact_id_2", "domain_concept_id_2", "domain_concept"
+        ),
+    ],
+    "Measurement": [
+        EventPointer(
+            "Measurement",
+            "measurement_event_id",
+            "meas_event_field_concept",
+            "field_concept",
+        )
+    ],
+    "Note": [
+        EventPointer(
+            "Note", "note_event_id", "note_event_field_concept", "field_concept"
+        )
+    ],
+    "Observation": [
+        EventPointer(
+            "Observation",
+            "observation_event_id",
+            "obs_event_field_concept",
+            "field_concept",
+        )
+    ],
+}
+
+# the event registries of domains
+DOMAIN_TABLES = {
+    "Condition": "ConditionOccurrence",
+    "Device": "DeviceExposure",
+    "Drug": "DrugExposure",
+    "Episode": "Episode",
+    "Measurement": "Measurement",
+    "Note": "Note",
+    "Observation": "Observation",
+    "Procedure": "ProcedureOccurrence",
+    "Specimen": "Specimen",
+    "Visit": "VisitOccurrence",
+}
+
+# the event registries by the table names of the CDM, e.g. `drug_exposure`
+CDM_TABLES = {
+    re.sub(r"(?<!^)(?=[A-Z])", "_", registry).lower(): registry
+    for registry in EVENT_TABLES
+}
+
+
+def _event_tables(registries: Iterable[str] | None = None) -> list[EventTable]:
+    if registries is None:
+        return list(EVENT_TABLES.values())
+    return [EVENT_TABLES[get_registry(registry).__name__] for registry in registries]
+
+
+def _timeline_select(table: EventTable, person_id: int) -> Select:
+    registry = get_registry(table.registry)
+    columns = [registry._meta.pk.attname, table.concept, table.start_date]
+    if table.end_date is not None:
+        columns.append(table.end_date)
+    return compile_select(for_person(registry, person_id), columns)
+
+
+def _timeline_frame(
+    tables: list[EventTable], selects: list[Select], results: list[list[tuple]]
+) -> pd.DataFrame:
+    """Combine the events of several registries into one sorted DataFrame."""
+    frames = []
+    for table, select, rows in zip(tables, selects, results):
+        if not rows:
+            continue
+        df = to_frame(rows, select)
+        df.columns = TIMELINE_COLUMNS[1 : len(df.columns) + 1]
+        df.insert(0, "registry", table.registry)
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=TIMELINE_COLUMNS)
+    df = pd.concat(frames, ignore_index=True).reindex(columns=TIMELINE_COLUMNS)
+    df["end_date"] = df["end_date"].astype("datetime64[s]")
+    return df.sort_values(["start_date", "registry", "event_id"], ignore_index=True)
+
+
+def timeline(
+    person_id: int, registries: Iterable[type | str] | None = None
+) -> pd.DataFrame:
+    """All events of a person, ordered by start date.
+
+    Runs one query per event registry, see :func:`omop.aio.atimeline` for an
+    asynchronous variant that runs them concurrently.
+
+    Args:
+        person_id: The id of the person.
+        registries: Event registries to include, defaults to all of them, e.g.
+            :class:`~omop.ConditionOccurrence` and :class:`~omop.Measurement`.
+
+    Returns:
+        A DataFrame with columns `registry`, `event_id`, `concept_id`, `start_date`
+        and `end_date`; `end_date` is missing for point events like measurements.
+
+    Examples:
+        >>> omop.events.timeline(42)
+        >>> omop.events.timeline(42, ["ConditionOccurrence", "DrugExposure"])
+    """
+    tables = _event_tables(registries)
+    selects = [_timeline_select(table, person_id) for table in tables]
+    results = [
+        [row for rows in fetch_batches(select, 10_000) for row in rows]
+        for select in selects
+    ]
+    return _timeline_frame(tables, selects, results)
+
+
+def _pointer(registry: type[Record], event_id: str | None) -> EventPointer:
+    pointers = EVENT_POINTERS.get(registry.__name__)
+    if pointers is None:
+        raise ValueError(f"{registry.__name__} has no event pointer")
+    if event_id is None:
+        return pointers[0]
+    for pointer in pointers:
+        if pointer.event_id == event_id:
+            return pointer
+    choices = ", ".join(pointer.event_id for pointer in pointers)
+    raise ValueError(f"{registry.__name__} points at events with {choices}")
+
+
+def _target_registries(pointer: EventPointer, targets: pd.Series) -> pd.Series:
+    """The event registry named by every value of the target column."""
+    if pointer.kind == "domain":
+        domain_ids = targets
+    elif pointer.kind == "domain_concept":
+        concept_ids = targets.dropna().unique().tolist()
+        domains = dict(
+            get_registry("Domain")
+            .filter(domain_concept_id__in=concept_ids)
+            .values_list("domain_concept_id", "domain_id")
+        )
+        domain_ids = targets.map(domains)
+    else:
+        names = concept_names(targets.dropna().unique().tolist())
+        tables = {
+            concept_id: CDM_TABLES.get(name.split(".")[0].lower())
+            for concept_id, name in names.items()
+        }
+        return targets.map(tables)
+    return domain_ids.map(DOMAIN_TABLES)
+
+
+def _fetch_events(table: EventTable, event_ids: list[int]) -> pd.DataFrame:
+    registry = get_registry(table.registry)
+    columns = [registry._meta.pk.attname, "person_id", table.concept, table.start_date]
+    if table.end_date is not None:
+        columns.append(table.end_date)
+    frames = [
+        fetch(
+            queryset.filter(pk__in=event_ids[start : start + BATCH_SIZE]),
+            columns,
+        )
+        for queryset in shards(registry)
+        for start in range(0, len(event_ids), BATCH_SIZE)
+    ]
+    df = pd.concat(frames, ignore_index=True)
+    df.columns = RESOLVED_COLUMNS[1 : len(df.columns) + 1]
+    df.insert(0, "registry", table.registry)
+    return df
+
+
+def resolve(
+    queryset: QuerySet | type[Record] | str,
+    event_id: str | None = None,
+    *,
+    columns: Iterable[str] = (),
+) -> pd.DataFrame:
+    """Events that records point at through a polymorphic event id.
+
+    Groups the ids by the registry of their events and fetches every group with
+    one query per 10,000 ids, instead of one query per record.
+
+    Args:
+        queryset: Records of a registry of `EVENT_POINTERS`, e.g. of
+            :class:`~omop.Cost`, or the registry to resolve all of its records.
+        event_id: The column of the ids, defaults to the first pointer of the
+            registry; `"fact_id_2"` resolves the second fact of
+            :class:`~omop.FactRelationship`.
+        columns: Further fields of the records to include, e.g. `"episode_id"`.
+
+    Returns:
+        A DataFrame with the primary key and the `columns` of every record with an
+        event id and the columns `registry`, `event_id`, `person_id`, `concept_id`, `start_date` and
+        `end_date` of its event. The columns of the event are missing if the
+        target is not an event registry, and all but `registry` and `event_id` are
+        missing if the event doesn't exist.
+
+    Examples:
+        >>> omop.events.resolve(omop.Cost.filter(cost_type_concept_id=32814))
+        >>> omop.events.resolve(omop.FactRelationship, "fact_id_2")
+    """
+    queryset = as_queryset(queryset)
+    registry = queryset.model
+    pointer = _pointer(registry, event_id)
+    keys = [registry._meta.pk.attname, *columns]
+    df = fetch(
+        queryset.filter(**{f"{pointer.event_id}__isnull": False}),
+        [*keys, pointer.event_id, pointer.target],
+    )
+    df.columns = [*keys, "event_id", "target"]
+    df.insert(len(keys), "registry", _target_registries(pointer, df.pop("target")))
+    frames = [
+        _fetch_events(EVENT_TABLES[table], group["event_id"].unique().tolist())
+        for table, group in df.groupby("registry")
+    ]
+    if not frames:
+        return df.reindex(columns=[*keys, *RESOLVED_COLUMNS])
+    events = pd.concat(frames, ignore_index=True).reindex(columns=RESOLVED_COLUMNS)
+    events["end_date"] = events["end_date"].astype("datetime64[s]")
+    return df.merge(events, how="left", on=["registry", "event_id"])
@@ -0,0 +1,268 @@
+"""Traverse the relationships between facts of :class:`~omop.FactRelationship`.
+
+:class:`~omop.FactRelationship` links facts of any registry, each identified by
+the concept of its domain and its id, e.g. a drug exposure with the condition
+that it treats. Walking these links with queries takes one query per fact and
+hop. :func:`build_graph` instead writes all relationships into compressed sparse
+rows per relationship concept, which a :class:`FactGraph` maps into memory
+read-only and traverses for many facts at once with array operations.
+
+The graph is a snapshot of the registry, rebuild it after loading relationships.
+Edges point from fact 1 to fact 2; the CDM records both directions of a
+relationship, e.g. `Has indication` and `Indication of`.
+
+.. autosummary::
+   :toctree: .
+
+   build_graph
+   FactGraph
+"""
+
+from __future__ import annotations
+
+import json
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+from django.utils import timezone
+from lamin_utils import logger
+
+from ._utils import get_registry, replace_directory, state_path
+from .query import stream
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+NEIGHBOR_COLUMNS = ["fact_id_1", "hops", "domain_concept_id_2", "fact_id_2"]
+
+RELATIONSHIP_COLUMNS = [
+    "domain_concept_id_1",
+    "fact_id_1",
+    "relationship_concept",
+    "domain_concept_id_2",
+    "fact_id_2",
+]
+
+FACT_ID_MASK = 0xFFFFFFFF
+
+
+def _keys(domain_concept_ids: np.ndarray, fact_ids: np.ndarray) -> np.ndarray:
+    """One sortable int64 per fact, the domain concept in the high 32 bits."""
+    return (np.asarray(domain_concept_ids, dtype=np.int64) << 32) | (
+        np.asarray(fact_ids, dtype=np.int64) & FACT_ID_MASK
+    )
+
+
+def _facts(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The domain concepts and fact ids of keys, inverse of :func:`_keys`."""
+    fact_ids = (keys & FACT_ID_MASK).astype(np.uint32).view(np.int32)
+    return keys >> 32, fact_ids.astype(np.int64)
+
+
+def _graph_path(path: str | Path | None) -> Path:
+    return state_path("facts") if path is None else Path(path)
+
+
+def build_graph(path: str | Path | None = None, *, batch_size: int = 1_000_000) -> Path:
+    """Write the relationships between facts into a graph for :class:`FactGraph`.
+
+    The files are written into a temporary directory that replaces an existing
+    graph when it is complete, so that processes never map a partial graph.
+
+    Args:
+        path: The directory of the graph, defaults to the cache directory of the
+            instance.
+        batch_size: Number of relationships read at a time.
+
+    Examples:
+        >>> omop.facts.build_graph()
+    """
+    path = _graph_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    columns: dict[str, list[np.ndarray]] = {c: [] for c in RELATIONSHIP_COLUMNS}
+    for df in stream(
+        get_registry("FactRelationship").filter(),
+        RELATIONSHIP_COLUMNS,
+        batch_size=batch_size,
+    ):
+        for column in RELATIONSHIP_COLUMNS:
+            columns[column].append(df[column].to_numpy(np.int64))
+    arrays = {
+        column: np.concatenate(values) if values else np.array([], dtype=np.int64)
+        for column, values in columns.items()
+    }
+    keys_1 = _keys(arrays["domain_concept_id_1"], arrays["fact_id_1"])
+    keys_2 = _keys(arrays["domain_concept_id_2"], arrays["fact_id_2"])
+    nodes = np.unique(np.concatenate([keys_1, keys_2]))
+    sources = np.searchsorted(nodes, keys_1).astype(np.int32)
+    targets = np.searchsorted(nodes, keys_2).astype(np.int32)
+    relationships = arrays["relationship_concept"]
+    order = np.lexsort((targets, sources, relationships))
+    sources, targets, relationships = (
+        sources[order],
+        targets[order],
+        relationships[order],
+    )
+    build = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}-"))
+    np.save(build / "nodes.npy", nodes)
+    # the edges of every relationship as compressed sparse rows of its sources
+    n_edges = {}
+    concept_ids, starts = np.unique(relationships, return_index=True)
+    ends = [*starts[1:].tolist(), len(relationships)]
+    for concept_id, start, end in zip(concept_ids.tolist(), starts.tolist(), ends):
+        rows, counts = np.unique(sources[start:end], return_counts=True)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        np.save(build / f"{concept_id}.rows.npy", rows)
+        np.save(build / f"{concept_id}.indptr.npy", indptr)
+        np.save(build / f"{concept_id}.targets.npy", targets[start:end])
+        n_edges[concept_id] = end - start
+    meta = {
+        "n_nodes": len(nodes),
+        "n_edges": n_edges,
+        "built_at": timezone.now().isoformat(),
+    }
+    with open(build / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+    replace_directory(build, path)
+    logger.success(
+        f"wrote {len(relationships)} relationships between {len(nodes)} facts"
+        f" into {path}"
+    )
+    return path
+
+
+class FactGraph:
+    """Relationships between facts in memory-mapped compressed sparse rows.
+
+    Facts are looked up by a binary search over their sorted keys, the neighbors
+    of a set of facts are gathered from the rows of their relationships in a few
+    array operations per relationship and hop.
+
+    Args:
+        path: The directory written by :func:`build_graph`, defaults to the cache
+            directory of the instance.
+
+    Examples:
+        >>> graph = omop.facts.FactGraph()
+        >>> graph.neighbors(13, drug_exposure_ids, hops=2)
+    """
+
+    def __init__(self, path: str | Path | None = None) -> None:
+        self.path = _graph_path(path)
+        with open(self.path / "meta.json") as f:
+            self.meta = json.load(f)
+        self.nodes: np.ndarray = np.load(self.path / "nodes.npy", mmap_mode="r")
+        self._edges = {
+            int(concept_id): tuple(
+                np.load(self.path / f"{concept_id}.{name}.npy", mmap_mode="r")
+                for name in ["rows", "indptr", "targets"]
+            )
+            for concept_id in self.meta["n_edges"]
+        }
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def relationships(self) -> list[int]:
+        """The ids of the relationship concepts in the graph."""
+        return list(self._edges)
+
+    def _expand(
+        self, origins: np.ndarray, nodes: np.ndarray, relationships: list[int]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The edges from nodes, as the origins and targets of every edge."""
+        all_origins, all_targets = [], []
+        for concept_id in relationships:
+            if concept_id not in self._edges:
+                continue
+            rows, indptr, targets = self._edges[concept_id]
+            if not len(rows):
+                continue
+            positions = np.searchsorted(rows, nodes)
+            positions[positions == len(rows)] = 0
+            found = rows[positions] == nodes
+            starts = indptr[positions[found]]
+            lengths = indptr[positions[found] + 1] - starts
+            # the positions of the targets of all found rows, row by row
+            offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+            all_targets.append(targets[np.arange(lengths.sum()) + offsets])
+            all_origins.append(np.repeat(origins[found], lengths))
+        if not all_targets:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty
+        return np.concatenate(all_origins), np.concatenate(all_targets)
+
+    def neighbors(
+        self,
+        domain_concept_id: int,
+        fact_ids: Iterable[int],
+        *,
+        hops: int = 1,
+        relationships: Iterable[int] | None = None,
+    ) -> pd.DataFrame:
+        """The facts reachable from facts of a domain within a number of hops.
+
+        Args:
+            domain_concept_id: The domain concept of the facts, e.g. `13` for drugs.
+            fact_ids: The ids of the facts.
+            hops: The maximal number of relationships to follow.
+            relationships: Only follow these relationship concepts, defaults to
+                all of them.
+
+        Returns:
+            A DataFrame with the columns `fact_id_1` of the start fact, `hops`, the
+            smallest number of hops to the reached fact, and `domain_concept_id_2`
+            and `fact_id_2` of the reached fact. Start facts are not reached.
+
+        Examples:
+            >>> graph.neighbors(13, [1, 2], relationships=[44818899])
+        """
+        relationships = (
+            self.relationships if relationships is None else list(relationships)
+        )
+        fact_ids = np.unique(np.fromiter(fact_ids, dtype=np.int64))
+        keys = _keys(np.full(len(fact_ids), domain_concept_id), fact_ids)
+        positions = np.searchsorted(self.nodes, keys)
+        if len(self.nodes):
+            positions[positions == len(self.nodes)] = 0
+            found = self.nodes[positions] == keys
+        else:
+            found = np.zeros(len(keys), dtype=bool)
+        # every path is identified by its origin and its last node
+        n_nodes = max(len(self.nodes), 1)
+        origins = np.flatnonzero(found).astype(np.int64)
+        nodes = positions[found].astype(np.int64)
+        visited = np.sort(origins * n_nodes + nodes)
+        reached = []
+        for hop in range(1, hops + 1):
+            origins, nodes = self._expand(origins, nodes, relationships)
+            paths = np.unique(origins * n_nodes + nodes)
+            paths = paths[~np.isin(paths, visited, assume_unique=True)]
+            if not len(paths):
+                break
+            visited = np.union1d(visited, paths)
+            reached.append((hop, paths))
+            origins, nodes = np.divmod(paths, n_nodes)
+        if not reached:
+            return pd.DataFrame(
+                {column: np.array([], dtype=np.int64) for column in NEIGHBOR_COLUMNS}
+            )
+        paths = np.concatenate([paths for _, paths in reached])
+        origins, nodes = np.divmod(paths, n_nodes)
+        domain_concept_ids, reached_ids = _facts(np.asarray(self.nodes)[nodes])
+        df = pd.DataFrame(
+            {
+                "fact_id_1": fact_ids[origins],
+                "hops": np.repeat(
+                    [hop for hop, _ in reached], [len(p) for _, p in reached]
+                ),
+                "domain_concept_id_2": domain_concept_ids,
+                "fact_id_2": reached_ids,
+            }
+        )
+        return df.sort_values(NEIGHBOR_COLUMNS, ignore_index=True)
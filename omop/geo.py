@@ -0,0 +1,503 @@
+"""Spatial queries over the coordinates of :class:`~omop.Location`.
+
+The `latitude` and `longitude` of locations are decimal columns without a
+spatial index, so that every radius query scans all locations. :func:`build_index`
+instead sorts the locations into a grid of cells of a fixed size in degrees,
+which a :class:`LocationIndex` maps into memory read-only. The cells of a query
+cover a few contiguous ranges of the sorted cells per grid row, found by binary
+search for many queries at once, before the exact distances of the candidates
+are computed with array operations.
+
+:func:`join` attaches the persons or care sites of the matched locations through
+their `location` foreign key, :func:`catchment` finds the persons within a
+distance of care sites.
+
+The index is a snapshot of the registry, rebuild it after loading locations.
+
+The `latitude` and `longitude` columns of the registry are decimals with as many
+decimal places as digits, like all decimal columns of the CDM here, so that
+Postgres rejects coordinates of magnitude 1 or more. Real coordinates need wider
+columns in the database.
+
+.. autosummary::
+   :toctree: .
+
+   build_index
+   LocationIndex
+   join
+   catchment
+"""
+
+from __future__ import annotations
+
+import json
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+from django.utils import timezone
+from lamin_utils import logger
+
+from ._utils import get_registry, replace_directory, state_path
+from .events import BATCH_SIZE
+from .query import fetch, stream
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from lamindb.models import Record
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+BOX_COLUMNS = ["query", "location_id"]
+RADIUS_COLUMNS = ["query", "location_id", "distance_km"]
+
+LOCATION_COLUMNS = ["location_id", "latitude", "longitude"]
+
+
+def _index_path(path: str | Path | None) -> Path:
+    return state_path("geo") if path is None else Path(path)
+
+
+def _as_array(values: float | Iterable[float]) -> np.ndarray:
+    return np.atleast_1d(np.asarray(values, dtype=np.float64))
+
+
+def _haversine(
+    latitudes_1: np.ndarray,
+    longitudes_1: np.ndarray,
+    latitudes_2: np.ndarray,
+    longitudes_2: np.ndarray,
+) -> np.ndarray:
+    """Great-circle distances in km between points in degrees."""
+    latitudes_1, longitudes_1, latitudes_2, longitudes_2 = map(
+        np.radians, (latitudes_1, longitudes_1, latitudes_2, longitudes_2)
+    )
+    a = (
+        np.sin((latitudes_2 - latitudes_1) / 2) ** 2
+        + np.cos(latitudes_1)
+        * np.cos(latitudes_2)
+        * np.sin((longitudes_2 - longitudes_1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _grid(cell_size: float) -> tuple[int, int]:
+    """The number of rows and columns of the grid."""
+    return int(np.ceil(180 / cell_size)), int(np.ceil(360 / cell_size))
+
+
+def _rows(latitudes: np.ndarray, cell_size: float) -> np.ndarray:
+    n_rows, _ = _grid(cell_size)
+    return np.clip(np.floor((latitudes + 90) / cell_size), 0, n_rows - 1).astype(
+        np.int64
+    )
+
+
+def _columns(longitudes: np.ndarray, cell_size: float) -> np.ndarray:
+    _, n_columns = _grid(cell_size)
+    return np.clip(np.floor((longitudes + 180) / cell_size), 0, n_columns - 1).astype(
+        np.int64
+    )
+
+
+def build_index(
+    path: str | Path | None = None,
+    *,
+    cell_size: float = 0.1,
+    batch_size: int = 1_000_000,
+) -> Path:
+    """Write the coordinates of locations into a grid for :class:`LocationIndex`.
+
+    Locations without coordinates or with coordinates out of range are skipped.
+    The files are written into a temporary directory that replaces an existing
+    index when it is complete, so that processes never map a partial index.
+
+    Args:
+        path: The directory of the index, defaults to the cache directory of the
+            instance.
+        cell_size: The size of the cells in degrees, about 11 km of latitude for
+            the default. Cells of about the typical query radius work best.
+        batch_size: Number of locations read at a time.
+
+    Examples:
+        >>> omop.geo.build_index()
+    """
+    if not 0 < cell_size <= 90:
+        raise ValueError(f"cell_size must be in (0, 90] degrees, got {cell_size}")
+    path = _index_path(path)
+    frames = list(
+        stream(
+            get_registry("Location").filter(),
+            LOCATION_COLUMNS,
+            batch_size=batch_size,
+        )
+    )
+    df = (
+        pd.concat(frames, ignore_index=True)
+        if frames
+        else pd.DataFrame(columns=LOCATION_COLUMNS)
+    )
+    location_ids = df["location_id"].to_numpy(np.int64)
+    latitudes = df["latitude"].to_numpy(np.float64, na_value=np.nan)
+    longitudes = df["longitude"].to_numpy(np.float64, na_value=np.nan)
+    valid = (np.abs(latitudes) <= 90) & (np.abs(longitudes) <= 180)
+    if (~valid).any():
+        logger.warning(f"skipped {(~valid).sum()} locations without valid coordinates")
+    _write_index(
+        path, location_ids[valid], latitudes[valid], longitudes[valid], cell_size
+    )
+    logger.success(f"indexed {valid.sum()} locations into {path}")
+    return path
+
+
+def _write_index(
+    path: Path,
+    location_ids: np.ndarray,
+    latitudes: np.ndarray,
+    longitudes: np.ndarray,
+    cell_size: float,
+) -> None:
+    """Sort locations into the cells of a grid and replace the index at `path`."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _, n_columns = _grid(cell_size)
+    cells = _rows(latitudes, cell_size) * n_columns + _columns(longitudes, cell_size)
+    order = np.lexsort((location_ids, cells))
+    build = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}-"))
+    np.save(build / "cells.npy", cells[order])
+    np.save(build / "location_ids.npy", location_ids[order])
+    np.save(build / "latitudes.npy", latitudes[order])
+    np.save(build / "longitudes.npy", longitudes[order])
+    meta = {
+        "cell_size": cell_size,
+        "n_locations": len(location_ids),
+        "built_at": timezone.now().isoformat(),
+    }
+    with open(build / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+    replace_directory(build, path)
+
+
+class LocationIndex:
+    """Coordinates of locations in a memory-mapped grid of cells.
+
+    Queries are answered for many boxes or circles at once, the results identify
+    every query by its position in the arguments.
+
+    Args:
+        path: The directory written by :func:`build_index`, defaults to the cache
+            directory of the instance.
+
+    Examples:
+        >>> index = omop.geo.LocationIndex()
+        >>> index.within_radius([40.7], [-74.0], 25)
+    """
+
+    def __init__(self, path: str | Path | None = None) -> None:
+        self.path = _index_path(path)
+        self._load()
+
+    def _load(self) -> None:
+        with open(self.path / "meta.json") as f:
+            self.meta = json.load(f)
+        self.cell_size: float = self.meta["cell_size"]
+        self.cells: np.ndarray = np.load(self.path / "cells.npy", mmap_mode="r")
+        self.location_ids: np.ndarray = np.load(
+            self.path / "location_ids.npy", mmap_mode="r"
+        )
+        self.latitudes: np.ndarray = np.load(self.path / "latitudes.npy", mmap_mode="r")
+        self.longitudes: np.ndarray = np.load(
+            self.path / "longitudes.npy", mmap_mode="r"
+        )
+
+    def __getstate__(self) -> dict:
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.path = state["path"]
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    def _candidates(
+        self,
+        queries: np.ndarray,
+        min_latitudes: np.ndarray,
+        min_longitudes: np.ndarray,
+        max_latitudes: np.ndarray,
+        max_longitudes: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The locations in the cells that overlap boxes, as queries and positions.
+
+        Boxes that cross the antimeridian, with `min_longitudes` larger than
+        `max_longitudes`, are split in two.
+        """
+        crossing = min_longitudes > max_longitudes
+        queries = np.concatenate([queries, queries[crossing]])
+        min_latitudes = np.concatenate([min_latitudes, min_latitudes[crossing]])
+        max_latitudes = np.concatenate([max_latitudes, max_latitudes[crossing]])
+        min_longitudes = np.concatenate(
+            [np.where(crossing, -180.0, min_longitudes), min_longitudes[crossing]]
+        )
+        max_longitudes = np.concatenate(
+            [max_longitudes, np.full(crossing.sum(), 180.0)]
+        )
+        # one range of sorted cells per grid row of every box
+        _, n_columns = _grid(self.cell_size)
+        first_rows = _rows(min_latitudes, self.cell_size)
+        n_rows = _rows(max_latitudes, self.cell_size) - first_rows + 1
+        n_rows[max_latitudes < min_latitudes] = 0
+        offsets = np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+        rows = np.repeat(first_rows, n_rows) + np.arange(n_rows.sum()) - offsets
+        starts = np.searchsorted(
+            self.cells,
+            rows * n_columns
+            + np.repeat(_columns(min_longitudes, self.cell_size), n_rows),
+            side="left",
+        )
+        ends = np.searchsorted(
+            self.cells,
+            rows * n_columns
+            + np.repeat(_columns(max_longitudes, self.cell_size), n_rows),
+            side="right",
+        )
+        lengths = ends - starts
+        # the positions of the locations of all ranges, range by range
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        positions = np.arange(lengths.sum()) + offsets
+        return np.repeat(np.repeat(queries, n_rows), lengths), positions
+
+    def within_box(
+        self,
+        min_latitudes: float | Iterable[float],
+        min_longitudes: float | Iterable[float],
+        max_latitudes: float | Iterable[float],
+        max_longitudes: float | Iterable[float],
+    ) -> pd.DataFrame:
+        """The locations within bounding boxes.
+
+        Args:
+            min_latitudes: The southern bounds of the boxes in degrees.
+            min_longitudes: The western bounds of the boxes in degrees, larger
+                than the eastern bounds for boxes across the antimeridian.
+            max_latitudes: The northern bounds of the boxes in degrees.
+            max_longitudes: The eastern bounds of the boxes in degrees.
+
+        Returns:
+            A DataFrame with the columns `query`, the position of the box in the
+            arguments, and `location_id`, sorted by both.
+
+        Examples:
+            >>> index.within_box(40.5, -74.3, 40.9, -73.7)
+        """
+        min_latitudes, min_longitudes, max_latitudes, max_longitudes = (
+            np.broadcast_arrays(
+                *map(
+                    _as_array,
+                    (min_latitudes, min_longitudes, max_latitudes, max_longitudes),
+                )
+            )
+        )
+        queries, positions = self._candidates(
+            np.arange(len(min_latitudes)),
+            min_latitudes,
+            min_longitudes,
+            max_latitudes,
+            max_longitudes,
+        )
+        latitudes = self.latitudes[positions]
+        longitudes = self.longitudes[positions]
+        west, east = min_longitudes[queries], max_longitudes[queries]
+        inside = (
+            (latitudes >= min_latitudes[queries])
+            & (latitudes <= max_latitudes[queries])
+            & np.where(
+                west <= east,
+                (longitudes >= west) & (longitudes <= east),
+                (longitudes >= west) | (longitudes <= east),
+            )
+        )
+        df = pd.DataFrame(
+            {
+                "query": queries[inside],
+                "location_id": self.location_ids[positions[inside]],
+            }
+        )
+        # the two parts of a box across the antimeridian can share a cell
+        return df.drop_duplicates().sort_values(BOX_COLUMNS, ignore_index=True)
+
+    def within_radius(
+        self,
+        latitudes: float | Iterable[float],
+        longitudes: float | Iterable[float],
+        radius_km: float | Iterable[float],
+    ) -> pd.DataFrame:
+        """The locations within a great-circle distance of points.
+
+        Args:
+            latitudes: The latitudes of the points in degrees.
+            longitudes: The longitudes of the points in degrees.
+            radius_km: The distance in km, for all points or per point.
+
+        Returns:
+            A DataFrame with the columns `query`, the position of the point in the
+            arguments, `location_id` and `distance_km`, sorted by query and
+            distance.
+
+        Examples:
+            >>> index.within_radius([40.7, 34.1], [-74.0, -118.2], 25)
+        """
+        latitudes, longitudes, radius_km = np.broadcast_arrays(
+            *map(_as_array, (latitudes, longitudes, radius_km))
+        )
+        # the bounding boxes of the circles, across all longitudes if they
+        # contain a pole
+        angles = radius_km / EARTH_RADIUS_KM
+        delta_latitudes = radius_km / KM_PER_DEGREE
+        min_latitudes = np.maximum(latitudes - delta_latitudes, -90.0)
+        max_latitudes = np.minimum(latitudes + delta_latitudes, 90.0)
+        polar = (min_latitudes <= -90) | (max_latitudes >= 90)
+        # the longitudes of the meridians tangent to the circles
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios = np.sin(angles) / np.cos(np.radians(latitudes))
+        global_ = polar | (angles >= np.pi / 2) | ~(ratios < 1)
+        delta_longitudes = np.degrees(np.arcsin(np.where(global_, 0.0, ratios)))
+        min_longitudes = np.where(global_, -180.0, longitudes - delta_longitudes)
+        max_longitudes = np.where(global_, 180.0, longitudes + delta_longitudes)
+        min_longitudes = np.where(
+            min_longitudes < -180, min_longitudes + 360, min_longitudes
+        )
+        max_longitudes = np.where(
+            max_longitudes > 180, max_longitudes - 360, max_longitudes
+        )
+        queries, positions = self._candidates(
+            np.arange(len(latitudes)),
+            min_latitudes,
+            min_longitudes,
+            max_latitudes,
+            max_longitudes,
+        )
+        distances = _haversine(
+            latitudes[queries],
+            longitudes[queries],
+            self.latitudes[positions],
+            self.longitudes[positions],
+        )
+        inside = distances <= radius_km[queries]
+        df = pd.DataFrame(
+            {
+                "query": queries[inside],
+                "location_id": self.location_ids[positions[inside]],
+                "distance_km": distances[inside],
+            }
+        )
+        df = df.drop_duplicates(["query", "location_id"])
+        return df.sort_values(
+            ["query", "distance_km", "location_id"], ignore_index=True
+        )
+
+
+def join(
+    matches: pd.DataFrame, registry: type[Record] | str = "Person"
+) -> pd.DataFrame:
+    """Attach the records that reference matched locations.
+
+    Args:
+        matches: A DataFrame with a `location_id` column, e.g. of
+            :meth:`LocationIndex.within_radius`.
+        registry: A registry with a `location` foreign key, :class:`~omop.Person`
+            or :class:`~omop.CareSite`.
+
+    Returns:
+        The matches with a row per record of a location and the primary key of
+        the record, e.g. `person_id`, as the last column. Matches without
+        records are dropped.
+
+    Examples:
+        >>> matches = index.within_radius([40.7], [-74.0], 25)
+        >>> omop.geo.join(matches, "CareSite")
+    """
+    registry = get_registry(registry)
+    if not any(field.name == "location" for field in registry._meta.fields):
+        raise ValueError(f"{registry.__name__} has no location foreign key")
+    pk = registry._meta.pk.attname
+    location_ids = matches["location_id"].drop_duplicates().tolist()
+    frames = [
+        fetch(
+            registry.filter(location_id__in=location_ids[start : start + BATCH_SIZE]),
+            [pk, "location_id"],
+        )
+        for start in range(0, len(location_ids), BATCH_SIZE)
+    ]
+    records = (
+        pd.concat(frames, ignore_index=True)
+        if frames
+        else pd.DataFrame({pk: [], "location_id": []}, dtype=np.int64)
+    )
+    records.columns = [pk, "location_id"]
+    # keep the order of the matches, and the records of a match by primary key
+    rows = pd.DataFrame(
+        {
+            "row": np.arange(len(matches)),
+            "location_id": matches["location_id"].to_numpy(),
+        }
+    )
+    rows = rows.merge(records, on="location_id")
+    rows = rows.sort_values(["row", pk], ignore_index=True)
+    df = matches.iloc[rows["row"].to_numpy()].reset_index(drop=True)
+    df[pk] = rows[pk].to_numpy()
+    return df
+
+
+def catchment(
+    care_site_ids: Iterable[int],
+    radius_km: float,
+    *,
+    index: LocationIndex | None = None,
+) -> pd.DataFrame:
+    """The persons that live within a distance of care sites.
+
+    Args:
+        care_site_ids: The ids of the care sites.
+        radius_km: The distance in km from the location of a care site.
+        index: The index of the locations, defaults to the index in the cache
+            directory of the instance.
+
+    Returns:
+        A DataFrame with the columns `care_site_id`, `location_id` and
+        `distance_km` of the location of the person, and `person_id`, sorted by
+        care site and distance. Care sites without coordinates match no persons.
+
+    Examples:
+        >>> omop.geo.catchment([1, 2], 50)
+    """
+    index = LocationIndex() if index is None else index
+    care_site_ids = sorted({int(care_site_id) for care_site_id in care_site_ids})
+    frames = [
+        fetch(
+            get_registry("CareSite").filter(
+                care_site_id__in=care_site_ids[start : start + BATCH_SIZE],
+                location__latitude__isnull=False,
+                location__longitude__isnull=False,
+            ),
+            ["care_site_id", "location__latitude", "location__longitude"],
+        )
+        for start in range(0, len(care_site_ids), BATCH_SIZE)
+    ]
+    columns = ["care_site_id", "location_id", "distance_km", "person_id"]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    sites = pd.concat(frames, ignore_index=True)
+    sites.columns = ["care_site_id", "latitude", "longitude"]
+    matches = index.within_radius(sites["latitude"], sites["longitude"], radius_km)
+    matches.insert(
+        0, "care_site_id", sites["care_site_id"].to_numpy()[matches["query"].to_numpy()]
+    )
+    df = join(matches.drop(columns="query"), "Person")
+    return df.sort_values(
+        ["care_site_id", "distance_km", "person_id"], ignore_index=True
+    )[columns]
@@ -0,0 +1,160 @@
+"""Referential integrity of the omop registries.
+
+All foreign keys in the OMOP schema are declared with `DO_NOTHING`, hence deleting
+a referenced record or bulk-loading with disabled constraints can leave orphaned
+references behind. :func:`scan` finds them with anti-joins.
+
+.. autosummary::
+   :toctree: .
+
+   foreign_keys
+   scan
+   ForeignKeyRef
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import TYPE_CHECKING, NamedTuple
+
+import pandas as pd
+from django.db import connections
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from lamin_utils import logger
+
+from ._utils import get_registry, omop_registries, read_state, unfiltered, write_state
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from lamindb.models import Record
+
+STATE_FILE = "integrity.json"
+
+
+class ForeignKeyRef(NamedTuple):
+    """A foreign key between two omop registries."""
+
+    registry: type[Record]
+    field: str
+    column: str
+    target: type[Record]
+
+    @property
+    def key(self) -> str:
+        return f"{self.registry.__name__}.{self.field}"
+
+
+def foreign_keys(
+    registries: Iterable[type[Record] | str] | None = None,
+) -> list[ForeignKeyRef]:
+    """Foreign keys between omop registries.
+
+    Foreign keys to lamindb registries (`created_by`, `run`, `space`) are excluded.
+
+    Args:
+        registries: Registries to inspect, defaults to all omop registries.
+
+    Examples:
+        >>> omop.integrity.foreign_keys(["Measurement"])
+    """
+    if registries is None:
+        registries = omop_registries()
+    refs = []
+    for registry in map(get_registry, registries):
+        for field in registry._meta.concrete_fields:
+            if not field.many_to_one:
+                continue
+            target = field.related_model
+            if target._meta.app_label != "omop":
+                continue
+            refs.append(ForeignKeyRef(registry, field.name, field.attname, target))
+    return refs
+
+
+def _scan_one(ref: ForeignKeyRef, since: datetime | None, n_samples: int) -> dict:
+    try:
+        queryset = unfiltered(ref.registry).filter(**{f"{ref.column}__isnull": False})
+        if since is not None:
+            queryset = queryset.filter(updated_at__gt=since)
+        targets = unfiltered(ref.target).filter(pk=OuterRef(ref.column))
+        orphans = queryset.filter(~Exists(targets))
+        n_orphans = orphans.count()
+        samples = []
+        if n_orphans > 0:
+            pk_name = ref.registry._meta.pk.attname
+            samples = list(
+                orphans.order_by(pk_name).values_list(pk_name, ref.column)[:n_samples]
+            )
+        return {
+            "registry": ref.registry.__name__,
+            "field": ref.field,
+            "target": ref.target.__name__,
+            "n_orphans": n_orphans,
+            "samples": samples,
+            "since": since,
+        }
+    finally:
+        # every worker thread opens its own connection
+        connections.close_all()
+
+
+def scan(
+    registries: Iterable[type[Record] | str] | None = None,
+    *,
+    incremental: bool = False,
+    since: datetime | None = None,
+    n_samples: int = 10,
+    max_workers: int = 4,
+) -> pd.DataFrame:
+    """Scan foreign keys for orphaned references.
+
+    Every foreign key is checked with an anti-join (`NOT EXISTS`) against its target
+    registry. Checks run concurrently, one database connection per worker.
+
+    In incremental mode, only records with an `updated_at` newer than the last
+    successful scan of the same foreign key are checked. Note that an incremental scan
+    does not detect orphans that arise from deleting a target record after its
+    referencing records were scanned; run a full scan for that.
+
+    Args:
+        registries: Registries whose foreign keys to scan, defaults to all.
+        incremental: Whether to only check records updated since the last scan.
+        since: Only check records updated after this time, overrides `incremental`.
+        n_samples: Number of `(primary key, dangling value)` samples per foreign key.
+        max_workers: Number of concurrent workers.
+
+    Returns:
+        A DataFrame with one row per foreign key and columns `registry`, `field`,
+        `target`, `n_orphans`, `samples` and `since`.
+
+    Examples:
+        >>> omop.integrity.scan(["Measurement", "ConditionOccurrence"])
+        >>> omop.integrity.scan(incremental=True)
+    """
+    refs = foreign_keys(registries)
+    state = read_state(STATE_FILE) if incremental else {}
+    scanned_at = timezone.now()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for ref in refs:
+            ref_since = since
+            if ref_since is None and incremental and ref.key in state:
+                ref_since = datetime.fromisoformat(state[ref.key])
+            futures.append(executor.submit(_scan_one, ref, ref_since, n_samples))
+        results = [future.result() for future in futures]
+    if incremental:
+        state.update({ref.key: scanned_at.isoformat() for ref in refs})
+        write_state(STATE_FILE, state)
+    df = pd.DataFrame(
+        results,
+        columns=["registry", "field", "target", "n_orphans", "samples", "since"],
+    )
+    for row in df.itertuples():
+        if row.n_orphans > 0:
+            logger.warning(
+                f"{row.n_orphans} orphaned references in {row.registry}.{row.field} to {row.target}"
+            )
+    return df
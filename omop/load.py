@@ -0,0 +1,434 @@
+"""Bulk loading into the omop registries.
+
+.. autosummary::
+   :toctree: .
+
+   merge
+   load_csv
+   MergeResult
+"""
+
+from __future__ import annotations
+
+import io
+import os
+from concurrent.futures import as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+import pandas as pd
+from django.db import connections, transaction
+from django.utils import timezone
+from lamin_utils import logger
+
+from ._columnar import BOOKKEEPING_FIELDS, to_db_values, value_kind
+from ._utils import get_registry, primary_key_columns, process_pool, unfiltered
+from .concepts import _names as _concept_names
+from .models import LoadCheckpoint
+from .partitioning import DATE_COLUMNS, create_partitions
+from .sharding import _split_frame
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+    from django.db.models import Field
+    from lamindb.models import Record
+
+# bookkeeping fields whose defaults are computed in Python rather than the database
+PYTHON_DEFAULT_FIELDS = ("created_by", "run")
+CHUNK_BYTES = 64 * 2**20
+
+
+class MergeResult(NamedTuple):
+    """Numbers of records affected by :func:`merge`."""
+
+    n_inserted: int
+    n_updated: int
+    n_unchanged: int
+
+
+def _chunks(
+    data: pd.DataFrame | Iterable[pd.DataFrame], batch_size: int
+) -> Iterator[pd.DataFrame]:
+    frames = [data] if isinstance(data, pd.DataFrame) else data
+    for df in frames:
+        for start in range(0, len(df), batch_size):
+            yield df.iloc[start : start + batch_size]
+
+
+def _resolve_columns(registry: type[Record], columns: Iterable[str]) -> list[Field]:
+    fields = []
+    for column in columns:
+        field = registry._meta.get_field(column)
+        if field.name in BOOKKEEPING_FIELDS or not field.concrete:
+            raise ValueError(f"cannot load column '{column}' of {registry.__name__}")
+        fields.append(field)
+    pk = registry._meta.pk
+    if pk not in fields:
+        raise ValueError(f"data needs the primary key column '{pk.attname}'")
+    return fields
+
+
+def _column_of(df: pd.DataFrame, fields: list[Field], name: str) -> str | None:
+    names = [field.name for field in fields]
+    return df.columns[names.index(name)] if name in names else None
+
+
+@contextmanager
+def _write_transaction(db: str) -> Iterator[None]:
+    connection = connections[db]
+    if connection.vendor != "sqlite":
+        with transaction.atomic(using=db):
+            yield
+        return
+    # take the write lock upfront: a deferred SQLite transaction that has read
+    # can't acquire it while another process writes and fails immediately
+    connection.ensure_connection()
+    transaction_mode = connection.transaction_mode
+    connection.transaction_mode = "IMMEDIATE"
+    try:
+        with transaction.atomic(using=db):
+            connection.transaction_mode = transaction_mode
+            yield
+    finally:
+        connection.transaction_mode = transaction_mode
+
+
+def _forget_concept_names(registry: type[Record]) -> None:
+    # bulk writes send no post_save, which invalidates single names
+    if registry._meta.app_label == "omop" and registry.__name__ == "Concept":
+        _concept_names.clear()
+
+
+def _merge_chunk(
+    registry: type[Record], df: pd.DataFrame, fields: list[Field], db: str
+) -> MergeResult:
+    connection = connections[db]
+    qn = connection.ops.quote_name
+    table = qn(registry._meta.db_table)
+    stage = qn(f"{registry._meta.db_table}_stage")
+    pk = qn(registry._meta.pk.column)
+    key = ", ".join(map(qn, primary_key_columns(registry, db)))
+    columns = [qn(field.column) for field in fields]
+    data_columns = [column for column in columns if column != pk]
+    defaults = {}
+    for name in PYTHON_DEFAULT_FIELDS:
+        field = registry._meta.get_field(name)
+        defaults[qn(field.column)] = field.get_default()
+    insert_columns = columns + list(defaults)
+    rows = list(
+        zip(
+            *(
+                to_db_values(df[name], field, connection)
+                for name, field in zip(df.columns, fields)
+            )
+        )
+    )
+    if data_columns:
+        distinct = "IS DISTINCT FROM" if connection.vendor == "postgresql" else "IS NOT"
+        changed = " OR ".join(
+            f"{table}.{column} {distinct} excluded.{column}" for column in data_columns
+        )
+        # `excluded.updated_at` holds the database default, the current time
+        assignments = ", ".join(
+            f"{column} = excluded.{column}"
+            for column in [*data_columns, qn("updated_at")]
+        )
+        on_conflict = f"UPDATE SET {assignments} WHERE {changed}"
+    else:
+        on_conflict = "NOTHING"
+    # the temporary table is dropped on rollback, too
+    with _write_transaction(db), connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {stage} AS"
+            f" SELECT {', '.join(columns)} FROM {table} WHERE 1 = 0"
+        )
+        cursor.executemany(
+            f"INSERT INTO {stage} ({', '.join(columns)})"
+            f" VALUES ({', '.join(['%s'] * len(columns))})",
+            rows,
+        )
+        cursor.execute(
+            f"SELECT COUNT(*) FROM {stage} JOIN {table} ON {table}.{pk} = {stage}.{pk}"
+        )
+        n_existing = cursor.fetchone()[0]
+        # `WHERE true` disambiguates the upsert clause from a join in SQLite
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(insert_columns)})"
+            f" SELECT {', '.join(columns + ['%s'] * len(defaults))} FROM {stage} WHERE true"
+            f" ON CONFLICT ({key}) DO {on_conflict}",
+            list(defaults.values()),
+        )
+        n_affected = cursor.rowcount
+        cursor.execute(f"DROP TABLE {stage}")
+    n_inserted = len(rows) - n_existing
+    n_updated = n_affected - n_inserted
+    _forget_concept_names(registry)
+    return MergeResult(n_inserted, n_updated, n_existing - n_updated)
+
+
+def _merge_frames(
+    registry: type[Record],
+    data: pd.DataFrame | Iterable[pd.DataFrame],
+    batch_size: int,
+) -> MergeResult:
+    pk = registry._meta.pk
+    counts = [0, 0, 0]
+    for df in _chunks(data, batch_size):
+        fields = _resolve_columns(registry, df.columns)
+        df = df.drop_duplicates(_column_of(df, fields, pk.name), keep="last")
+        date_column = _column_of(df, fields, DATE_COLUMNS.get(registry.__name__))
+        if date_column is not None:
+            create_partitions(
+                registry, pd.to_datetime(df[date_column]).dt.year.unique()
+            )
+        for db, part in _split_frame(registry, df, _column_of(df, fields, "person")):
+            chunk_result = _merge_chunk(registry, part, fields, db)
+            counts = [a + b for a, b in zip(counts, chunk_result)]
+    return MergeResult(*counts)
+
+
+def merge(
+    registry: type[Record] | str,
+    data: pd.DataFrame | Iterable[pd.DataFrame],
+    *,
+    batch_size: int = 10_000,
+) -> MergeResult:
+    """Insert new and update changed records from a delta.
+
+    Each chunk of `batch_size` rows is staged in a temporary table and merged into
+    the registry with a single `INSERT ... ON CONFLICT DO UPDATE` statement keyed by
+    the primary key, within one transaction per chunk. Existing records are only
+    updated, and their `updated_at` only refreshed, if at least one of the given
+    columns differs; columns absent from `data` are left untouched.
+
+    If a primary key occurs more than once in a chunk, the last occurrence wins.
+
+    Args:
+        registry: The registry to merge into.
+        data: Records with field names or column names like `person_id` as
+            columns, including the primary key. Pass an iterable of DataFrames, e.g.
+            from `pd.read_csv(..., chunksize=...)`, to merge a large delta.
+        batch_size: Number of rows per staged chunk.
+
+    Examples:
+        >>> omop.load.merge(omop.Measurement, pd.read_csv("measurement_delta.csv"))
+        >>> omop.load.merge("VisitOccurrence", pd.read_csv(path, chunksize=100_000))
+    """
+    registry = get_registry(registry)
+    result = _merge_frames(registry, data, batch_size)
+    logger.info(
+        f"merged into {registry.__name__}: {result.n_inserted} inserted,"
+        f" {result.n_updated} updated, {result.n_unchanged} unchanged"
+    )
+    return result
+
+
+def _byte_ranges(
+    path: Path, chunk_bytes: int, offset: int = 0
+) -> list[tuple[int, int]]:
+    """Split a file into byte ranges that end at line boundaries.
+
+    The ranges start after the header, or at `offset` if it is larger, which must
+    be the start of a line.
+    """
+    size = path.stat().st_size
+    ranges = []
+    with open(path, "rb") as f:
+        f.readline()
+        start = max(f.tell(), offset)
+        while start < size:
+            end = start + chunk_bytes
+            if end < size:
+                # move to the start of the line that contains or follows `end`
+                f.seek(end - 1)
+                f.readline()
+                end = f.tell()
+            ranges.append((start, min(end, size)))
+            start = end
+    return ranges
+
+
+def _read_range(
+    registry: type[Record],
+    path: Path,
+    byte_range: tuple[int, int],
+    columns: list[str],
+    sep: str,
+    date_format: str | None,
+) -> pd.DataFrame:
+    """Parse a byte range and coerce its columns to the types of their fields."""
+    fields = _resolve_columns(registry, columns)
+    dtypes = {}
+    for column, field in zip(columns, fields):
+        kind = value_kind(field)
+        dtypes[column] = {"int": "Int64", "float": "float64"}.get(kind, "str")
+    start, end = byte_range
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    try:
+        df = pd.read_csv(
+            io.BytesIO(data),
+            sep=sep,
+            header=None,
+            names=columns,
+            dtype=dtypes,
+            keep_default_na=False,
+            na_values=[""],
+        )
+        for column, field in zip(columns, fields):
+            if value_kind(field) in {"date", "datetime"}:
+                df[column] = pd.to_datetime(df[column], format=date_format)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"cannot parse bytes {start}-{end} of {path}: {e}") from e
+    return df
+
+
+def _load_range(
+    registry_name: str,
+    path: Path,
+    byte_range: tuple[int, int],
+    columns: list[str],
+    sep: str,
+    date_format: str | None,
+    batch_size: int,
+) -> tuple[MergeResult, int | None]:
+    """Load a byte range of a file, runs in a worker process.
+
+    Returns the merge counts and the primary key of the last record in the range.
+    """
+    registry = get_registry(registry_name)
+    df = _read_range(registry, path, byte_range, columns, sep, date_format)
+    connection = connections["default"]
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            # SQLite serializes writers, wait for the other workers
+            cursor.execute("PRAGMA busy_timeout = 600000")
+    result = _merge_frames(registry, df, batch_size)
+    fields = _resolve_columns(registry, columns)
+    pk_column = _column_of(df, fields, registry._meta.pk.name)
+    return result, None if df.empty else int(df[pk_column].iloc[-1])
+
+
+def load_csv(
+    registry: type[Record] | str,
+    path: str | Path,
+    *,
+    sep: str = ",",
+    date_format: str | None = None,
+    n_workers: int | None = None,
+    chunk_bytes: int = CHUNK_BYTES,
+    batch_size: int = 10_000,
+    resume: bool = True,
+) -> MergeResult:
+    r"""Load a CSV file with a pool of worker processes.
+
+    The file is split into byte ranges of about `chunk_bytes` that end at line
+    boundaries. Every worker parses a range, coerces its columns to the types of
+    the registry fields and merges the records over its own database connection as
+    in :func:`merge`, which makes loading a range twice harmless.
+
+    Workers commit their ranges in the order they finish, not in the order of the
+    file. Only the checkpoint advances in file order: it is kept in
+    :class:`~omop.LoadCheckpoint` as the end of the contiguous prefix of loaded
+    ranges and the primary key of its last record. After a failure or interruption,
+    calling `load_csv` again resumes after the checkpoint as long as the file didn't
+    change. Ranges beyond the checkpoint that were committed before the failure are
+    merged again, which relies on :func:`merge` being idempotent and creates no
+    duplicates.
+
+    Records must not contain line breaks within quoted values.
+
+    Args:
+        registry: The registry to load into.
+        path: A CSV file with a header of field or column names like `person_id`,
+            in any case.
+        sep: The delimiter, e.g. `"\t"` for the vocabulary files from Athena.
+        date_format: The format of dates, e.g. `"%Y%m%d"`, inferred by default.
+        n_workers: Number of worker processes, defaults to the number of CPUs.
+            Workers are forked where the platform supports it, and connect to
+            the current instance otherwise, e.g. on Windows.
+        chunk_bytes: Approximate size of a byte range.
+        batch_size: Number of rows per staged chunk within a range.
+        resume: Whether to resume at the checkpoint of a previous load.
+
+    Examples:
+        >>> omop.load.load_csv(omop.Measurement, "measurement.csv", n_workers=8)
+        >>> omop.load.load_csv("Concept", "CONCEPT.csv", sep="\t", date_format="%Y%m%d")
+    """
+    registry = get_registry(registry)
+    path = Path(path).resolve()
+    columns = [column.lower() for column in pd.read_csv(path, sep=sep, nrows=0)]
+    # fail early on unknown columns
+    _resolve_columns(registry, columns)
+    stat = path.stat()
+    checkpoint, _ = unfiltered(LoadCheckpoint).get_or_create(
+        registry=registry.__name__,
+        path=str(path),
+        defaults={
+            "file_size": stat.st_size,
+            "file_mtime": stat.st_mtime,
+            "byte_offset": 0,
+        },
+    )
+    unchanged = (checkpoint.file_size, checkpoint.file_mtime) == (
+        stat.st_size,
+        stat.st_mtime,
+    )
+    if resume and unchanged and checkpoint.byte_offset > 0:
+        logger.info(
+            f"resuming {path.name} at byte {checkpoint.byte_offset} of {stat.st_size}"
+            f" after {registry._meta.pk.attname} {checkpoint.last_pk}"
+        )
+    else:
+        checkpoint.file_size, checkpoint.file_mtime = stat.st_size, stat.st_mtime
+        checkpoint.byte_offset, checkpoint.last_pk = 0, None
+    # the ranges of a resumed load start at the checkpoint, which is a line
+    # boundary regardless of the `chunk_bytes` of the previous load
+    ranges = _byte_ranges(path, chunk_bytes, checkpoint.byte_offset)
+    offset = ranges[0][0] if ranges else checkpoint.byte_offset
+    # worker processes must not inherit open connections
+    connections.close_all()
+    counts = [0, 0, 0]
+    loaded: dict[int, tuple[int, int | None]] = {}
+    with process_pool(n_workers or os.cpu_count()) as executor:
+        futures = {
+            executor.submit(
+                _load_range,
+                registry.__name__,
+                path,
+                byte_range,
+                columns,
+                sep,
+                date_format,
+                batch_size,
+            ): byte_range
+            for byte_range in ranges
+        }
+        try:
+            for future in as_completed(futures):
+                range_result, last_pk = future.result()
+                counts = [a + b for a, b in zip(counts, range_result)]
+                start, end = futures[future]
+                loaded[start] = (end, last_pk)
+                if offset not in loaded:
+                    continue
+                while offset in loaded:
+                    offset, pk = loaded.pop(offset)
+                    checkpoint.last_pk = checkpoint.last_pk if pk is None else pk
+                checkpoint.byte_offset = offset
+                checkpoint.updated_at = timezone.now()
+                checkpoint.save()
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    # the workers wrote the concepts
+    _forget_concept_names(registry)
+    result = MergeResult(*counts)
+    logger.info(
+        f"loaded {path.name} into {registry.__name__}: {result.n_inserted} inserted,"
+        f" {result.n_updated} updated, {result.n_unchanged} unchanged"
+    )
+    return result
@@ -0,0 +1,217 @@
+# Generated by Django 5.1.15 on 2026-10-19 02:08
+
+import django.db.models.deletion
+import django.db.models.functions.datetime
+import lamindb.base.fields
+import lamindb.base.users
+import lamindb.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("lamindb", "0081_revert_textfield_collection"),
+        ("omop", "0003_remove_caresite__previous_runs_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AchillesAnalysis",
+            fields=[
+                (
+                    "created_at",
+                    lamindb.base.fields.DateTimeField(
+                        blank=True,
+                        db_default=django.db.models.functions.datetime.Now(),
+                        db_index=True,
+                        editable=False,
+                    ),
+                ),
+                (
+                    "updated_at",
+                    lamindb.base.fields.DateTimeField(
+                        blank=True,
+                        db_default=django.db.models.functions.datetime.Now(),
+                        db_index=True,
+                        editable=False,
+                    ),
+                ),
+                (
+                    "_branch_code",
+                    models.SmallIntegerField(db_default=1, db_index=True, default=1),
+                ),
+                (
+                    "_aux",
+                    lamindb.base.fields.JSONField(
+                        blank=True, db_default=None, default=None, null=True
+                    ),
+                ),
+                (
+                    "analysis_id",
+                    lamindb.base.fields.IntegerField(
+                        blank=True, primary_key=True, serialize=False
+                    ),
+                ),
+                (
+                    "analysis_name",
+                    lamindb.base.fields.CharField(
+                        blank=True, default=None, max_length=255
+                    ),
+                ),
+                (
+                    "source_state",
+                    lamindb.base.fields.JSONField(blank=True, default=None, null=True),
+                ),
+                (
+                    "created_by",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        default=lamindb.base.users.current_user_id,
+                        editable=False,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="lamindb.user",
+                    ),
+                ),
+                (
+                    "run",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        default=lamindb.models.current_run,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="lamindb.run",
+                    ),
+                ),
+                (
+                    "space",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        db_default=1,
+                        default=1,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="lamindb.space",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+            bases=(lamindb.models.CanCurate, models.Model),
+        ),
+        migrations.CreateModel(
+            name="AchillesResult",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    lamindb.base.fields.DateTimeField(
+                        blank=True,
+                        db_default=django.db.models.functions.datetime.Now(),
+                        db_index=True,
+                        editable=False,
+                    ),
+                ),
+                (
+                    "updated_at",
+                    lamindb.base.fields.DateTimeField(
+                        blank=True,
+                        db_default=django.db.models.functions.datetime.Now(),
+                        db_index=True,
+                        editable=False,
+                    ),
+                ),
+                (
+                    "_branch_code",
+                    models.SmallIntegerField(db_default=1, db_index=True, default=1),
+                ),
+                (
+                    "_aux",
+                    lamindb.base.fields.JSONField(
+                        blank=True, db_default=None, default=None, null=True
+                    ),
+                ),
+                (
+                    "stratum_1",
+                    lamindb.base.fields.CharField(
+                        blank=True, default=None, max_length=255, null=True
+                    ),
+                ),
+                (
+                    "stratum_2",
+                    lamindb.base.fields.CharField(
+                        blank=True, default=None, max_length=255, null=True
+                    ),
+                ),
+                (
+                    "stratum_3",
+                    lamindb.base.fields.CharField(
+                        blank=True, default=None, max_length=255, null=True
+                    ),
+                ),
+                (
+                    "stratum_4",
+                    lamindb.base.fields.CharField(
+                        blank=True, default=None, max_length=255, null=True
+                    ),
+                ),
+                (
+                    "count_value",
+                    lamindb.base.fields.BigIntegerField(blank=True, default=None),
+                ),
+                (
+                    "analysis",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        to="omop.achillesanalysis",
+                    ),
+                ),
+                (
+                    "created_by",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        default=lamindb.base.users.current_user_id,
+                        editable=False,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="lamindb.user",
+                    ),
+                ),
+                (
+                    "run",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        default=lamindb.models.current_run,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="lamindb.run",
+                    ),
+                ),
+                (
+                    "space",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        db_default=1,
+                        default=1,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="lamindb.space",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+            bases=(lamindb.models.CanCurate, models.Model),
+        ),
+    ]
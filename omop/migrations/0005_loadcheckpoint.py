@@ -0,0 +1,118 @@
+# Generated by Django 5.1.15 on 2026-10-19 02:35
+
+import django.db.models.deletion
+import django.db.models.functions.datetime
+import lamindb.base.fields
+import lamindb.base.users
+import lamindb.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("lamindb", "0081_revert_textfield_collection"),
+        ("omop", "0004_achillesanalysis_achillesresult"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LoadCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    lamindb.base.fields.DateTimeField(
+                        blank=True,
+                        db_default=django.db.models.functions.datetime.Now(),
+                        db_index=True,
+                        editable=False,
+                    ),
+                ),
+                (
+                    "updated_at",
+                    lamindb.base.fields.DateTimeField(
+                        blank=True,
+                        db_default=django.db.models.functions.datetime.Now(),
+                        db_index=True,
+                        editable=False,
+                    ),
+                ),
+                (
+                    "_branch_code",
+                    models.SmallIntegerField(db_default=1, db_index=True, default=1),
+                ),
+                (
+                    "_aux",
+                    lamindb.base.fields.JSONField(
+                        blank=True, db_default=None, default=None, null=True
+                    ),
+                ),
+                (
+                    "registry",
+                    lamindb.base.fields.CharField(
+                        blank=True, db_index=True, default=None, max_length=255
+                    ),
+                ),
+                ("path", lamindb.base.fields.TextField(blank=True, default=None)),
+                (
+                    "file_size",
+                    lamindb.base.fields.BigIntegerField(blank=True, default=None),
+                ),
+                ("file_mtime", lamindb.base.fields.FloatField(blank=True)),
+                (
+                    "byte_offset",
+                    lamindb.base.fields.BigIntegerField(blank=True, default=None),
+                ),
+                (
+                    "last_pk",
+                    lamindb.base.fields.BigIntegerField(
+                        blank=True, default=None, null=True
+                    ),
+                ),
+                (
+                    "created_by",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        default=lamindb.base.users.current_user_id,
+                        editable=False,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="lamindb.user",
+                    ),
+                ),
+                (
+                    "run",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        default=lamindb.models.current_run,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="lamindb.run",
+                    ),
+                ),
+                (
+                    "space",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        db_default=1,
+                        default=1,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="lamindb.space",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+            bases=(lamindb.models.CanCurate, models.Model),
+        ),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 5.1.15 on 2026-10-19 03:30
+
+import django.db.models.deletion
+import django.db.models.functions.datetime
+import lamindb.base.fields
+import lamindb.base.users
+import lamindb.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("lamindb", "0081_revert_textfield_collection"),
+        ("omop", "0005_loadcheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="NoteBlob",
+            fields=[
+                (
+                    "created_at",
+                    lamindb.base.fields.DateTimeField(
+                        blank=True,
+                        db_default=django.db.models.functions.datetime.Now(),
+                        db_index=True,
+                        editable=False,
+                    ),
+                ),
+                (
+                    "updated_at",
+                    lamindb.base.fields.DateTimeField(
+                        blank=True,
+                        db_default=django.db.models.functions.datetime.Now(),
+                        db_index=True,
+                        editable=False,
+                    ),
+                ),
+                (
+                    "_branch_code",
+                    models.SmallIntegerField(db_default=1, db_index=True, default=1),
+                ),
+                (
+                    "_aux",
+                    lamindb.base.fields.JSONField(
+                        blank=True, db_default=None, default=None, null=True
+                    ),
+                ),
+                (
+                    "note_id",
+                    lamindb.base.fields.IntegerField(
+                        blank=True, primary_key=True, serialize=False
+                    ),
+                ),
+                (
+                    "codec",
+                    lamindb.base.fields.CharField(
+                        blank=True, default=None, max_length=20
+                    ),
+                ),
+                ("size", lamindb.base.fields.BigIntegerField(blank=True, default=None)),
+                ("data", lamindb.base.fields.BinaryField(blank=True)),
+                (
+                    "created_by",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        default=lamindb.base.users.current_user_id,
+                        editable=False,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="lamindb.user",
+                    ),
+                ),
+                (
+                    "run",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        default=lamindb.models.current_run,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="lamindb.run",
+                    ),
+                ),
+                (
+                    "space",
+                    lamindb.base.fields.ForeignKey(
+                        blank=True,
+                        db_default=1,
+                        default=1,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="lamindb.space",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+            bases=(lamindb.models.CanCurate, models.Model),
+        ),
+    ]
@@ -5,17 +5,53 @@ from decimal import Decimal  # noqa
 
 from django.db import models
 from lamindb.base.fields import (
+    BigIntegerField,
+    BinaryField,
     CharField,
     DateField,
     DateTimeField,
     DecimalField,
+    FloatField,
     ForeignKey,
     IntegerField,
+    JSONField,
     TextField,
 )
 from lamindb.models import CanCurate, Record, TracksRun, TracksUpdates
 
 
+class AchillesAnalysis(Record, CanCurate, TracksRun, TracksUpdates):
+    """Database characterization analyses and the state of their source registries when they were last computed.
+
+    Results are stored in the ACHILLES_RESULT table and computed by :mod:`omop.characterization`.
+    """
+
+    class Meta(Record.Meta, TracksRun.Meta, TracksUpdates.Meta):
+        abstract = False
+
+    analysis_id: int = IntegerField(primary_key=True)
+    analysis_name: str = CharField(max_length=255)
+    source_state: dict | None = JSONField(default=None, null=True)
+
+
+class AchillesResult(Record, CanCurate, TracksRun, TracksUpdates):
+    """Aggregate counts of a database characterization analysis, stratified by up to four values.
+
+    Modeled after the results table of OHDSI Achilles.
+    The meaning of the strata is defined by the analysis, e.g. `stratum_1` holds the `gender_concept_id` for the counts of persons by gender.
+    """
+
+    class Meta(Record.Meta, TracksRun.Meta, TracksUpdates.Meta):
+        abstract = False
+
+    analysis: AchillesAnalysis = ForeignKey(AchillesAnalysis, models.DO_NOTHING)
+    stratum_1: str | None = CharField(max_length=255, null=True)
+    stratum_2: str | None = CharField(max_length=255, null=True)
+    stratum_3: str | None = CharField(max_length=255, null=True)
+    stratum_4: str | None = CharField(max_length=255, null=True)
+    count_value: int = BigIntegerField()
+
+
 class CareSite(Record, CanCurate, TracksRun, TracksUpdates):
     """Uniquely identified healthcare delivery unit or an organizational unit, where healthcare services are provided."""
 
@@ -648,6 +684,24 @@ class FactRelationship(Record, CanCurate, TracksRun, TracksUpdates):
     )
 
 
+class LoadCheckpoint(Record, CanCurate, TracksRun, TracksUpdates):
+    """Progress of a bulk load of a file into a registry, maintained by :mod:`omop.load`.
+
+    A restarted load resumes after `byte_offset` if the file still has the same `file_size` and `file_mtime`.
+    `last_pk` is the primary key of the last record before `byte_offset`.
+    """
+
+    class Meta(Record.Meta, TracksRun.Meta, TracksUpdates.Meta):
+        abstract = False
+
+    registry: str = CharField(max_length=255, db_index=True)
+    path: str = TextField()
+    file_size: int = BigIntegerField()
+    file_mtime: float = FloatField()
+    byte_offset: int = BigIntegerField()
+    last_pk: int | None = BigIntegerField(null=True)
+
+
 class Location(Record, CanCurate, TracksRun, TracksUpdates):
     """Capture physical location or address information of Persons and Care Sites."""
 
@@ -819,6 +873,45 @@ class Note(Record, CanCurate, TracksRun, TracksUpdates):
         null=True,
     )
 
+    @property
+    def text(self) -> str:
+        """The text of the note, loaded from :class:`NoteBlob` if it was offloaded by :mod:`omop.notes`."""
+        if self.note_text:
+            return self.note_text
+        from .notes import texts
+
+        return texts([self.note_id], using=self._state.db).get(self.note_id, "")
+
+
+class NoteBlob(Record, CanCurate, TracksRun, TracksUpdates):
+    """Compressed text of a Note, maintained by :mod:`omop.notes`.
+
+    Not part of the OMOP CDM. A note whose text was moved here has an empty `note_text`.
+    """
+
+    class Meta(Record.Meta, TracksRun.Meta, TracksUpdates.Meta):
+        abstract = False
+
+    note_id: int = IntegerField(primary_key=True)
+    codec: str = CharField(max_length=20)
+    size: int = BigIntegerField()
+    data: bytes = BinaryField()
+
+
+class NlpCheckpoint(Record, CanCurate, TracksRun, TracksUpdates):
+    """Progress of an NLP system over a queryset of notes, maintained by :mod:`omop.nlp`.
+
+    Not part of the OMOP CDM. `query_hash` identifies the queryset of the run, a restarted run resumes after `last_note_id`.
+    """
+
+    class Meta(Record.Meta, TracksRun.Meta, TracksUpdates.Meta):
+        abstract = False
+
+    nlp_system: str = CharField(max_length=255, db_index=True)
+    query_hash: str = CharField(max_length=64)
+    n_notes: int = BigIntegerField()
+    last_note_id: int | None = BigIntegerField(null=True)
+
 
 class NoteNlp(Record, CanCurate, TracksRun, TracksUpdates):
     """Encodes all output of NLP on clinical notes. Each row represents a single extracted term from a note."""
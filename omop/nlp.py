@@ -0,0 +1,495 @@
+"""Extract terms from clinical notes into :class:`~omop.NoteNlp`.
+
+:func:`run` streams :class:`~omop.Note` records in batches ordered by `note_id`
+and dispatches them to a pool of worker processes that apply an extractor to the
+text of every note. The main process writes the terms of a finished batch to
+:class:`~omop.NoteNlp` in bulk, replacing the terms that the same NLP system
+extracted from these notes before.
+
+- Backpressure: at most `max_pending` batches are read ahead of the writes, so
+  memory stays bounded however many notes there are.
+- Resumability: the end of the contiguous prefix of written batches is
+  checkpointed in :class:`~omop.NlpCheckpoint` per NLP system and queryset.
+  Calling :func:`run` again with the same queryset continues after the last
+  checkpointed note.
+- Concurrency: the ids of terms are allocated in the transaction that writes
+  them, so that runs in several processes don't collide.
+
+An extractor is a picklable callable that maps the text of a note to tuples of the
+character offset, the matched text and the concept id of its terms, like
+:class:`DictionaryMatcher`, the default.
+
+For large vocabularies, :func:`build_automaton` compiles the names of concepts once
+into an Aho-Corasick automaton on disk, which every worker loads with an
+:class:`AutomatonMatcher` instead of building a dictionary from the database.
+
+.. autosummary::
+   :toctree: .
+
+   run
+   DictionaryMatcher
+   AutomatonMatcher
+   build_automaton
+   NlpResult
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import date
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+import numpy as np
+import pandas as pd
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+from lamin_utils import logger
+
+from ._columnar import as_queryset
+from ._utils import (
+    get_registry,
+    process_pool,
+    replace_directory,
+    state_path,
+    unfiltered,
+)
+from .load import _merge_frames, _write_transaction
+from .models import NlpCheckpoint
+from .notes import _batches, _blob_texts
+from .query import fetch
+from .search import WORD_PATTERN
+from .standardize import normalize
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator
+
+    from django.db.models import QuerySet
+
+    Extractor = Callable[[str], Iterable[tuple[int, str, int]]]
+
+# characters of text around a term in its snippet
+SNIPPET_CONTEXT = 50
+# the lengths of the text columns of NoteNlp
+MAX_SNIPPET = MAX_LEXICAL_VARIANT = 250
+
+# the extractor of a worker process
+_extractor: Extractor | None = None
+
+
+class NlpResult(NamedTuple):
+    """Numbers of notes processed and terms written by :func:`run`."""
+
+    n_notes: int
+    n_terms: int
+
+
+def _dictionary(
+    domain_id: str | None,
+    vocabulary_id: str | None,
+    standard_concept: str | None,
+    synonyms: bool,
+    max_words: int,
+) -> pd.DataFrame:
+    """Distinct normalized names with their concept id and number of words."""
+    expressions = {
+        column: value
+        for column, value in [
+            ("domain_id", domain_id),
+            ("vocabulary_id", vocabulary_id),
+            ("standard_concept", standard_concept),
+        ]
+        if value is not None
+    }
+    names = [
+        fetch(
+            get_registry("Concept").filter(**expressions),
+            ["concept_id", "concept_name"],
+        ).sort_values("concept_id")
+    ]
+    if synonyms:
+        names.append(
+            fetch(
+                get_registry("ConceptSynonym").filter(
+                    **{f"concept__{key}": value for key, value in expressions.items()}
+                ),
+                ["concept_id", "concept_synonym_name"],
+            )
+            .rename(columns={"concept_synonym_name": "concept_name"})
+            .sort_values("concept_id")
+        )
+    # names of concepts take precedence over synonyms, lower ids over higher
+    df = pd.concat(names, ignore_index=True)
+    df["name"] = normalize(df["concept_name"])
+    n_words = df["name"].str.count(" ") + 1
+    df = df[(df["name"] != "") & (n_words <= max_words)]
+    df = df.drop_duplicates("name")
+    df["n_words"] = n_words[df.index]
+    return df[["name", "concept_id", "n_words"]].reset_index(drop=True)
+
+
+class DictionaryMatcher:
+    """Match the names and synonyms of concepts in text as whole words.
+
+    Text and names are compared after :func:`omop.standardize.normalize`. At every
+    word, the longest name that starts there matches and the scan continues after
+    it, so that matches don't overlap.
+
+    Args:
+        domain_id: Only concepts of this domain, e.g. `"Condition"`.
+        vocabulary_id: Only concepts of this vocabulary, e.g. `"SNOMED"`.
+        standard_concept: Only concepts with this flag, `None` for all concepts.
+        synonyms: Whether to match the synonyms of concepts, too.
+        max_words: Names with more words are not matched.
+
+    Examples:
+        >>> matcher = omop.nlp.DictionaryMatcher(domain_id="Condition")
+        >>> list(matcher("History of type 2 diabetes mellitus."))
+        [(11, 'type 2 diabetes mellitus', 201826)]
+    """
+
+    def __init__(
+        self,
+        *,
+        domain_id: str | None = None,
+        vocabulary_id: str | None = None,
+        standard_concept: str | None = "S",
+        synonyms: bool = True,
+        max_words: int = 10,
+    ) -> None:
+        df = _dictionary(
+            domain_id, vocabulary_id, standard_concept, synonyms, max_words
+        )
+        self.terms: dict[str, int] = dict(zip(df["name"], df["concept_id"].tolist()))
+        self.max_words = int(df["n_words"].max()) if len(df) else 0
+
+    def __call__(self, text: str) -> Iterator[tuple[int, str, int]]:
+        words = list(WORD_PATTERN.finditer(text))
+        lowered = [word.group().lower() for word in words]
+        i = 0
+        while i < len(words):
+            for n in range(min(self.max_words, len(words) - i), 0, -1):
+                name = " ".join(lowered[i : i + n])
+                concept_id = self.terms.get(name)
+                if concept_id is not None:
+                    start, end = words[i].start(), words[i + n - 1].end()
+                    yield start, text[start:end], concept_id
+                    i += n
+                    break
+            else:
+                i += 1
+
+
+def _automaton_path(path: str | Path | None) -> Path:
+    return state_path("automaton") if path is None else Path(path)
+
+
+def build_automaton(
+    path: str | Path | None = None,
+    *,
+    domain_id: str | None = None,
+    vocabulary_id: str | None = None,
+    standard_concept: str | None = "S",
+    synonyms: bool = True,
+    max_words: int = 10,
+) -> Path:
+    """Compile the names and synonyms of concepts into an Aho-Corasick automaton.
+
+    The automaton is a snapshot of the vocabulary for :class:`AutomatonMatcher`,
+    rebuild it after loading a vocabulary. It is written into a temporary
+    directory that replaces an existing automaton when it is complete.
+
+    Requires the `pyahocorasick` package, see the `nlp` extra.
+
+    Args:
+        path: The directory of the automaton, defaults to the cache directory of
+            the instance.
+        domain_id: Only concepts of this domain, e.g. `"Condition"`.
+        vocabulary_id: Only concepts of this vocabulary, e.g. `"SNOMED"`.
+        standard_concept: Only concepts with this flag, `None` for all concepts.
+        synonyms: Whether to match the synonyms of concepts, too.
+        max_words: Names with more words are not matched.
+
+    Examples:
+        >>> omop.nlp.build_automaton(domain_id="Condition")
+    """
+    import ahocorasick
+
+    path = _automaton_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df = _dictionary(domain_id, vocabulary_id, standard_concept, synonyms, max_words)
+    automaton = ahocorasick.Automaton(ahocorasick.STORE_INTS)
+    # every word in angle brackets, so that names only match whole words
+    for index, name in enumerate(df["name"]):
+        automaton.add_word(f"<{name.replace(' ', '><')}>", index)
+    automaton.make_automaton()
+    build = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}-"))
+    # unpickling is several times faster than ahocorasick.load
+    with open(build / "automaton.pickle", "wb") as f:
+        pickle.dump(automaton, f, protocol=pickle.HIGHEST_PROTOCOL)
+    np.save(build / "concept_id.npy", df["concept_id"].to_numpy(np.int64))
+    np.save(build / "n_words.npy", df["n_words"].to_numpy(np.int32))
+    meta = {
+        "n_names": len(df),
+        "built_at": timezone.now().isoformat(),
+        "domain_id": domain_id,
+        "vocabulary_id": vocabulary_id,
+        "standard_concept": standard_concept,
+        "synonyms": synonyms,
+        "max_words": max_words,
+    }
+    with open(build / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+    replace_directory(build, path)
+    logger.success(f"compiled {len(df)} names into {path}")
+    return path
+
+
+class AutomatonMatcher:
+    """Match concept names in text with an automaton from :func:`build_automaton`.
+
+    Finds the same terms as a :class:`DictionaryMatcher` with the same arguments,
+    in a single pass over the text whatever the number of names. The leftmost
+    longest name matches and the scan continues after it.
+
+    Instances are pickled as the path of the automaton, so that every worker of
+    :func:`run` loads it from disk instead of compiling it again.
+
+    Requires the `pyahocorasick` package, see the `nlp` extra.
+
+    Args:
+        path: The directory written by :func:`build_automaton`.
+
+    Examples:
+        >>> omop.nlp.build_automaton(domain_id="Condition")
+        >>> matcher = omop.nlp.AutomatonMatcher()
+        >>> list(matcher("History of type 2 diabetes mellitus."))
+        [(11, 'type 2 diabetes mellitus', 201826)]
+        >>> omop.nlp.run(extractor=matcher)
+    """
+
+    def __init__(self, path: str | Path | None = None) -> None:
+        self.path = _automaton_path(path)
+        self._load()
+
+    def _load(self) -> None:
+        import ahocorasick
+
+        with open(self.path / "meta.json") as f:
+            self.meta = json.load(f)
+        with open(self.path / "automaton.pickle", "rb") as f:
+            self._automaton = pickle.load(f)
+        # an automaton without names cannot be searched
+        self._empty = self._automaton.kind != ahocorasick.AHOCORASICK
+        self.concept_ids: np.ndarray = np.load(
+            self.path / "concept_id.npy", mmap_mode="r"
+        )
+        self.n_words: np.ndarray = np.load(self.path / "n_words.npy", mmap_mode="r")
+
+    def __getstate__(self) -> dict:
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.path = state["path"]
+        self._load()
+
+    def __call__(self, text: str) -> Iterator[tuple[int, str, int]]:
+        if self._empty:
+            return
+        words = list(WORD_PATTERN.finditer(text))
+        lowered = [word.group().lower() for word in words]
+        # the word that ends at every closing bracket of the scanned text
+        last_words = {}
+        end = -1
+        for i, word in enumerate(lowered):
+            end += len(word) + 2
+            last_words[end] = i
+        scanned = "".join(f"<{word}>" for word in lowered)
+        for end, index in self._automaton.iter_long(scanned):
+            last = last_words[end]
+            start = words[last - int(self.n_words[index]) + 1].start()
+            stop = words[last].end()
+            yield start, text[start:stop], int(self.concept_ids[index])
+
+
+def _init_worker(extractor: Extractor) -> None:
+    global _extractor
+    _extractor = extractor
+
+
+def _extract(notes: list[tuple[int, str]]) -> list[tuple[int, str, str, str, int]]:
+    """Terms of a batch of notes, runs in a worker process."""
+    terms = []
+    for note_id, text in notes:
+        for offset, lexical_variant, concept_id in _extractor(text):
+            end = offset + len(lexical_variant)
+            snippet = text[max(offset - SNIPPET_CONTEXT, 0) : end + SNIPPET_CONTEXT]
+            terms.append(
+                (
+                    note_id,
+                    " ".join(snippet.split())[:MAX_SNIPPET],
+                    str(offset),
+                    lexical_variant[:MAX_LEXICAL_VARIANT],
+                    concept_id,
+                )
+            )
+    return terms
+
+
+def _with_texts(rows: list[tuple[int, str]]) -> list[tuple[int, str]]:
+    # the text of notes offloaded by omop.notes
+    offloaded = [note_id for note_id, text in rows if not text]
+    if not offloaded:
+        return rows
+    blobs = _blob_texts(unfiltered(get_registry("NoteBlob")), offloaded)
+    return [(note_id, text or blobs.get(note_id, "")) for note_id, text in rows]
+
+
+def _query_hash(notes: QuerySet) -> str:
+    try:
+        sql, params = notes.query.sql_with_params()
+    except EmptyResultSet:
+        sql, params = "", ()
+    return hashlib.sha256(f"{sql} {params!r}".encode()).hexdigest()
+
+
+def _write(note_ids: list[int], terms: list[tuple], nlp_system: str) -> None:
+    note_nlp = get_registry("NoteNlp")
+    df = pd.DataFrame(
+        terms,
+        columns=["note_id", "snippet", "offset", "lexical_variant", "note_nlp_concept"],
+    )
+    df["nlp_system"] = nlp_system
+    df["nlp_date"] = date.today()
+    df["term_exists"] = "Y"
+    connection = connections["default"]
+    with _write_transaction("default"):
+        if connection.vendor != "sqlite":
+            # SQLite holds the write lock of the database for the transaction
+            with connection.cursor() as cursor:
+                table = connection.ops.quote_name(note_nlp._meta.db_table)
+                cursor.execute(f"LOCK TABLE {table} IN EXCLUSIVE MODE")
+        unfiltered(note_nlp).filter(
+            note_id__in=note_ids, nlp_system=nlp_system
+        ).delete()
+        if not df.empty:
+            last = unfiltered(note_nlp).aggregate(last=Max("note_nlp_id"))["last"]
+            first_id = (last or 0) + 1
+            df.insert(0, "note_nlp_id", range(first_id, first_id + len(df)))
+            _merge_frames(note_nlp, df, len(df))
+
+
+def run(
+    queryset: QuerySet | None = None,
+    extractor: Extractor | None = None,
+    *,
+    nlp_system: str | None = None,
+    n_workers: int | None = None,
+    batch_size: int = 1_000,
+    max_pending: int | None = None,
+    resume: bool = True,
+) -> NlpResult:
+    """Extract the terms of notes into NoteNlp with a pool of worker processes.
+
+    Terms are written with `term_exists = "Y"`, the character offset as `offset`
+    and the text around them as `snippet`. Processing a note again replaces its
+    terms of the same `nlp_system`.
+
+    Args:
+        queryset: The notes to process, defaults to all notes.
+        extractor: A picklable callable that yields tuples of the offset, the
+            matched text and the concept id of the terms in a text. Defaults to a
+            :class:`DictionaryMatcher` of all standard concepts.
+        nlp_system: The name recorded with the terms, which identifies the
+            checkpoint together with the queryset. Defaults to the qualified name of the extractor function
+            or class.
+        n_workers: Number of worker processes, defaults to the number of CPUs.
+            Workers are forked where the platform supports it, and connect to
+            the current instance otherwise, e.g. on Windows.
+        batch_size: Number of notes per batch.
+        max_pending: Maximal number of batches read ahead of the writes, defaults
+            to twice the number of workers.
+        resume: Whether to continue after the checkpoint of a previous run of
+            the same NLP system over the same queryset.
+
+    Examples:
+        >>> omop.nlp.run()
+        >>> matcher = omop.nlp.DictionaryMatcher(domain_id="Condition")
+        >>> omop.nlp.run(omop.Note.filter(note_date__year=2024), matcher, n_workers=8)
+    """
+    if extractor is None:
+        extractor = DictionaryMatcher()
+    if nlp_system is None:
+        # the name of a function, or the class of a callable instance
+        named = extractor if hasattr(extractor, "__qualname__") else type(extractor)
+        nlp_system = f"{named.__module__}.{named.__qualname__}"
+    n_workers = n_workers or os.cpu_count()
+    max_pending = max_pending or 2 * n_workers
+    notes = as_queryset(get_registry("Note") if queryset is None else queryset)
+    checkpoint, _ = unfiltered(NlpCheckpoint).get_or_create(
+        nlp_system=nlp_system,
+        query_hash=_query_hash(notes),
+        defaults={"n_notes": 0},
+    )
+    if not resume:
+        checkpoint.n_notes, checkpoint.last_note_id = 0, None
+        checkpoint.save()
+    if checkpoint.last_note_id is not None:
+        logger.info(f"resuming {nlp_system} after note {checkpoint.last_note_id}")
+        notes = notes.filter(note_id__gt=checkpoint.last_note_id)
+    batches = _batches(notes, batch_size)
+    n_notes = n_terms = 0
+    # batches by their position, and the finished ones after the checkpoint
+    pending, finished = {}, {}
+    n_read = n_checkpointed = 0
+    with process_pool(n_workers, _init_worker, (extractor,)) as executor:
+        try:
+            exhausted = False
+            while not exhausted or pending:
+                while not exhausted and len(pending) < max_pending:
+                    rows = next(batches, None)
+                    if rows is None:
+                        exhausted = True
+                        break
+                    rows = _with_texts(rows)
+                    if not n_read:
+                        # workers start on the first submission and must not
+                        # inherit open connections
+                        connections.close_all()
+                    future = executor.submit(_extract, rows)
+                    pending[future] = (n_read, [note_id for note_id, _ in rows])
+                    n_read += 1
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    position, note_ids = pending.pop(future)
+                    terms = future.result()
+                    _write(note_ids, terms, nlp_system)
+                    n_notes += len(note_ids)
+                    n_terms += len(terms)
+                    finished[position] = note_ids
+                if n_checkpointed not in finished:
+                    continue
+                while n_checkpointed in finished:
+                    note_ids = finished.pop(n_checkpointed)
+                    checkpoint.n_notes += len(note_ids)
+                    checkpoint.last_note_id = note_ids[-1]
+                    n_checkpointed += 1
+                checkpoint.updated_at = timezone.now()
+                checkpoint.save()
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    result = NlpResult(n_notes, n_terms)
+    logger.info(
+        f"extracted {result.n_terms} terms from {result.n_notes} notes with {nlp_system}"
+    )
+    return result
@@ -0,0 +1,225 @@
+"""Compressed storage of the text of clinical notes.
+
+`note_text` of :class:`~omop.Note` is stored inline, so every scan of the
+registry reads the text along with the metadata of the notes. :func:`offload`
+compresses the text with zstd into :class:`~omop.NoteBlob` and leaves an empty
+`note_text`, so that queries on the metadata of notes no longer read any text.
+The freed space is reclaimed by `VACUUM` on both SQLite and Postgres.
+
+Read the texts of a batch of notes with :func:`texts`, or the text of a single
+note with the `text` attribute of :class:`~omop.Note`. A non-empty `note_text`,
+e.g. of a note written after offloading, takes precedence over its blob.
+
+Requires the `zstandard` package, see the `notes` extra.
+
+.. autosummary::
+   :toctree: .
+
+   offload
+   restore
+   texts
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pandas as pd
+from django.db import transaction
+from django.db.models import Case, TextField, Value, When
+from lamin_utils import logger
+
+from ._columnar import as_queryset
+from ._utils import get_registry
+from .load import _merge_frames, _write_transaction
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    import zstandard
+    from django.db.models import Manager, QuerySet
+
+CODEC = "zstd"
+COMPRESSION_LEVEL = 3
+# notes per transaction and per query
+BATCH_SIZE = 1_000
+
+
+def _batches(queryset: QuerySet, batch_size: int) -> Iterable[list[tuple[int, str]]]:
+    # keyset pagination, the batches are written while reading
+    last = None
+    while True:
+        batch = queryset if last is None else queryset.filter(note_id__gt=last)
+        rows = list(
+            batch.order_by("note_id").values_list("note_id", "note_text")[:batch_size]
+        )
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def offload(
+    queryset: QuerySet | None = None,
+    *,
+    level: int = COMPRESSION_LEVEL,
+    batch_size: int = BATCH_SIZE,
+) -> int:
+    """Move the text of notes into compressed blobs.
+
+    Notes with an empty `note_text` are skipped, offloading again only moves the
+    text of notes written since. Every batch is read and cleared in one
+    transaction that locks its notes, so that no edit of a note is lost.
+
+    Args:
+        queryset: The notes to offload, defaults to all notes.
+        level: The zstd compression level, from 1 to 22.
+        batch_size: Number of notes per transaction.
+
+    Returns:
+        The number of offloaded notes.
+
+    Examples:
+        >>> omop.notes.offload()
+        >>> omop.notes.offload(omop.Note.filter(note_date__lt="2020-01-01"), level=19)
+    """
+    import zstandard
+
+    note = get_registry("Note")
+    note_blob = get_registry("NoteBlob")
+    queryset = as_queryset(note if queryset is None else queryset)
+    compressor = zstandard.ZstdCompressor(level=level)
+    notes = queryset.exclude(note_text="")
+    n_notes = n_bytes = n_compressed = 0
+    last = None
+    while True:
+        with _write_transaction("default"):
+            batch = notes if last is None else notes.filter(note_id__gt=last)
+            rows = list(
+                batch.select_for_update()
+                .order_by("note_id")
+                .values_list("note_id", "note_text")[:batch_size]
+            )
+            if not rows:
+                break
+            note_ids = [note_id for note_id, _ in rows]
+            data = [text.encode() for _, text in rows]
+            compressed = [compressor.compress(value) for value in data]
+            blobs = pd.DataFrame(
+                {
+                    "note_id": note_ids,
+                    "codec": CODEC,
+                    "size": [len(value) for value in data],
+                    "data": compressed,
+                }
+            )
+            _merge_frames(note_blob, blobs, batch_size)
+            n_notes += note.objects.filter(note_id__in=note_ids).update(note_text="")
+        n_bytes += sum(map(len, data))
+        n_compressed += sum(map(len, compressed))
+        last = note_ids[-1]
+    if n_notes:
+        logger.info(
+            f"offloaded {n_notes} notes, compressed {n_bytes} to {n_compressed} bytes"
+        )
+    return n_notes
+
+
+def _decompress(
+    codec: str, data: bytes, decompressor: zstandard.ZstdDecompressor
+) -> str:
+    if codec != CODEC:
+        raise ValueError(f"unknown codec of a note blob: {codec}")
+    return decompressor.decompress(bytes(data)).decode()
+
+
+def _blob_texts(note_blob: Manager, note_ids: list[int]) -> dict[int, str]:
+    """Decompressed texts of the notes among `note_ids` that have a blob."""
+    blobs = list(
+        note_blob.filter(note_id__in=note_ids).values_list("note_id", "codec", "data")
+    )
+    if not blobs:
+        return {}
+    import zstandard
+
+    decompressor = zstandard.ZstdDecompressor()
+    return {
+        note_id: _decompress(codec, data, decompressor)
+        for note_id, codec, data in blobs
+    }
+
+
+def texts(note_ids: Iterable[int], *, using: str | None = None) -> dict[int, str]:
+    """Texts of notes, offloaded or not, with two queries per 1,000 notes.
+
+    Ids without a note are missing from the result.
+
+    Args:
+        note_ids: Ids of notes.
+        using: The database alias, defaults to that of the Note registry.
+
+    Examples:
+        >>> omop.notes.texts([1, 2])
+        {1: 'Patient presents with ...', 2: 'Follow-up visit ...'}
+    """
+    note_ids = sorted({int(note_id) for note_id in note_ids})
+    note = get_registry("Note").objects
+    note_blob = get_registry("NoteBlob").objects
+    if using is not None:
+        note, note_blob = note.using(using), note_blob.using(using)
+    result = {}
+    for start in range(0, len(note_ids), BATCH_SIZE):
+        batch = note_ids[start : start + BATCH_SIZE]
+        offloaded = []
+        for note_id, text in note.filter(note_id__in=batch).values_list(
+            "note_id", "note_text"
+        ):
+            result[note_id] = text
+            if not text:
+                offloaded.append(note_id)
+        if offloaded:
+            result.update(_blob_texts(note_blob, offloaded))
+    return result
+
+
+def restore(queryset: QuerySet | None = None, *, batch_size: int = BATCH_SIZE) -> int:
+    """Move the text of offloaded notes back into `note_text`.
+
+    Args:
+        queryset: The notes to restore, defaults to all notes.
+        batch_size: Number of notes per transaction.
+
+    Returns:
+        The number of restored notes.
+
+    Examples:
+        >>> omop.notes.restore()
+    """
+    import zstandard
+
+    note = get_registry("Note")
+    note_blob = get_registry("NoteBlob")
+    queryset = as_queryset(note if queryset is None else queryset)
+    decompressor = zstandard.ZstdDecompressor()
+    n_notes = 0
+    for rows in _batches(queryset.filter(note_text=""), batch_size):
+        note_ids = [row[0] for row in rows]
+        blobs = note_blob.objects.filter(note_id__in=note_ids).values_list(
+            "note_id", "codec", "data"
+        )
+        restored = {
+            note_id: _decompress(codec, data, decompressor)
+            for note_id, codec, data in blobs
+        }
+        if not restored:
+            continue
+        cases = [When(note_id=i, then=Value(text)) for i, text in restored.items()]
+        with transaction.atomic():
+            note.objects.filter(note_id__in=list(restored)).update(
+                note_text=Case(*cases, output_field=TextField())
+            )
+            note_blob.objects.filter(note_id__in=list(restored)).delete()
+        n_notes += len(restored)
+    if n_notes:
+        logger.info(f"restored the text of {n_notes} notes")
+    return n_notes
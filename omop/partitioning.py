@@ -0,0 +1,272 @@
+"""Yearly date-range partitioning of :class:`~omop.Measurement` and :class:`~omop.Observation`.
+
+On Postgres, :func:`enable` converts the tables into declarative range partitions
+on `measurement_date` and `observation_date` with one partition per year. Queries
+filtering on the date are pruned to the partitions of the requested years, and
+old years can be detached cheaply with :func:`detach`.
+
+Partitions for new years are created when records are saved or merged with
+:func:`omop.load.merge`. The primary key is extended by the date column.
+
+Partitioning requires Postgres and cannot be combined with :mod:`~omop.sharding`.
+
+.. autosummary::
+   :toctree: .
+
+   enable
+   disable
+   years
+   create_partitions
+   detach
+"""
+
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING
+
+from django.db import connections, transaction
+from django.db.models.signals import pre_save
+from django.utils import timezone
+from lamin_utils import logger
+
+from ._utils import get_registry, partition_names, partition_strategy, rebuild_table
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from lamindb.models import Record
+
+DATE_COLUMNS = {
+    "Measurement": "measurement_date",
+    "Observation": "observation_date",
+}
+
+# seconds after which the partitions are looked up again, other processes might
+# have created or detached partitions in the meantime
+CACHE_SECONDS = 60.0
+
+# years with a partition per registry, None if the registry is not partitioned,
+# with the monotonic time of their lookup
+_years: dict[str, tuple[float, set[int] | None]] = {}
+
+
+def _partition_name(registry: type[Record], year: int) -> str:
+    return f"{registry._meta.db_table}_y{year}"
+
+
+def _bound(year: int) -> str:
+    return f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+
+
+def _check_registry(registry: type[Record] | str) -> type[Record]:
+    registry = get_registry(registry)
+    if registry.__name__ not in DATE_COLUMNS:
+        raise ValueError(
+            f"only {' and '.join(DATE_COLUMNS)} can be partitioned, not {registry.__name__}"
+        )
+    return registry
+
+
+def _check_postgres() -> None:
+    if connections["default"].vendor != "postgresql":
+        raise NotImplementedError("date-range partitioning requires Postgres")
+
+
+def _partition_years(
+    registry: type[Record], *, refresh: bool = False
+) -> set[int] | None:
+    cached = _years.get(registry.__name__)
+    if refresh or cached is None or time.monotonic() - cached[0] > CACHE_SECONDS:
+        cached = (
+            time.monotonic(),
+            {int(name.rsplit("_y", 1)[1]) for name in partition_names(registry)}
+            if partition_strategy(registry) == "range"
+            else None,
+        )
+        _years[registry.__name__] = cached
+    return cached[1]
+
+
+def years(registry: type[Record] | str) -> list[int] | None:
+    """Years that have a partition, `None` if the registry is not partitioned.
+
+    Examples:
+        >>> omop.partitioning.years(omop.Measurement)
+    """
+    partition_years = _partition_years(_check_registry(registry))
+    return None if partition_years is None else sorted(partition_years)
+
+
+def enable(registries: Iterable[type[Record] | str] | None = None) -> None:
+    """Partition registries by year of their date column.
+
+    Existing records are moved into partitions for the years they cover. Run this
+    while no other process writes to the instance. Call :func:`disable` before
+    applying migrations that change the partitioned tables.
+
+    Args:
+        registries: Registries to partition, defaults to `Measurement` and
+            `Observation`.
+
+    Examples:
+        >>> omop.partitioning.enable()
+    """
+    _check_postgres()
+    registries = [_check_registry(r) for r in registries or DATE_COLUMNS]
+    connection = connections["default"]
+    qn = connection.ops.quote_name
+    with transaction.atomic(), connection.schema_editor() as editor:
+        for registry in registries:
+            strategy = partition_strategy(registry)
+            if strategy == "range":
+                continue
+            if strategy is not None:
+                raise ValueError(
+                    f"{registry.__name__} is sharded, call omop.sharding.disable() first"
+                )
+            column = DATE_COLUMNS[registry.__name__]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT DISTINCT EXTRACT(YEAR FROM {qn(column)})::integer"
+                    f" FROM {qn(registry._meta.db_table)}"
+                )
+                data_years = sorted(year for (year,) in cursor.fetchall())
+            rebuild_table(
+                editor,
+                registry,
+                partition_by=f"RANGE ({qn(column)})",
+                partitions=[
+                    (_partition_name(registry, year), _bound(year))
+                    for year in data_years
+                ],
+                key=[column],
+            )
+            _years[registry.__name__] = (time.monotonic(), set(data_years))
+            logger.success(
+                f"partitioned {registry.__name__} into {len(data_years)} years"
+            )
+
+
+def disable(registries: Iterable[type[Record] | str] | None = None) -> None:
+    """Merge the yearly partitions back into single tables.
+
+    Detached partitions are not merged back.
+
+    Examples:
+        >>> omop.partitioning.disable()
+    """
+    _check_postgres()
+    registries = [_check_registry(r) for r in registries or DATE_COLUMNS]
+    connection = connections["default"]
+    with transaction.atomic(), connection.schema_editor() as editor:
+        for registry in registries:
+            if _partition_years(registry) is None:
+                continue
+            rebuild_table(editor, registry)
+            _years[registry.__name__] = (time.monotonic(), None)
+
+
+def create_partitions(registry: type[Record] | str, years: Iterable[int]) -> None:
+    """Create the partitions for years that don't have one yet.
+
+    Does nothing if the registry is not partitioned.
+
+    Args:
+        registry: The partitioned registry.
+        years: Years of records that are about to be written.
+
+    Examples:
+        >>> omop.partitioning.create_partitions("Measurement", [2025, 2026])
+    """
+    registry = _check_registry(registry)
+    years = set(map(int, years))
+    existing = _partition_years(registry)
+    if existing is None or years <= existing:
+        return
+    # another process might have created the partitions in the meantime
+    existing = _partition_years(registry, refresh=True)
+    if existing is None:
+        return
+    missing = sorted(years - existing)
+    if not missing:
+        return
+    connection = connections["default"]
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for year in missing:
+            name = _partition_name(registry, year)
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {qn(name)}"
+                f" PARTITION OF {qn(registry._meta.db_table)} {_bound(year)}"
+            )
+    # a table of the same name that is not a partition, e.g. created by hand
+    names = set(partition_names(registry))
+    unattached = [
+        _partition_name(registry, year)
+        for year in missing
+        if _partition_name(registry, year) not in names
+    ]
+    if unattached:
+        raise ValueError(
+            f"tables {unattached} exist but are not partitions of"
+            f" {registry.__name__}, rename or drop them"
+        )
+    existing.update(missing)
+    logger.info(f"created partitions of {registry.__name__} for years {missing}")
+
+
+def detach(
+    registry: type[Record] | str, year: int, *, drop: bool = False
+) -> str | None:
+    """Detach the partition of a year from its registry.
+
+    A detached partition is renamed into a standalone table like
+    `omop_measurement_y2015_detached_20260101120000`, with the time it was
+    detached, which can be archived or dropped. Its records are no longer visible
+    through the registry and records of the year written later go to a new
+    partition.
+
+    Args:
+        registry: The partitioned registry.
+        year: The year to detach.
+        drop: Whether to drop the detached table.
+
+    Returns:
+        The name of the detached table, `None` if it was dropped.
+
+    Examples:
+        >>> omop.partitioning.detach(omop.Measurement, 2010, drop=True)
+    """
+    registry = _check_registry(registry)
+    if year not in (_partition_years(registry, refresh=True) or set()):
+        raise ValueError(f"{registry.__name__} has no partition for {year}")
+    connection = connections["default"]
+    qn = connection.ops.quote_name
+    name = _partition_name(registry, year)
+    detached = f"{name}_detached_{timezone.now():%Y%m%d%H%M%S}"
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE {qn(registry._meta.db_table)} DETACH PARTITION {qn(name)}"
+        )
+        if drop:
+            cursor.execute(f"DROP TABLE {qn(name)}")
+        else:
+            cursor.execute(f"ALTER TABLE {qn(name)} RENAME TO {qn(detached)}")
+    _partition_years(registry).discard(year)
+    return None if drop else detached
+
+
+def _on_pre_save(sender: type[Record], instance: Record, **kwargs) -> None:
+    if sender._meta.app_label != "omop" or sender.__name__ not in DATE_COLUMNS:
+        return
+    if connections[kwargs.get("using") or "default"].vendor != "postgresql":
+        return
+    field = sender._meta.get_field(DATE_COLUMNS[sender.__name__])
+    # the date might still be a string before it is saved
+    date = field.to_python(getattr(instance, field.attname))
+    if date is not None:
+        create_partitions(sender, [date.year])
+
+
+pre_save.connect(_on_pre_save, dispatch_uid="omop_partitions")
@@ -0,0 +1,259 @@
+"""Query instrumentation for code that accesses the omop registries.
+
+:func:`profile` records every query that runs on the database connections of the
+current thread, with its SQL, the registry it reads or writes, the number of
+rows and its latency including fetching the rows. Queries that repeat with the
+same SQL are flagged as N+1 suspects, typically the lazy resolution of a foreign
+key in a loop like `[c.condition_concept.concept_name for c in conditions]`.
+
+.. autosummary::
+   :toctree: .
+
+   profile
+   Profile
+   QueryTrace
+"""
+
+from __future__ import annotations
+
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable
+
+import django
+import pandas as pd
+from django.apps import apps
+from django.db import connections
+from lamin_utils import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
+# queries that run at least this often with the same SQL are N+1 suspects
+N_PLUS_ONE_THRESHOLD = 5
+
+# the first table that a statement reads from or writes to
+TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"([^"]+)"', re.IGNORECASE)
+
+# frames of Django and of this module are not part of the recorded call stacks
+_SKIPPED_PATHS = (str(Path(django.__file__).parent), __file__)
+
+
+@dataclass
+class QueryTrace:
+    """A query that ran while profiling."""
+
+    sql: str
+    """The SQL with placeholders for the parameters."""
+    db: str
+    """The database alias."""
+    registry: str | None
+    """The registry of the first table of the query, if any."""
+    rows: int = 0
+    """The number of rows fetched, or affected by a write."""
+    seconds: float = 0.0
+    """The time spent executing the query and fetching its rows."""
+    stack: list[str] = field(default_factory=list)
+    """The calling frames, outermost first."""
+
+
+def _registries_by_table() -> dict[str, str]:
+    return {model._meta.db_table: model.__name__ for model in apps.get_models()}
+
+
+def _stack() -> list[str]:
+    frames = []
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith(_SKIPPED_PATHS):
+            frames.append(
+                f"{frame.f_code.co_name} ({Path(filename).name}:{frame.f_lineno})"
+            )
+        frame = frame.f_back
+    return frames[::-1]
+
+
+def _is_read(sql: str) -> bool:
+    return sql.lstrip()[:6].upper() == "SELECT"
+
+
+def _counting(fetch: Callable, cursor: Any, attribute: str) -> Callable:
+    def wrapper(*args: Any) -> Any:
+        start = time.perf_counter()
+        result = fetch(*args)
+        # the cursor might have executed another query since it was wrapped
+        trace = getattr(cursor, attribute)
+        if trace is not None:
+            trace.seconds += time.perf_counter() - start
+            if isinstance(result, list):
+                trace.rows += len(result)
+            elif result is not None:
+                trace.rows += 1
+        return result
+
+    return wrapper
+
+
+class Profile:
+    """The queries recorded by :func:`profile`."""
+
+    def __init__(self, *, stacks: bool = True) -> None:
+        self.queries: list[QueryTrace] = []
+        """The queries in the order they ran."""
+        self._stacks = stacks
+        self._registries = _registries_by_table()
+
+    def _execute(
+        self,
+        execute: Callable,
+        sql: str,
+        params: Any,
+        many: bool,
+        context: dict[str, Any],
+    ) -> Any:
+        match = TABLE_PATTERN.search(sql)
+        trace = QueryTrace(
+            sql=sql,
+            db=context["connection"].alias,
+            registry=self._registries.get(match.group(1)) if match else None,
+            stack=_stack() if self._stacks else [],
+        )
+        self.queries.append(trace)
+        cursor = context["cursor"]
+        # the trace that fetches of the cursor count towards, per profile
+        attribute = f"_omop_profile_{id(self)}"
+        if not hasattr(cursor, attribute):
+            for name in ["fetchone", "fetchmany", "fetchall"]:
+                # instance attributes take precedence over the delegation to the
+                # cursor of the driver
+                setattr(
+                    cursor, name, _counting(getattr(cursor, name), cursor, attribute)
+                )
+        setattr(cursor, attribute, trace if _is_read(sql) else None)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            trace.seconds += time.perf_counter() - start
+            if not _is_read(sql):
+                trace.rows = max(cursor.cursor.rowcount, 0)
+
+    def to_frame(self) -> pd.DataFrame:
+        """One row per query with columns `registry`, `db`, `sql`, `rows` and `seconds`."""
+        return pd.DataFrame(
+            [
+                (trace.registry, trace.db, trace.sql, trace.rows, trace.seconds)
+                for trace in self.queries
+            ],
+            columns=["registry", "db", "sql", "rows", "seconds"],
+        )
+
+    def summary(self) -> pd.DataFrame:
+        """Number of queries, rows and the total latency per registry.
+
+        Examples:
+            >>> profile.summary().sort_values("seconds", ascending=False)
+        """
+        df = self.to_frame()
+        df["registry"] = df["registry"].fillna("")
+        return (
+            df.groupby("registry")
+            .agg(
+                n_queries=("sql", "size"),
+                rows=("rows", "sum"),
+                seconds=("seconds", "sum"),
+            )
+            .sort_index()
+        )
+
+    def n_plus_one(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> pd.DataFrame:
+        """Reads that ran at least `threshold` times with the same SQL.
+
+        Returns:
+            One row per SQL with the number of queries, their total latency and
+            the innermost calling frame, sorted by the number of queries.
+        """
+        counts = Counter(trace.sql for trace in self.queries if _is_read(trace.sql))
+        suspects = {sql for sql, count in counts.items() if count >= threshold}
+        rows = {}
+        for trace in self.queries:
+            if trace.sql not in suspects:
+                continue
+            if trace.sql not in rows:
+                location = trace.stack[-1] if trace.stack else None
+                rows[trace.sql] = [trace.registry, trace.sql, 0, 0.0, location]
+            rows[trace.sql][2] += 1
+            rows[trace.sql][3] += trace.seconds
+        df = pd.DataFrame(
+            list(rows.values()),
+            columns=["registry", "sql", "n_queries", "seconds", "location"],
+        )
+        return df.sort_values("n_queries", ascending=False, ignore_index=True)
+
+    def to_folded(self, path: str | Path | None = None) -> str:
+        """Call stacks of the queries in the folded format of flame graph tools.
+
+        Every line holds the frames of a stack separated by `;`, ending with the
+        registry and SQL of the query, and its latency in microseconds. Open the
+        file with `flamegraph.pl`, `inferno-flamegraph` or https://speedscope.app.
+
+        Args:
+            path: A file to write the stacks to.
+
+        Examples:
+            >>> profile.to_folded("queries.folded")
+        """
+        weights: Counter[str] = Counter()
+        for trace in self.queries:
+            sql = " ".join(trace.sql.split())[:120].replace(";", ",")
+            leaf = f"{trace.registry or trace.db}: {sql}"
+            weights[";".join([*trace.stack, leaf])] += round(trace.seconds * 1e6)
+        folded = "".join(f"{stack} {weight}\n" for stack, weight in weights.items())
+        if path is not None:
+            Path(path).write_text(folded)
+        return folded
+
+
+@contextmanager
+def profile(
+    databases: Iterable[str] | None = None, *, stacks: bool = True
+) -> Iterator[Profile]:
+    """Record the queries of a block of code.
+
+    Only the connections of the current thread are instrumented, queries of worker
+    threads like those of :func:`omop.sharding.map_shards` are not recorded.
+    Logs a warning for N+1 suspects at the end of the block.
+
+    Args:
+        databases: Database aliases to instrument, defaults to all of them.
+        stacks: Whether to record the call stack of every query, which
+            :meth:`Profile.to_folded` needs.
+
+    Examples:
+        >>> with omop.profiling.profile() as profile:
+        ...     names = [
+        ...         c.condition_concept.concept_name
+        ...         for c in omop.ConditionOccurrence.filter(person_id=42)
+        ...     ]
+        >>> profile.summary()
+        >>> profile.n_plus_one()
+    """
+    result = Profile(stacks=stacks)
+    aliases = list(connections) if databases is None else list(databases)
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(connections[alias].execute_wrapper(result._execute))
+        yield result
+    suspects = result.n_plus_one()
+    if not suspects.empty:
+        details = ", ".join(
+            f"{row.n_queries}x {row.registry} at {row.location}"
+            for row in suspects.itertuples()
+        )
+        logger.warning(f"repeated queries, suspected N+1: {details}")
@@ -0,0 +1,364 @@
+"""Fuzzy search over the names and synonyms of concepts.
+
+`LIKE` queries on :class:`~omop.Concept` and :class:`~omop.ConceptSynonym` scan
+millions of strings. :func:`build_index` creates a trigram index over both:
+
+- On SQLite, an FTS5 table with the trigram tokenizer.
+- On Postgres, GIN indexes of the `pg_trgm` extension.
+- Otherwise, e.g. if `pg_trgm` is not installed on the server, an inverted
+  trigram index in the memory of the process.
+
+:func:`search` ranks concepts by the trigram similarity of the query to their name
+or to one of their synonyms, the measure of `pg_trgm`: the number of shared
+trigrams of words divided by the number of distinct trigrams of both.
+
+The SQLite index is a snapshot, rebuild it after loading a vocabulary.
+
+.. autosummary::
+   :toctree: .
+
+   build_index
+   drop_index
+   search
+   similarity
+"""
+
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING, Literal, NamedTuple
+
+import numpy as np
+import pandas as pd
+from django.db import connections, transaction
+from lamin_utils import logger
+
+from ._utils import get_registry
+from .query import fetch
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+# the FTS5 table of the SQLite index
+SEARCH_TABLE = "omop_concept_search"
+# the GIN indexes of the Postgres index per registry and name column
+TRIGRAM_INDEXES = {
+    ("Concept", "concept_name"): "omop_concept_name_trgm",
+    ("ConceptSynonym", "concept_synonym_name"): "omop_conceptsynonym_name_trgm",
+}
+# candidates fetched per result, to rank them and to merge synonyms of a concept
+CANDIDATES_PER_RESULT = 20
+RESULT_COLUMNS = [
+    "concept_id",
+    "concept_name",
+    "matched_name",
+    "score",
+    "domain_id",
+    "vocabulary_id",
+    "standard_concept",
+]
+
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+# the index in the memory of this process, if the database has none
+_memory_index: _TrigramIndex | None = None
+
+
+def _trigrams(text: str) -> set[str]:
+    # like pg_trgm, lowercase words padded with two blanks in front and one behind
+    trigrams = set()
+    for word in WORD_PATTERN.findall(text.lower()):
+        padded = f"  {word} "
+        trigrams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def _score(a_trigrams: set[str], b_trigrams: set[str]) -> float:
+    if not a_trigrams or not b_trigrams:
+        return 0.0
+    shared = len(a_trigrams & b_trigrams)
+    return shared / (len(a_trigrams) + len(b_trigrams) - shared)
+
+
+def similarity(a: str, b: str) -> float:
+    """Trigram similarity of two strings between 0 and 1, like that of `pg_trgm`.
+
+    Examples:
+        >>> omop.search.similarity("diabetes", "diabetis")
+        0.5
+    """
+    return _score(_trigrams(a), _trigrams(b))
+
+
+class _Filters(NamedTuple):
+    domain_id: str | None
+    vocabulary_id: str | None
+    standard_concept: str | None
+
+    def sql(self, alias: str) -> tuple[str, list]:
+        """`AND` clauses on the concept table under an alias."""
+        clauses, params = [], []
+        for column, value in self._asdict().items():
+            if value is not None:
+                clauses.append(f" AND {alias}.{column} = %s")
+                params.append(value)
+        return "".join(clauses), params
+
+
+class _TrigramIndex:
+    """An inverted index from trigrams to the positions of names."""
+
+    def __init__(self) -> None:
+        concepts = fetch(
+            "Concept",
+            ["concept_id", "concept_name", *_Filters._fields],
+        )
+        synonyms = fetch("ConceptSynonym", ["concept_id", "concept_synonym_name"])
+        names = pd.concat(
+            [
+                concepts[["concept_id", "concept_name"]],
+                synonyms.rename(columns={"concept_synonym_name": "concept_name"}),
+            ],
+            ignore_index=True,
+        )
+        self.concept_ids = names["concept_id"].to_numpy(np.int64)
+        self.names = names["concept_name"].to_numpy(object)
+        attributes = concepts.set_index("concept_id").reindex(self.concept_ids)
+        self.attributes = {
+            column: attributes[column].to_numpy(object) for column in _Filters._fields
+        }
+        postings: dict[str, list[int]] = {}
+        n_trigrams = np.zeros(len(self.names), dtype=np.int32)
+        for position, name in enumerate(self.names):
+            trigrams = _trigrams(name)
+            n_trigrams[position] = len(trigrams)
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(position)
+        self.n_trigrams = n_trigrams
+        self.postings = {
+            trigram: np.array(positions, dtype=np.int32)
+            for trigram, positions in postings.items()
+        }
+
+    def search(
+        self, query: str, filters: _Filters, min_score: float, n_candidates: int
+    ) -> list[tuple[int, str, float]]:
+        trigrams = _trigrams(query)
+        postings = [self.postings[t] for t in trigrams if t in self.postings]
+        if not postings:
+            return []
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.names))
+        scores = shared / (len(trigrams) + self.n_trigrams - shared)
+        mask = scores >= min_score
+        for column, value in filters._asdict().items():
+            if value is not None:
+                mask &= self.attributes[column] == value
+        positions = np.flatnonzero(mask)
+        if len(positions) > n_candidates:
+            top = np.argpartition(-scores[positions], n_candidates)[:n_candidates]
+            positions = positions[top]
+        return [
+            (int(self.concept_ids[p]), self.names[p], float(scores[p]))
+            for p in positions
+        ]
+
+
+def _backend() -> Literal["fts5", "pg_trgm", "memory"]:
+    """The index that the database holds, `"memory"` if it has none."""
+    connection = connections["default"]
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+                [SEARCH_TABLE],
+            )
+            return "fts5" if cursor.fetchone() else "memory"
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT count(*) FROM pg_indexes WHERE indexname = ANY(%s)",
+                [list(TRIGRAM_INDEXES.values())],
+            )
+            if cursor.fetchone()[0] == len(TRIGRAM_INDEXES):
+                return "pg_trgm"
+    return "memory"
+
+
+def _table(registry: str) -> str:
+    return connections["default"].ops.quote_name(get_registry(registry)._meta.db_table)
+
+
+def build_index() -> str:
+    """Create the trigram index over concept names and synonyms.
+
+    Falls back to an index in the memory of the process if the database supports
+    neither FTS5 nor `pg_trgm`, which every process then builds on its first search.
+
+    Returns:
+        The kind of index, `"fts5"`, `"pg_trgm"` or `"memory"`.
+
+    Examples:
+        >>> omop.search.build_index()
+    """
+    global _memory_index
+    connection = connections["default"]
+    qn = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute(f"DROP TABLE IF EXISTS {qn(SEARCH_TABLE)}")
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {qn(SEARCH_TABLE)} USING"
+                " fts5(name, concept_id UNINDEXED, tokenize = 'trigram')"
+            )
+            cursor.execute(
+                f"INSERT INTO {qn(SEARCH_TABLE)} (name, concept_id)"
+                f" SELECT concept_name, concept_id FROM {_table('Concept')}"
+                " WHERE _branch_code = 1 UNION ALL"
+                f" SELECT concept_synonym_name, concept_id FROM {_table('ConceptSynonym')}"
+                " WHERE _branch_code = 1"
+            )
+            return "fts5"
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+            )
+            if cursor.fetchone():
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                for (registry, column), index in TRIGRAM_INDEXES.items():
+                    cursor.execute(
+                        f"CREATE INDEX IF NOT EXISTS {qn(index)} ON {_table(registry)}"
+                        f" USING gin ({qn(column)} gin_trgm_ops)"
+                    )
+                return "pg_trgm"
+    logger.warning("the database has no trigram support, indexing in memory")
+    _memory_index = _TrigramIndex()
+    return "memory"
+
+
+def drop_index() -> None:
+    """Remove the trigram index.
+
+    Examples:
+        >>> omop.search.drop_index()
+    """
+    global _memory_index
+    _memory_index = None
+    connection = connections["default"]
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute(f"DROP TABLE IF EXISTS {qn(SEARCH_TABLE)}")
+        elif connection.vendor == "postgresql":
+            for index in TRIGRAM_INDEXES.values():
+                cursor.execute(f"DROP INDEX IF EXISTS {qn(index)}")
+
+
+def _search_fts5(
+    query: str, filters: _Filters, min_score: float, n_candidates: int
+) -> list[tuple[int, str, float]]:
+    # FTS5 matches unpadded trigrams within words, of which any needs to match
+    terms = {
+        word[i : i + 3]
+        for word in WORD_PATTERN.findall(query.lower())
+        for i in range(len(word) - 2)
+    }
+    if not terms:
+        return []
+    match = " OR ".join(f'"{term}"' for term in sorted(terms))
+    filter_sql, filter_params = filters.sql("c")
+    with connections["default"].cursor() as cursor:
+        cursor.execute(
+            f"SELECT s.concept_id, s.name FROM {SEARCH_TABLE} s"
+            f" JOIN {_table('Concept')} c ON c.concept_id = s.concept_id"
+            f" WHERE s.name MATCH %s{filter_sql}"
+            " ORDER BY s.rank LIMIT %s",
+            [match, *filter_params, n_candidates],
+        )
+        rows = cursor.fetchall()
+    query_trigrams = _trigrams(query)
+    candidates = [
+        (concept_id, name, _score(query_trigrams, _trigrams(name)))
+        for concept_id, name in rows
+    ]
+    return [candidate for candidate in candidates if candidate[2] >= min_score]
+
+
+def _search_pg_trgm(
+    query: str, filters: _Filters, min_score: float, n_candidates: int
+) -> list[tuple[int, str, float]]:
+    filter_sql, filter_params = filters.sql("c")
+    with connections["default"].cursor() as cursor:
+        # the threshold of the `%` operator, which the GIN indexes support
+        cursor.execute("SELECT set_limit(%s)", [min_score])
+        cursor.execute(
+            "SELECT concept_id, name, similarity(name, %s) AS score FROM ("
+            f" SELECT c.concept_id, c.concept_name AS name FROM {_table('Concept')} c"
+            f" WHERE c.concept_name %% %s{filter_sql} UNION ALL"
+            f" SELECT s.concept_id, s.concept_synonym_name FROM {_table('ConceptSynonym')} s"
+            f" JOIN {_table('Concept')} c ON c.concept_id = s.concept_id"
+            f" WHERE s.concept_synonym_name %% %s{filter_sql}"
+            ") matches ORDER BY score DESC LIMIT %s",
+            [query, query, *filter_params, query, *filter_params, n_candidates],
+        )
+        return cursor.fetchall()
+
+
+def search(
+    query: str,
+    *,
+    domain_id: str | None = None,
+    vocabulary_id: str | None = None,
+    standard_concept: str | None = None,
+    limit: int = 20,
+    min_score: float = 0.3,
+) -> pd.DataFrame:
+    """Concepts whose name or synonyms are similar to a free-text query.
+
+    Uses the index of :func:`build_index`, or builds an index in memory if the
+    database has none.
+
+    Args:
+        query: Free text, e.g. `"diabetis type 2"`.
+        domain_id: Only concepts of this domain, e.g. `"Condition"`.
+        vocabulary_id: Only concepts of this vocabulary, e.g. `"SNOMED"`.
+        standard_concept: Only concepts with this flag, e.g. `"S"` for standard
+            concepts.
+        limit: The maximal number of concepts.
+        min_score: The minimal similarity.
+
+    Returns:
+        One row per concept, ranked by `score`, the highest similarity of its name
+        and synonyms. `matched_name` is the name or synonym that matched best.
+
+    Examples:
+        >>> omop.search.search("hemoglobin a1c", domain_id="Measurement", standard_concept="S")
+    """
+    global _memory_index
+    filters = _Filters(domain_id, vocabulary_id, standard_concept)
+    n_candidates = limit * CANDIDATES_PER_RESULT
+    backend = _backend()
+    if backend == "fts5":
+        candidates = _search_fts5(query, filters, min_score, n_candidates)
+    elif backend == "pg_trgm":
+        candidates = _search_pg_trgm(query, filters, min_score, n_candidates)
+    else:
+        if _memory_index is None:
+            logger.info("indexing concept names in memory, see build_index()")
+            _memory_index = _TrigramIndex()
+        candidates = _memory_index.search(query, filters, min_score, n_candidates)
+    # the best matching name per concept
+    best: dict[int, tuple[str, float]] = {}
+    for concept_id, name, score in sorted(candidates, key=lambda c: (-c[2], c[0])):
+        best.setdefault(concept_id, (name, score))
+    concept_ids = list(best)[:limit]
+    attributes = (
+        get_registry("Concept")
+        .filter(concept_id__in=concept_ids)
+        .values("concept_id", "concept_name", *_Filters._fields)
+    )
+    df = pd.DataFrame(
+        list(attributes), columns=["concept_id", "concept_name", *_Filters._fields]
+    )
+    df["matched_name"] = df["concept_id"].map(lambda i: best[i][0])
+    df["score"] = df["concept_id"].map(lambda i: best[i][1]).astype(float)
+    df = df.sort_values(["score", "concept_id"], ascending=[False, True])
+    return df[RESULT_COLUMNS].reset_index(drop=True)
@@ -0,0 +1,419 @@
+"""Person-id sharding of the high-volume event tables.
+
+:class:`~omop.ConditionOccurrence`, :class:`~omop.DrugExposure`,
+:class:`~omop.Measurement` and :class:`~omop.Observation` can be split into shards by
+the hash of `person_id`:
+
+- On Postgres, the tables are converted into declarative hash partitions. The
+  registries keep working as before and queries filtering on a single `person_id`
+  are pruned to one partition by the planner. The primary key is extended by
+  `person_id`, which hence must not change for an existing record. Every
+  partition lives in a schema of its own under the name of the table, which
+  :func:`shards` reads through a database alias that searches this schema first.
+- On SQLite, every shard is a separate database file next to the instance
+  database, attached under its own database alias. Records are written to their
+  shard by a database router; read them through :func:`for_person`, :func:`shards`
+  or :func:`map_shards`, reading a sharded registry without choosing a shard
+  raises an error. Related managers of a person, e.g. `person.measurement_set`,
+  read from the shard of the person. Queries on shards can join registries of the
+  instance database, foreign keys, however, are not enforced across files.
+  Records fetched from a shard are saved back with
+  `record.save(using=record._state.db)`.
+
+.. autosummary::
+   :toctree: .
+
+   enable
+   disable
+   n_shards
+   for_person
+   shards
+   map_shards
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable
+
+from django.db import connections, router, transaction
+from django.db.backends.signals import connection_created
+from lamin_utils import logger
+
+from ._utils import get_registry, partition_names, partition_strategy, rebuild_table
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from django.db.models import QuerySet
+    from lamindb.models import Record
+
+SHARDED_REGISTRIES = (
+    "ConditionOccurrence",
+    "DrugExposure",
+    "Measurement",
+    "Observation",
+)
+SHARD_KEY = "person_id"
+ALIAS_PREFIX = "omop_shard_"
+# schema name of the instance database within the connection to a SQLite shard
+INSTANCE_SCHEMA = "instance"
+
+_n_shards: int | None = None
+
+
+def _is_sharded(registry: type[Record]) -> bool:
+    return registry.__name__ in SHARDED_REGISTRIES and n_shards() > 1
+
+
+def _vendor() -> str:
+    return connections["default"].vendor
+
+
+def _alias(shard: int) -> str:
+    return f"{ALIAS_PREFIX}{shard}"
+
+
+def _shard_path(shard: int) -> Path:
+    path = Path(connections["default"].settings_dict["NAME"])
+    return path.with_name(f"{path.stem}.omop-shard-{shard}{path.suffix}")
+
+
+def _schema(shard: int) -> str:
+    """The Postgres schema of the partitions of a shard."""
+    return f"{ALIAS_PREFIX}{shard}"
+
+
+def _partition_table(registry: type[Record], shard: int) -> str:
+    qn = connections["default"].ops.quote_name
+    return f"{qn(_schema(shard))}.{qn(registry._meta.db_table)}"
+
+
+def _register_shards(n: int) -> None:
+    default = connections.settings["default"]
+    if _vendor() == "postgresql":
+        with connections["default"].cursor() as cursor:
+            cursor.execute("SELECT array_to_string(current_schemas(false), ',')")
+            (search_path,) = cursor.fetchone()
+    for shard in range(n):
+        if _vendor() == "postgresql":
+            # the partition of the shard shadows the parent table
+            options = default.get("OPTIONS", {})
+            settings = {
+                **default,
+                "OPTIONS": {
+                    **options,
+                    "options": f"{options.get('options', '')}"
+                    f" -c search_path={_schema(shard)},{search_path}".strip(),
+                },
+            }
+        else:
+            settings = {**default, "NAME": str(_shard_path(shard))}
+        connections.settings[_alias(shard)] = settings
+
+
+def _unregister_shards(n: int) -> None:
+    for shard in range(n):
+        alias = _alias(shard)
+        connections[alias].close()
+        del connections[alias]
+        del connections.settings[alias]
+
+
+def _on_connection_created(sender, connection, **kwargs) -> None:
+    if not connection.alias.startswith(ALIAS_PREFIX) or connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        # parent tables live in the instance database
+        cursor.execute("PRAGMA foreign_keys = OFF")
+        cursor.execute(
+            "ATTACH DATABASE %s AS " + INSTANCE_SCHEMA,
+            [connections["default"].settings_dict["NAME"]],
+        )
+
+
+def _routes(model: type[Record]) -> bool:
+    """Whether the records of a registry are split into SQLite shards."""
+    return (
+        model._meta.app_label == "omop"
+        and model.__name__ in SHARDED_REGISTRIES
+        and _vendor() == "sqlite"
+        and n_shards() > 1
+    )
+
+
+class ShardRouter:
+    """Route records of sharded registries on SQLite to the shard of their person.
+
+    Reads without a record that determines the shard raise a `ValueError`, as
+    they would only see the empty table of the instance database.
+    """
+
+    def db_for_read(self, model: type[Record], **hints: Any) -> str | None:
+        if not _routes(model):
+            return None
+        instance = hints.get("instance")
+        if instance is not None:
+            # related managers of records read from a shard
+            if (instance._state.db or "").startswith(ALIAS_PREFIX):
+                return instance._state.db
+            if isinstance(instance, get_registry("Person")):
+                return _alias(instance.pk % n_shards())
+            if isinstance(instance, model) and instance.person_id is not None:
+                return _alias(instance.person_id % n_shards())
+        raise ValueError(
+            f"{model.__name__} is split into {n_shards()} shards, read it through"
+            " omop.sharding.for_person(), shards() or map_shards()"
+        )
+
+    def db_for_write(self, model: type[Record], **hints: Any) -> str | None:
+        # related instances are passed as hints when assigning foreign keys
+        instance = hints.get("instance")
+        if not isinstance(instance, model) or not _routes(model):
+            return None
+        person_id = getattr(instance, SHARD_KEY)
+        if person_id is None:
+            # the instance database rejects the record like an unsharded table
+            return None
+        return _alias(person_id % n_shards())
+
+    def allow_migrate(self, db: str, app_label: str, **hints: Any) -> bool | None:
+        return False if db.startswith(ALIAS_PREFIX) else None
+
+
+def n_shards() -> int:
+    """Number of shards of the event tables, `1` if they are not sharded.
+
+    Examples:
+        >>> omop.sharding.n_shards()
+    """
+    global _n_shards
+    if _n_shards is None:
+        n = 0
+        if _vendor() == "postgresql":
+            registry = get_registry("Measurement")
+            if partition_strategy(registry) == "hash":
+                n = len(partition_names(registry))
+        else:
+            while _shard_path(n).exists():
+                n += 1
+        if n > 1:
+            _register_shards(n)
+        _n_shards = max(n, 1)
+    return _n_shards
+
+
+def _reshard_postgres(n: int, n_old: int) -> None:
+    connection = connections["default"]
+    qn = connection.ops.quote_name
+    with transaction.atomic(), connection.schema_editor() as editor:
+        for shard in range(n if n > 1 else 0):
+            editor.execute(f"CREATE SCHEMA IF NOT EXISTS {qn(_schema(shard))}")
+        for registry in map(get_registry, SHARDED_REGISTRIES):
+            if n == 1:
+                rebuild_table(editor, registry)
+                continue
+            rebuild_table(
+                editor,
+                registry,
+                partition_by=f"HASH ({SHARD_KEY})",
+                partitions=[
+                    (
+                        _partition_table(registry, shard),
+                        f"FOR VALUES WITH (MODULUS {n}, REMAINDER {shard})",
+                    )
+                    for shard in range(n)
+                ],
+                key=[SHARD_KEY],
+            )
+        for shard in range(n_old if n == 1 else 0):
+            editor.execute(f"DROP SCHEMA IF EXISTS {qn(_schema(shard))}")
+
+
+def _copy_sqlite(shard: int, n: int, *, to_shard: bool) -> None:
+    with transaction.atomic(using=_alias(shard)):
+        with connections[_alias(shard)].cursor() as cursor:
+            for registry in map(get_registry, SHARDED_REGISTRIES):
+                table = connections["default"].ops.quote_name(registry._meta.db_table)
+                if to_shard:
+                    cursor.execute(
+                        f"INSERT INTO main.{table} SELECT * FROM {INSTANCE_SCHEMA}.{table}"
+                        f" WHERE {SHARD_KEY} %% %s = %s",
+                        [n, shard],
+                    )
+                else:
+                    cursor.execute(
+                        f"INSERT INTO {INSTANCE_SCHEMA}.{table} SELECT * FROM main.{table}"
+                    )
+
+
+def _create_sqlite_shards(n: int) -> None:
+    default = connections["default"]
+    statements = []
+    with default.cursor() as cursor:
+        for registry in map(get_registry, SHARDED_REGISTRIES):
+            cursor.execute(
+                "SELECT sql FROM sqlite_master WHERE tbl_name = %s AND sql IS NOT NULL"
+                " ORDER BY type DESC",  # tables before indexes
+                [registry._meta.db_table],
+            )
+            statements += [sql for (sql,) in cursor.fetchall()]
+    _register_shards(n)
+    for shard in range(n):
+        with connections[_alias(shard)].cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+        _copy_sqlite(shard, n, to_shard=True)
+    with transaction.atomic(), default.cursor() as cursor:
+        for registry in map(get_registry, SHARDED_REGISTRIES):
+            cursor.execute(
+                f"DELETE FROM {default.ops.quote_name(registry._meta.db_table)}"
+            )
+
+
+def _remove_sqlite_shards(n: int) -> None:
+    for shard in range(n):
+        _copy_sqlite(shard, n, to_shard=False)
+    _unregister_shards(n)
+    for shard in range(n):
+        _shard_path(shard).unlink()
+
+
+def enable(n: int) -> None:
+    """Split the event tables into `n` shards by `person_id`.
+
+    Existing records are moved into their shards. Run this while no other process
+    writes to the instance. Migrations are not applied to shards, call
+    :func:`disable` before migrating the instance.
+
+    Args:
+        n: Number of shards, at least 2.
+
+    Examples:
+        >>> omop.sharding.enable(16)
+    """
+    global _n_shards
+    if n < 2:
+        raise ValueError("n needs to be at least 2, call disable() to remove shards")
+    if n_shards() > 1:
+        raise ValueError(f"tables are already split into {n_shards()} shards")
+    if _vendor() == "postgresql":
+        for registry in map(get_registry, SHARDED_REGISTRIES):
+            if partition_strategy(registry) is not None:
+                raise ValueError(
+                    f"{registry.__name__} is partitioned by date, call"
+                    " omop.partitioning.disable() first"
+                )
+        _reshard_postgres(n, 1)
+        _register_shards(n)
+    else:
+        _create_sqlite_shards(n)
+    _n_shards = n
+    logger.success(f"split {', '.join(SHARDED_REGISTRIES)} into {n} shards")
+
+
+def disable() -> None:
+    """Merge the shards of the event tables back into single tables.
+
+    Examples:
+        >>> omop.sharding.disable()
+    """
+    global _n_shards
+    n = n_shards()
+    if n == 1:
+        return
+    if _vendor() == "postgresql":
+        _unregister_shards(n)
+        _reshard_postgres(1, n)
+    else:
+        _remove_sqlite_shards(n)
+    _n_shards = 1
+    logger.success(f"merged {n} shards of {', '.join(SHARDED_REGISTRIES)}")
+
+
+def for_person(registry: type[Record] | str, person_id: int) -> QuerySet:
+    """Records of a person, read from the shard that holds them.
+
+    Works on all registries with a `person` field, sharded or not.
+
+    Args:
+        registry: The registry to query.
+        person_id: The id of the person.
+
+    Examples:
+        >>> omop.sharding.for_person(omop.Measurement, 42).filter(
+        ...     measurement_concept_id=3004501
+        ... )
+    """
+    registry = get_registry(registry)
+    queryset = registry.filter(**{SHARD_KEY: person_id})
+    if _is_sharded(registry) and _vendor() == "sqlite":
+        queryset = queryset.using(_alias(person_id % n_shards()))
+    # Postgres prunes partitions based on the `person_id` predicate itself
+    return queryset
+
+
+def shards(registry: type[Record] | str) -> list[QuerySet]:
+    """One queryset over all records per shard.
+
+    Returns a single queryset for registries that are not sharded.
+
+    Examples:
+        >>> [queryset.count() for queryset in omop.sharding.shards("Measurement")]
+    """
+    registry = get_registry(registry)
+    if not _is_sharded(registry):
+        return [registry.filter()]
+    return [registry.filter().using(_alias(shard)) for shard in range(n_shards())]
+
+
+def _run(func: Callable[[QuerySet], Any], queryset: QuerySet) -> Any:
+    try:
+        return func(queryset)
+    finally:
+        # every worker thread opens its own connections
+        connections.close_all()
+
+
+def map_shards(
+    func: Callable[[QuerySet], Any],
+    registry: type[Record] | str,
+    *,
+    max_workers: int | None = None,
+) -> list[Any]:
+    """Apply a function to every shard, one worker per shard.
+
+    Args:
+        func: Called with the queryset of a shard, see :func:`shards`.
+        registry: The registry to scan.
+        max_workers: Number of concurrent workers, defaults to the number of shards.
+
+    Returns:
+        The results of `func` in the order of the shards.
+
+    Examples:
+        >>> counts = omop.sharding.map_shards(
+        ...     lambda queryset: omop.query.fetch(queryset, ["value_as_number"])
+        ...     .value_as_number.describe(),
+        ...     omop.Measurement,
+        ... )
+    """
+    querysets = shards(registry)
+    with ThreadPoolExecutor(max_workers=max_workers or len(querysets)) as executor:
+        return list(executor.map(lambda queryset: _run(func, queryset), querysets))
+
+
+def _split_frame(
+    registry: type[Record], df: pd.DataFrame, column: str | None
+) -> list[tuple[str, pd.DataFrame]]:
+    """Split records by the database alias they are written to."""
+    if column is None or not _is_sharded(registry) or _vendor() != "sqlite":
+        return [(router.db_for_write(registry), df)]
+    shard = df[column] % n_shards()
+    return [(_alias(i), part) for i, part in df.groupby(shard, sort=True)]
+
+
+# shards are looked up on the first query of a sharded registry, the router routes
+# records to existing SQLite shards from the start of a session
+router.routers.append(ShardRouter())
+connection_created.connect(_on_connection_created, dispatch_uid="omop_shards")
@@ -0,0 +1,350 @@
+"""Map free-text source values to concepts in bulk.
+
+Source values like the lab names in `Measurement.measurement_source_value` are
+messy: `"HbA1c"`, `"Hemoglobin A1c "`, `"hemoglobin-a1c (blood)"`. A
+:class:`Standardizer` indexes the names and synonyms of the concepts of a domain
+once, then maps batches of strings to concepts in vectorized passes:
+
+1. Normalize: lowercase, replace punctuation by blanks, collapse whitespace, then
+   deduplicate.
+2. `exact`: the normalized value equals the normalized name of a concept.
+3. `synonym`: the normalized value equals a normalized synonym of a concept from
+   :class:`~omop.ConceptSynonym`.
+4. `fuzzy`: the name or synonym with the highest trigram similarity, see
+   :func:`omop.search.similarity`, computed for a batch of values at once as a
+   product of sparse trigram matrices.
+
+The result is a mapping table with one row per distinct value.
+
+.. autosummary::
+   :toctree: .
+
+   standardize
+   normalize
+   clear_cache
+   Standardizer
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+from lamin_utils import logger
+from scipy import sparse
+
+from ._utils import get_registry
+from .query import fetch
+from .search import _Filters, _trigrams
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+# values compared at a time in the fuzzy pass, bounds the memory of the product
+FUZZY_BATCH_SIZE = 2_000
+
+# trigrams of a larger fraction of names are compared only for candidate matches
+FREQUENT_TRIGRAMS = 0.002
+
+RESULT_COLUMNS = [
+    "source_value",
+    "concept_id",
+    "concept_name",
+    "matched_name",
+    "match_type",
+    "score",
+]
+
+# standardizers built so far per filters
+_standardizers: dict[_Filters, Standardizer] = {}
+
+
+def normalize(values: Iterable[str]) -> pd.Series:
+    """Lowercase, replace punctuation by blanks and collapse whitespace.
+
+    Examples:
+        >>> omop.standardize.normalize(["Hemoglobin-A1c ", "HbA1c"]).tolist()
+        ['hemoglobin a1c', 'hba1c']
+    """
+    series = pd.Series(values, dtype=object).astype(str)
+    return series.str.lower().str.replace(r"[\W_]+", " ", regex=True).str.strip()
+
+
+def _trigram_matrix(
+    names: Iterable[str], vocabulary: dict[str, int], *, extend: bool = False
+) -> tuple[sparse.csr_matrix, np.ndarray]:
+    """Names by trigrams, and the number of distinct trigrams per name.
+
+    Trigrams missing from the vocabulary are added if `extend`, and otherwise only
+    counted.
+    """
+    indptr, indices, counts = [0], [], []
+    for name in names:
+        trigrams = _trigrams(name)
+        counts.append(len(trigrams))
+        if extend:
+            indices.extend(vocabulary.setdefault(t, len(vocabulary)) for t in trigrams)
+        else:
+            indices.extend(vocabulary[t] for t in trigrams if t in vocabulary)
+        indptr.append(len(indices))
+    indices = np.array(indices, dtype=np.int32)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int32), indices, np.array(indptr)),
+        shape=(len(counts), len(vocabulary)),
+    )
+    return matrix, np.array(counts, dtype=np.int32)
+
+
+class Standardizer:
+    """An index of the names and synonyms of concepts to map strings to them.
+
+    Building the index reads all matching concepts and synonyms once, reuse the
+    standardizer for every batch of values.
+
+    Args:
+        domain_id: Only concepts of this domain, e.g. `"Measurement"`.
+        vocabulary_id: Only concepts of this vocabulary, e.g. `"LOINC"`.
+        standard_concept: Only concepts with this flag, `None` for all concepts.
+        fuzzy: Whether to index trigrams for the fuzzy pass.
+
+    Examples:
+        >>> standardizer = omop.standardize.Standardizer(domain_id="Measurement")
+        >>> mapping = standardizer.standardize(df["measurement_source_value"])
+    """
+
+    def __init__(
+        self,
+        *,
+        domain_id: str | None = None,
+        vocabulary_id: str | None = None,
+        standard_concept: str | None = "S",
+        fuzzy: bool = True,
+    ) -> None:
+        self.filters = _Filters(domain_id, vocabulary_id, standard_concept)
+        expressions = {
+            column: value
+            for column, value in self.filters._asdict().items()
+            if value is not None
+        }
+        concepts = fetch(
+            get_registry("Concept").filter(**expressions),
+            ["concept_id", "concept_name"],
+        )
+        synonyms = fetch(
+            get_registry("ConceptSynonym").filter(
+                **{f"concept__{column}": value for column, value in expressions.items()}
+            ),
+            ["concept_id", "concept_synonym_name"],
+        )
+        names = pd.concat(
+            [
+                concepts.assign(is_synonym=False),
+                synonyms.rename(
+                    columns={"concept_synonym_name": "concept_name"}
+                ).assign(is_synonym=True),
+            ],
+            ignore_index=True,
+        )
+        # names before synonyms and lower concept ids first resolve ties
+        names = names.sort_values(["is_synonym", "concept_id"], ignore_index=True)
+        self.concept_ids = names["concept_id"].to_numpy(np.int64)
+        self.names = names["concept_name"].to_numpy(object)
+        self.is_synonym = names["is_synonym"].to_numpy(bool)
+        self.concept_names = pd.Series(
+            concepts["concept_name"].to_numpy(object),
+            index=concepts["concept_id"].to_numpy(np.int64),
+        )
+        normalized = normalize(self.names)
+        self._exact = self._positions(normalized, ~self.is_synonym)
+        self._synonym = self._positions(normalized, self.is_synonym)
+        self._vocabulary: dict[str, int] = {}
+        self._matrix: sparse.csr_matrix | None = None
+        if fuzzy:
+            self._matrix, self._n_trigrams = _trigram_matrix(
+                normalized, self._vocabulary, extend=True
+            )
+            # trigrams by names, and the number of names per trigram
+            self._postings = self._matrix.T.tocsr()
+            self._frequency = np.diff(self._postings.indptr)
+            self._frequent = FREQUENT_TRIGRAMS * len(self.names)
+
+    @staticmethod
+    def _positions(normalized: pd.Series, mask: np.ndarray) -> pd.Series:
+        # the first position of every normalized name
+        positions = pd.Series(np.flatnonzero(mask), index=normalized[mask].to_numpy())
+        return positions[~positions.index.duplicated()]
+
+    def _split(
+        self, matrix: sparse.csr_matrix, counts: np.ndarray, min_score: float
+    ) -> tuple[sparse.csr_matrix, sparse.csr_matrix]:
+        """The frequent and the rare trigrams of values.
+
+        A name with a similarity of at least `min_score` to a value shares at least
+        `ceil(min_score * count)` of its `count` trigrams. Up to one less of them
+        are frequent, so that every match shares a rare trigram.
+        """
+        n_known = np.diff(matrix.indptr)
+        rows = np.repeat(np.arange(matrix.shape[0]), n_known)
+        frequency = self._frequency[matrix.indices]
+        # the most frequent trigrams of a value first
+        order = np.lexsort((-frequency, rows))
+        rank = np.arange(len(order)) - matrix.indptr[rows]
+        n_frequent = np.maximum(np.ceil(min_score * counts - 1e-9) - 1, 0)
+        is_frequent = (frequency[order] > self._frequent) & (rank < n_frequent[rows])
+        indices = matrix.indices[order]
+        return tuple(
+            sparse.csr_matrix(
+                (np.ones(int(mask.sum()), dtype=np.int32), (rows[mask], indices[mask])),
+                shape=matrix.shape,
+            )
+            for mask in [is_frequent, ~is_frequent]
+        )
+
+    def _fuzzy(
+        self, values: np.ndarray, min_score: float
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The best matching position per value, -1 below `min_score`, and its score."""
+        positions = np.full(len(values), -1, dtype=np.int64)
+        scores = np.full(len(values), np.nan)
+        for start in range(0, len(values), FUZZY_BATCH_SIZE):
+            batch = values[start : start + FUZZY_BATCH_SIZE]
+            matrix, counts = _trigram_matrix(batch, self._vocabulary)
+            frequent, rare = self._split(matrix, counts, min_score)
+            # the names that share rare trigrams, few compared to frequent ones
+            candidates = (rare @ self._postings).tocoo()
+            rows, columns = candidates.row, candidates.col
+            n_trigrams = counts[rows] + self._n_trigrams[columns]
+            # similarity >= min_score needs this many shared trigrams
+            needed = np.ceil(min_score * n_trigrams / (1 + min_score) - 1e-9)
+            keep = candidates.data + np.diff(frequent.indptr)[rows] >= needed
+            rows, columns = rows[keep], columns[keep]
+            n_trigrams, shared = n_trigrams[keep], candidates.data[keep]
+            if frequent.nnz:
+                shared = (
+                    shared
+                    + np.asarray(
+                        frequent[rows].multiply(self._matrix[columns]).sum(axis=1)
+                    ).ravel()
+                )
+            similarity = shared / (n_trigrams - shared)
+            keep = similarity >= min_score
+            rows, columns, similarity = rows[keep], columns[keep], similarity[keep]
+            # per row the highest similarity, the lowest position on ties
+            order = np.lexsort((columns, -similarity, rows))
+            rows, columns, similarity = rows[order], columns[order], similarity[order]
+            first = np.ones(len(rows), dtype=bool)
+            first[1:] = rows[1:] != rows[:-1]
+            positions[start + rows[first]] = columns[first]
+            scores[start + rows[first]] = similarity[first]
+        return positions, scores
+
+    def standardize(
+        self, values: Iterable[str], *, min_score: float = 0.5
+    ) -> pd.DataFrame:
+        """Map strings to concepts.
+
+        Args:
+            values: Source values, duplicates and missing values are dropped.
+            min_score: The minimal trigram similarity of fuzzy matches.
+
+        Returns:
+            One row per distinct value. `match_type` is `"exact"`, `"synonym"`,
+            `"fuzzy"` or missing for values without a match. `matched_name` is
+            the name or synonym that matched, `score` is 1 for exact and synonym
+            matches and the similarity for fuzzy matches.
+
+        Examples:
+            >>> mapping = standardizer.standardize(["HbA1c", "glucose (serum)"])
+        """
+        source_values = pd.Series(values, dtype=object).dropna().unique()
+        normalized = normalize(source_values).to_numpy(object)
+        # every pass resolves the values that the previous ones left
+        unique, inverse = np.unique(normalized, return_inverse=True)
+        positions = np.full(len(unique), -1, dtype=np.int64)
+        match_types = np.full(len(unique), None, dtype=object)
+        scores = np.full(len(unique), np.nan)
+        for match_type, index in [("exact", self._exact), ("synonym", self._synonym)]:
+            left = np.flatnonzero(positions < 0)
+            found = index.reindex(unique[left]).to_numpy(np.float64)
+            hits = ~np.isnan(found)
+            positions[left[hits]] = found[hits]
+            match_types[left[hits]] = match_type
+            scores[left[hits]] = 1.0
+        left = np.flatnonzero(positions < 0)
+        if self._matrix is not None and len(left):
+            fuzzy_positions, fuzzy_scores = self._fuzzy(unique[left], min_score)
+            hits = fuzzy_positions >= 0
+            positions[left[hits]] = fuzzy_positions[hits]
+            match_types[left[hits]] = "fuzzy"
+            scores[left[hits]] = fuzzy_scores[hits]
+        positions, match_types, scores = (
+            positions[inverse],
+            match_types[inverse],
+            scores[inverse],
+        )
+        matched = positions >= 0
+        # unmatched values don't index the names, which can be empty
+        concept_ids = np.zeros(len(positions), dtype=np.int64)
+        concept_ids[matched] = self.concept_ids[positions[matched]]
+        matched_names = np.full(len(positions), None, dtype=object)
+        matched_names[matched] = self.names[positions[matched]]
+        df = pd.DataFrame(
+            {
+                "source_value": source_values,
+                "concept_id": pd.array(
+                    np.where(matched, concept_ids, None), dtype="Int64"
+                ),
+                "concept_name": np.where(
+                    matched, self.concept_names.reindex(concept_ids).to_numpy(), None
+                ),
+                "matched_name": matched_names,
+                "match_type": match_types,
+                "score": scores,
+            }
+        )
+        n_matched = int(matched.sum())
+        logger.info(f"mapped {n_matched} of {len(df)} distinct values to concepts")
+        return df[RESULT_COLUMNS]
+
+
+def standardize(
+    values: Iterable[str],
+    *,
+    domain_id: str | None = None,
+    vocabulary_id: str | None = None,
+    standard_concept: str | None = "S",
+    min_score: float = 0.5,
+) -> pd.DataFrame:
+    """Map strings to concepts, see :meth:`Standardizer.standardize`.
+
+    The :class:`Standardizer` of the filters is built on the first call and
+    reused afterwards, call :func:`clear_cache` after loading a vocabulary.
+
+    Args:
+        values: Source values, duplicates and missing values are dropped.
+        domain_id: Only concepts of this domain, e.g. `"Measurement"`.
+        vocabulary_id: Only concepts of this vocabulary, e.g. `"LOINC"`.
+        standard_concept: Only concepts with this flag, `None` for all concepts.
+        min_score: The minimal trigram similarity of fuzzy matches.
+
+    Examples:
+        >>> values = omop.query.fetch(omop.Measurement, ["measurement_source_value"])
+        >>> mapping = omop.standardize.standardize(
+        ...     values["measurement_source_value"], domain_id="Measurement"
+        ... )
+        >>> mapping[mapping["match_type"] != "exact"]
+    """
+    filters = _Filters(domain_id, vocabulary_id, standard_concept)
+    if filters not in _standardizers:
+        _standardizers[filters] = Standardizer(**filters._asdict())
+    return _standardizers[filters].standardize(values, min_score=min_score)
+
+
+def clear_cache() -> None:
+    """Remove the standardizers that :func:`standardize` built.
+
+    Examples:
+        >>> omop.standardize.clear_cache()
+    """
+    _standardizers.clear()
@@ -0,0 +1,104 @@
+import lamindb_setup as ln_setup
+import pytest
+
+
+def pytest_sessionstart():
+    ln_setup.init(storage="./testdb", schema="omop")
+
+
+def pytest_sessionfinish(session: pytest.Session):
+    ln_setup.delete("testdb", force=True)
+
+
+@pytest.fixture(autouse=True)
+def clean_omop():
+    yield
+    from django.db import connection
+    from omop._utils import omop_registries, unfiltered
+
+    with connection.constraint_checks_disabled():
+        for registry in omop_registries():
+            unfiltered(registry).delete()
+
+
+@pytest.fixture
+def concept():
+    import omop
+
+    def create(
+        concept_id: int, concept_name: str, domain_id: str = "Metadata", **kwargs
+    ):
+        return omop.Concept(
+            concept_id=concept_id,
+            concept_name=concept_name,
+            domain_id=domain_id,
+            vocabulary_id=kwargs.pop("vocabulary_id", "None"),
+            concept_class=kwargs.pop("concept_class", "Undefined"),
+            concept_code=kwargs.pop("concept_code", str(concept_id)),
+            valid_start_date="1970-01-01",
+            valid_end_date="2099-12-31",
+            **kwargs,
+        ).save()
+
+    return create
+
+
+@pytest.fixture
+def events(concept):
+    import omop
+
+    gender = concept(8532, "FEMALE", "Gender")
+    diabetes = concept(201826, "Type 2 diabetes mellitus", "Condition")
+    glucose = concept(3004501, "Glucose", "Measurement")
+    for person_id in [1, 2]:
+        omop.Person(
+            person_id=person_id,
+            gender_concept=gender,
+            year_of_birth=1980,
+            race_concept=gender,
+            ethnicity_concept=gender,
+        ).save()
+    omop.ConditionOccurrence(
+        condition_occurrence_id=1,
+        person_id=1,
+        condition_concept=diabetes,
+        condition_type_concept=diabetes,
+        condition_start_date="2020-01-02",
+        condition_end_date="2020-03-01",
+    ).save()
+    for measurement_id, person_id, date in [
+        (1, 1, "2020-01-01"),
+        (2, 1, "2020-01-03"),
+        (3, 2, "2020-01-01"),
+    ]:
+        omop.Measurement(
+            measurement_id=measurement_id,
+            person_id=person_id,
+            measurement_concept=glucose,
+            measurement_type_concept=glucose,
+            measurement_date=date,
+        ).save()
+
+
+@pytest.fixture
+def notes(events, concept):
+    import omop
+
+    note_type = concept(32831, "EHR note", "Type Concept")
+    texts = [
+        "Patient with type 2 diabetes mellitus, glucose elevated.",
+        "Follow-up visit. " * 100,
+        "",
+    ]
+    for note_id, text in enumerate(texts, start=1):
+        omop.Note(
+            note_id=note_id,
+            person_id=1,
+            note_date="2020-01-02",
+            note_type_concept=note_type,
+            note_class_concept=note_type,
+            note_text=text,
+            encoding_concept=note_type,
+            language_concept=note_type,
+        ).save()
+    return texts
@@ -0,0 +1,68 @@
+import asyncio
+
+import omop
+import pytest
+
+
+def run(coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await omop.aio.close()
+
+    return asyncio.run(main())
+
+
+def test_afilter(events):
+    persons = run(omop.aio.afilter(omop.Person, year_of_birth=1980))
+    assert sorted(person.person_id for person in persons) == [1, 2]
+    assert persons[0]._state.db == "default"
+
+    measurements = run(
+        omop.aio.afilter(
+            omop.Measurement.filter(person_id=1).order_by("-measurement_date")
+        )
+    )
+    assert [m.measurement_id for m in measurements] == [2, 1]
+    assert measurements[0].measurement_date.isoformat() == "2020-01-03"
+
+    # the SQL of date lookups calls functions that Django registers on SQLite
+    measurements = run(omop.aio.afilter(omop.Measurement, measurement_date__week_day=6))
+    assert sorted(m.measurement_id for m in measurements) == [2]
+    assert run(omop.aio.afilter("Measurement", measurement_id__in=[])) == []
+    with pytest.raises(ValueError):
+        run(omop.aio.afilter(omop.Person.filter().values("person_id")))
+
+
+def test_aget(events):
+    person = run(omop.aio.aget(omop.Person, person_id=2))
+    assert person.year_of_birth == 1980
+    with pytest.raises(omop.Person.DoesNotExist):
+        run(omop.aio.aget(omop.Person, person_id=3))
+    with pytest.raises(omop.Person.MultipleObjectsReturned):
+        run(omop.aio.aget(omop.Person))
+
+
+def test_astream(events):
+    async def collect():
+        return [
+            df
+            async for df in omop.aio.astream(
+                omop.Measurement.filter().order_by("measurement_id"),
+                ["measurement_id", "measurement_date"],
+                batch_size=2,
+            )
+        ]
+
+    batches = run(collect())
+    assert [len(df) for df in batches] == [2, 1]
+    assert batches[1]["measurement_date"].dt.day.tolist() == [1]
+
+
+def test_atimeline(events):
+    async def timelines():
+        return await asyncio.gather(*(omop.aio.atimeline(i) for i in [1, 2]))
+
+    for person_id, df in zip([1, 2], run(timelines())):
+        assert df.equals(omop.events.timeline(person_id))
@@ -0,0 +1,71 @@
+import omop
+from omop._utils import unfiltered
+
+
+def concept(concept_id, name, domain_id="Gender"):
+    return omop.Concept(
+        concept_id=concept_id,
+        concept_name=name,
+        domain_id=domain_id,
+        vocabulary_id="Test",
+        concept_class="Test",
+        concept_code=str(concept_id),
+        valid_start_date="1970-01-01",
+        valid_end_date="2099-12-31",
+    ).save()
+
+
+def test_refresh_and_results():
+    female, male = concept(8532, "FEMALE"), concept(8507, "MALE")
+    glucose = concept(3004501, "Glucose", "Measurement")
+    for person_id, gender, year in [
+        (1, female, 1980),
+        (2, male, 1980),
+        (3, female, 1990),
+    ]:
+        omop.Person(
+            person_id=person_id,
+            gender_concept=gender,
+            year_of_birth=year,
+            race_concept=gender,
+            ethnicity_concept=gender,
+        ).save()
+    for measurement_id, value in enumerate([0.1, 0.11, 0.9]):
+        omop.Measurement(
+            measurement_id=measurement_id,
+            person_id=1,
+            measurement_concept=glucose,
+            measurement_type_concept=glucose,
+            measurement_date="2020-01-01",
+            value_as_number=value,
+        ).save()
+
+    refreshed = omop.characterization.refresh([0, 2, 10, 1801, 1815])
+    assert refreshed == [0, 2, 10, 1801, 1815]
+    assert omop.characterization.results(0)["count_value"].tolist() == [3]
+    by_gender = omop.characterization.results(2).set_index("stratum_1")
+    assert by_gender.loc["8532", "count_value"] == 2
+    histogram = omop.characterization.results(1815)
+    assert histogram["count_value"].sum() == 3
+    assert histogram["count_value"].tolist() == [2, 1]
+
+    # nothing changed, nothing to recompute
+    assert omop.characterization.refresh([0, 2, 1815]) == []
+    omop.Person(
+        person_id=4,
+        gender_concept=male,
+        year_of_birth=2000,
+        race_concept=male,
+        ethnicity_concept=male,
+    ).save()
+    assert omop.characterization.refresh([0, 2, 1815]) == [0, 2]
+    assert omop.characterization.results(0)["count_value"].tolist() == [4]
+
+    for registry in [
+        omop.AchillesResult,
+        omop.AchillesAnalysis,
+        omop.Measurement,
+        omop.Person,
+        omop.Concept,
+    ]:
+        unfiltered(registry).delete()
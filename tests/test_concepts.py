@@ -0,0 +1,137 @@
+import omop
+import pandas as pd
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    omop.concepts.clear_cache()
+    yield
+    omop.concepts.clear_cache()
+
+
+def test_concept_fields():
+    assert omop.concepts.concept_fields("Death") == [
+        "death_type_concept",
+        "cause_concept",
+        "cause_source_concept",
+    ]
+
+
+def test_select_concepts(events):
+    queryset = omop.concepts.select_concepts(
+        omop.Measurement.filter(),
+        [
+            "measurement_concept__concept_name",
+            "person__gender_concept",
+            "person_id",
+            "value_as_number",
+        ],
+    )
+    assert queryset.query.select_related == {
+        "measurement_concept": {},
+        "person": {"gender_concept": {}},
+    }
+    with omop.profiling.profile() as profile:
+        names = [
+            (m.measurement_concept.concept_name, m.person.gender_concept.concept_name)
+            for m in queryset
+        ]
+    assert names == [("Glucose", "FEMALE")] * 3
+    assert len(profile.queries) == 1
+
+    queryset = omop.concepts.select_concepts(
+        omop.Person, ["conditionoccurrence__condition_concept"]
+    )
+    assert queryset._prefetch_related_lookups == (
+        "conditionoccurrence_set__condition_concept",
+    )
+    with omop.profiling.profile() as profile:
+        names = {
+            person.person_id: [
+                condition.condition_concept.concept_name
+                for condition in person.conditionoccurrence_set.all()
+            ]
+            for person in queryset
+        }
+    assert names == {1: ["Type 2 diabetes mellitus"], 2: []}
+    # persons, their conditions and the concepts of the conditions
+    assert len(profile.queries) == 3
+    queryset = omop.concepts.select_concepts("Measurement")
+    assert "unit_concept" in queryset.query.select_related
+
+
+def test_decode(events, monkeypatch):
+    df = omop.query.fetch(
+        omop.Measurement.filter().order_by("measurement_id"),
+        ["measurement_id", "measurement_concept_id", "unit_concept_id"],
+    )
+    with omop.profiling.profile() as profile:
+        decoded = omop.concepts.decode(df)
+        omop.concepts.decode(df)
+    assert len(profile.queries) == 1
+    assert decoded.columns.tolist() == [
+        "measurement_id",
+        "measurement_concept_id",
+        "measurement_concept_name",
+        "unit_concept_id",
+        "unit_concept_name",
+    ]
+    assert decoded["measurement_concept_name"].tolist() == ["Glucose"] * 3
+    assert decoded["unit_concept_name"].isna().all()
+    assert "measurement_concept_name" not in df
+
+    assert omop.concepts.concept_names([8532, 1]) == {8532: "FEMALE"}
+    concept = omop.Concept.get(concept_id=8532)
+    concept.concept_name = "Female"
+    concept.save()
+    assert omop.concepts.concept_names([8532]) == {8532: "Female"}
+    # bulk writes send no post_save
+    df = omop.query.fetch(omop.Concept.filter(concept_id=8532))
+    omop.load.merge(omop.Concept, df.assign(concept_name="female"))
+    assert omop.concepts.concept_names([8532]) == {8532: "female"}
+
+    # the least recently used names are evicted
+    monkeypatch.setattr(omop.concepts._names, "maxsize", 2)
+    omop.concepts.clear_cache()
+    for concept_id in [8532, 3004501, 201826, 8532]:
+        omop.concepts.concept_names([concept_id])
+    assert list(omop.concepts._names) == [201826, 8532]
+
+
+def test_concept_cache(concept, tmp_path):
+    empty = omop.concepts.ConceptCache(omop.concepts.build_cache(tmp_path / "cache"))
+    assert len(empty) == 0
+    assert empty.names([8532]) == {}
+
+    concept(8532, "FEMALE", "Gender")
+    concept(3004501, "Glucose", "Measurement", standard_concept="S")
+    concept(4, "Kilogram", "Unit", vocabulary_id="UCUM")
+    path = omop.concepts.build_cache(tmp_path / "cache", batch_size=2)
+    # processes that attached before the rebuild keep the old snapshot
+    assert len(empty) == 0
+
+    cache = omop.concepts.attach_cache(path)
+    assert cache.meta["n_concepts"] == len(cache) == 3
+    assert cache.concept_ids.tolist() == [4, 8532, 3004501]
+    df = cache.lookup([3004501, 1, 4, 3004501])
+    assert df["concept_id"].tolist() == [3004501, 1, 4, 3004501]
+    assert df.loc[1].drop("concept_id").isna().all()
+    found = df.drop(index=1)
+    assert found["concept_name"].tolist() == ["Glucose", "Kilogram", "Glucose"]
+    assert found["domain_id"].tolist() == ["Measurement", "Unit", "Measurement"]
+    assert found["vocabulary_id"].tolist() == ["None", "UCUM", "None"]
+    assert found["standard_concept"].isna().tolist() == [False, True, False]
+    assert cache.lookup([4], ["concept_class"]).columns.tolist() == [
+        "concept_id",
+        "concept_class",
+    ]
+    with pytest.raises(ValueError):
+        cache.lookup([4], ["concept_code"])
+
+    df = pd.DataFrame({"unit_concept_id": pd.array([4, None, 8532], dtype="Int64")})
+    with omop.profiling.profile() as profile:
+        decoded = omop.concepts.decode(df)
+    assert profile.queries == []
+    assert decoded["unit_concept_name"].isna().tolist() == [False, True, False]
+    assert decoded["unit_concept_name"][[0, 2]].tolist() == ["Kilogram", "FEMALE"]
@@ -0,0 +1,152 @@
+import omop
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def costs(events, concept):
+    omop.costs.clear_cache()
+    cost_type = concept(32814, "Adjudicated claim", "Type Concept")
+    for domain_id in ["Condition", "Measurement", "Payer", "Specimen", "Visit"]:
+        omop.Domain(
+            domain_id=domain_id, domain_name=domain_id, domain_concept=cost_type
+        ).save()
+
+    def create(cost_id, event_id, domain_id, total_charge, total_paid=None):
+        omop.Cost(
+            cost_id=cost_id,
+            cost_event_id=event_id,
+            cost_domain_id=domain_id,
+            cost_type_concept=cost_type,
+            total_charge=total_charge,
+            total_paid=total_paid,
+        ).save()
+
+    for row in [
+        (1, 1, "Measurement", 0.25, 0.125),
+        (2, 2, "Measurement", 0.5),
+        (3, 3, "Measurement", 0.125),
+        (4, 1, "Condition", 0.0625),
+        (5, 7, "Visit", 0.5),
+    ]:
+        create(*row)
+    yield create
+    omop.costs.clear_cache()
+
+
+def test_rollup(costs):
+    df = omop.costs.rollup("domain")
+    assert df.columns.tolist() == [
+        "cost_domain_id",
+        "currency_concept_id",
+        "n_records",
+        *omop.costs.MONETARY_COLUMNS,
+    ]
+    df = df.set_index("cost_domain_id")
+    assert df.loc["Measurement", "n_records"] == 3
+    assert df.loc["Measurement", "total_charge"] == 0.875
+    assert df.loc["Measurement", "total_paid"] == 0.125
+    assert pd.isna(df.loc["Condition", "total_paid"])
+
+    # the visit doesn't exist
+    df = omop.costs.rollup("person_year")
+    assert df["person_id"].tolist() == [1, 2, pd.NA]
+    assert df["year"].tolist() == [2020, 2020, pd.NA]
+    assert df["n_records"].tolist() == [3, 1, 1]
+    assert df["total_charge"].tolist() == [0.8125, 0.125, 0.5]
+
+    # the measurements and the condition have no visit
+    df = omop.costs.rollup("visit")
+    assert df["n_records"].tolist() == [1, 4]
+    assert df["visit_occurrence_id"].tolist() == [7, pd.NA]
+
+
+def test_rollup_without_events(costs):
+    # a domain without an event registry, and a registry without visits
+    costs(6, 1, "Payer", 0.25)
+    costs(7, 1, "Specimen", 0.125)
+    df = omop.costs.rollup("visit")
+    assert df["visit_occurrence_id"].tolist() == [7, pd.NA]
+    assert df["n_records"].tolist() == [1, 6]
+    df = omop.costs.rollup("person_year")
+    assert df["person_id"].tolist() == [1, 2, pd.NA]
+    assert df["n_records"].tolist() == [3, 1, 3]
+    assert df["total_charge"].tolist() == [0.8125, 0.125, 0.875]
+
+
+def test_refresh(costs):
+    assert set(omop.costs.refresh().values()) == {"full"}
+    assert set(omop.costs.refresh().values()) == {"unchanged"}
+
+    costs(6, 3, "Measurement", 0.25)
+    assert omop.costs.refresh(["person_year"]) == {"person_year": "incremental"}
+    df = omop.costs.rollup("person_year", cached=True)
+    assert df["n_records"].tolist() == [3, 2, 1]
+    assert df["total_charge"].tolist() == [0.8125, 0.375, 0.5]
+    assert omop.costs.rollup("person_year").equals(df)
+
+    # changed and deleted costs are recomputed
+    delta = pd.DataFrame(
+        {
+            "cost_id": [2],
+            "cost_event_id": [2],
+            "cost_domain_id": ["Measurement"],
+            "cost_type_concept_id": [32814],
+            "total_charge": [0.75],
+        }
+    )
+    omop.load.merge(omop.Cost, delta)
+    assert omop.costs.refresh(["domain"]) == {"domain": "full"}
+    omop.Cost.filter(cost_id=1).delete()
+    assert omop.costs.refresh(["person_year"]) == {"person_year": "full"}
+    df = omop.costs.rollup("person_year", cached=True)
+    assert df["total_charge"].tolist() == [0.8125, 0.375, 0.5]
+    with pytest.raises(ValueError):
+        omop.costs.refresh(["payer"])
+
+    # saving a cost doesn't refresh updated_at, the checksums detect it
+    omop.costs.refresh(["domain"])
+    assert omop.costs.refresh(["domain"]) == {"domain": "unchanged"}
+    cost = omop.Cost.get(cost_id=3)
+    cost.total_charge = 0.5
+    cost.save()
+    assert omop.costs.refresh(["domain"]) == {"domain": "full"}
+    cost.total_charge = 0.25
+    cost.save()
+    costs(7, 3, "Measurement", 0.25)
+    assert omop.costs.refresh(["domain"]) == {"domain": "full"}
+    df = omop.costs.rollup("domain", cached=True).set_index("cost_domain_id")
+    assert df.loc["Measurement", "total_charge"] == 1.5
+
+    # changing the domain of a cost in place
+    omop.costs.refresh(["domain"])
+    omop.Cost.filter(cost_id=3).update(cost_domain_id="Condition")
+    assert omop.costs.refresh(["domain"]) == {"domain": "full"}
+
+
+def test_refresh_concurrent(costs, monkeypatch):
+    omop.costs.refresh(["domain"])
+    source_state = omop.costs._source_state
+    added = []
+
+    def add_after_state():
+        # a cost that lands between taking the state and aggregating
+        state = source_state()
+        cost_id = 7 + len(added)
+        costs(cost_id, 3, "Measurement", 0.25)
+        added.append(cost_id)
+        return state
+
+    def measurements():
+        df = omop.costs.rollup("domain", cached=True).set_index("cost_domain_id")
+        return df.loc["Measurement", ["n_records", "total_charge"]].tolist()
+
+    costs(6, 3, "Measurement", 0.25)
+    monkeypatch.setattr(omop.costs, "_source_state", add_after_state)
+    assert omop.costs.refresh(["domain"]) == {"domain": "incremental"}
+    assert measurements() == [4, 1.125]
+    assert omop.costs.refresh(["domain"], force=True) == {"domain": "full"}
+    assert measurements() == [5, 1.375]
+    monkeypatch.setattr(omop.costs, "_source_state", source_state)
+    assert omop.costs.refresh(["domain"]) == {"domain": "incremental"}
+    assert measurements() == [6, 1.625]
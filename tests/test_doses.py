@@ -0,0 +1,149 @@
+import omop
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def exposures(events, concept):
+    for unit_id, name in [
+        (8576, "milligram"),
+        (8504, "gram"),
+        (9655, "microgram"),
+        (8587, "milliliter"),
+        (8505, "hour"),
+    ]:
+        concept(unit_id, name, "Unit")
+    concept(1503297, "metformin", "Drug")
+    concept(1154029, "fentanyl", "Drug")
+    concept(32838, "EHR prescription", "Type Concept")
+    for drug_id in range(1001, 1007):
+        concept(drug_id, f"drug {drug_id}", "Drug")
+    # the decimal columns of the registries only store values below 1
+    strengths = pd.DataFrame(
+        [
+            # 0.5 g tablet
+            (1, 1001, 1503297, 0.5, 8504, None, None, None, None),
+            # 0.1 g/mL oral solution
+            (2, 1002, 1503297, None, None, 0.1, 8504, None, 8587),
+            # 0.5 ug/h patch
+            (3, 1003, 1154029, None, None, 0.5, 9655, None, 8505),
+            # 0.5 mg per 0.1 mL injection
+            (4, 1004, 1154029, None, None, 0.5, 8576, 0.1, 8587),
+            # 0.3 mg patch over 0.5 h
+            (5, 1005, 1154029, None, None, 0.3, 8576, 0.5, 8505),
+        ],
+        columns=[
+            "id",
+            "drug_concept_id",
+            "ingredient_concept_id",
+            "amount_value",
+            "amount_unit_concept_id",
+            "numerator_value",
+            "numerator_unit_concept_id",
+            "denominator_value",
+            "denominator_unit_concept_id",
+        ],
+    )
+    strengths["valid_start_date"] = "1970-01-01"
+    strengths["valid_end_date"] = "2099-12-31"
+    omop.load.merge(omop.DrugStrength, strengths)
+    exposures = pd.DataFrame(
+        [
+            (1, 1001, 0.6, 30, "2020-01-30"),
+            (2, 1002, 0.5, None, "2020-01-10"),
+            (3, 1003, 0.1, 30, "2020-01-30"),
+            (4, 1004, 0.2, 0, "2020-01-01"),
+            (5, 1005, 0.1, 30, "2020-01-30"),
+            (6, 1006, 0.1, 30, "2020-01-30"),
+            (7, 1001, None, 30, "2020-01-30"),
+        ],
+        columns=[
+            "drug_exposure_id",
+            "drug_concept_id",
+            "quantity",
+            "days_supply",
+            "drug_exposure_end_date",
+        ],
+    )
+    exposures["days_supply"] = exposures["days_supply"].astype("Int64")
+    exposures["person_id"] = 1
+    exposures["drug_exposure_start_date"] = "2020-01-01"
+    exposures["drug_type_concept_id"] = 32838
+    omop.load.merge(omop.DrugExposure, exposures)
+
+
+def test_daily_doses(exposures):
+    df = omop.doses.fetch(batch_size=3)
+    assert df.columns.tolist() == omop.doses.DOSE_COLUMNS
+    df = df.set_index("drug_exposure_id")
+    assert df.index.sort_values().tolist() == [1, 2, 3, 4, 5, 7]
+    assert df["pattern"].to_dict() == {
+        1: "fixed_amount",
+        2: "concentration",
+        3: "time_based",
+        4: "quantified",
+        5: "time_based",
+        7: "fixed_amount",
+    }
+    # 0.6 tablets of 500 mg over 30 days
+    assert df.loc[1, "daily_dose"] == pytest.approx(10)
+    # 0.5 mL of 100 mg/mL over the 10 days of the exposure
+    assert df.loc[2, "daily_dose"] == pytest.approx(5)
+    # 0.5 ug/h
+    assert df.loc[3, "daily_dose"] == pytest.approx(0.012)
+    # 0.2 injections of 0.5 mg in a day, without days of supply
+    assert df.loc[4, "daily_dose"] == pytest.approx(0.1)
+    # 0.3 mg over less than a day
+    assert df.loc[5, "daily_dose"] == pytest.approx(0.3)
+    assert pd.isna(df.loc[7, "daily_dose"])
+    assert df["unit_concept_id"].unique().tolist() == [8576]
+
+    df = omop.doses.fetch(
+        omop.DrugExposure.filter(drug_exposure_id__lt=3),
+        ingredient_concept_ids=[1503297],
+    )
+    assert df["drug_exposure_id"].tolist() == [1, 2]
+    assert omop.doses.fetch(ingredient_concept_ids=[1]).empty
+
+
+def test_strength_versions(exposures):
+    # the 0.5 g tablet since 2020, its earlier version and a deprecated duplicate
+    strengths = pd.DataFrame(
+        [
+            (1, 1001, 1503297, 0.5, 8504, "2020-01-01", "2099-12-31", None),
+            (6, 1001, 1503297, 0.25, 8504, "1970-01-01", "2019-12-31", "U"),
+            (7, 1001, 1503297, 0.1, 8504, "1970-01-01", "2099-12-31", "D"),
+        ],
+        columns=[
+            "id",
+            "drug_concept_id",
+            "ingredient_concept_id",
+            "amount_value",
+            "amount_unit_concept_id",
+            "valid_start_date",
+            "valid_end_date",
+            "invalid_reason",
+        ],
+    )
+    omop.load.merge(omop.DrugStrength, strengths)
+    omop.load.merge(
+        omop.DrugExposure,
+        pd.DataFrame(
+            {
+                "drug_exposure_id": [8],
+                "person_id": [1],
+                "drug_concept_id": [1001],
+                "drug_exposure_start_date": ["2019-06-01"],
+                "drug_exposure_end_date": ["2019-06-30"],
+                "drug_type_concept_id": [32838],
+                "quantity": [0.6],
+                "days_supply": [30],
+            }
+        ),
+    )
+    df = omop.doses.fetch(omop.DrugExposure.filter(drug_concept_id=1001))
+    df = df.set_index("drug_exposure_id")
+    assert df.index.sort_values().tolist() == [1, 7, 8]
+    # 0.6 tablets of 500 mg, and of 250 mg before 2020, over 30 days
+    assert df.loc[1, "daily_dose"] == pytest.approx(10)
+    assert df.loc[8, "daily_dose"] == pytest.approx(5)
@@ -0,0 +1,62 @@
+import omop
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+def test_trees(events, concept):
+    cancer = concept(4028717, "Disease Episode", "Episode")
+    condition_field = concept(1147127, "condition_occurrence.condition_occurrence_id")
+    measurement_field = concept(1147138, "measurement.measurement_id")
+    for episode_id, person_id, parent_id, number, start_date in [
+        (10, 1, None, 1, "2020-01-01"),
+        (11, 1, 10, 2, "2020-01-01"),
+        (12, 1, 10, 1, "2020-02-01"),
+        (13, 2, 10, None, "2020-01-01"),
+    ]:
+        omop.Episode(
+            episode_id=episode_id,
+            person_id=person_id,
+            episode_concept=cancer,
+            episode_start_date=start_date,
+            episode_parent_id=parent_id,
+            episode_number=number,
+            episode_object_concept=cancer,
+            episode_type_concept=cancer,
+        ).save()
+    for episode_id, event_id, field in [
+        (12, 1, condition_field),
+        (10, 2, measurement_field),
+        (10, 1, measurement_field),
+    ]:
+        omop.EpisodeEvent(
+            episode_id=episode_id,
+            event_id=event_id,
+            episode_event_field_concept=field,
+        ).save()
+
+    omop.concepts.clear_cache()
+    with CaptureQueriesContext(connection) as queries:
+        trees = omop.episodes.trees([1, 2, 3])
+    # episodes, episode events, field concepts, measurements and conditions
+    sql = [query["sql"] for query in queries.captured_queries]
+    assert len([statement for statement in sql if '"omop_' in statement]) == 5
+    assert list(trees) == [1, 2]
+    [root] = trees[1]
+    assert root.episode_id == 10
+    assert root.episode_number == 1
+    assert [child.episode_id for child in root.children] == [12, 11]
+    assert root.events.columns.tolist() == omop.events.RESOLVED_COLUMNS
+    assert root.events["event_id"].tolist() == [1, 2]
+    assert root.events["registry"].unique().tolist() == ["Measurement"]
+    [child, _] = root.children
+    assert child.events[["registry", "concept_id"]].values.tolist() == [
+        ["ConditionOccurrence", 201826]
+    ]
+    assert root.children[1].events.empty
+    # the parent is an episode of another person
+    assert [episode.episode_id for episode in trees[2]] == [13]
+    assert trees[2][0].episode_number is None
+
+    trees = omop.episodes.trees([1], events=False)
+    assert trees[1][0].events.empty
+    assert omop.episodes.trees([]) == {}
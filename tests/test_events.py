@@ -0,0 +1,79 @@
+import omop
+import pandas as pd
+import pytest
+
+
+def test_timeline(events):
+    df = omop.events.timeline(1)
+    assert df.columns.tolist() == omop.events.TIMELINE_COLUMNS
+    assert df["registry"].tolist() == [
+        "Measurement",
+        "ConditionOccurrence",
+        "Measurement",
+    ]
+    assert df["event_id"].tolist() == [1, 1, 2]
+    assert df["end_date"].isna().tolist() == [True, False, True]
+
+    df = omop.events.timeline(2, [omop.Measurement, "ConditionOccurrence"])
+    assert df["event_id"].tolist() == [3]
+
+    assert omop.events.timeline(3).empty
+
+
+def test_resolve(events, concept):
+    condition = concept(19, "Condition", "Metadata", concept_class="Domain")
+    measurement = concept(21, "Measurement", "Metadata", concept_class="Domain")
+    field = concept(1147127, "condition_occurrence.condition_occurrence_id")
+    for domain, domain_concept in [
+        ("Condition", condition),
+        ("Measurement", measurement),
+    ]:
+        omop.Domain(
+            domain_id=domain, domain_name=domain, domain_concept=domain_concept
+        ).save()
+    for cost_id, event_id, domain_id in [
+        (1, 2, "Measurement"),
+        (2, 1, "Condition"),
+        (3, 99, "Measurement"),
+    ]:
+        omop.Cost(
+            cost_id=cost_id,
+            cost_event_id=event_id,
+            cost_domain_id=domain_id,
+            cost_type_concept=field,
+        ).save()
+
+    df = omop.events.resolve(omop.Cost)
+    assert df.columns.tolist() == ["cost_id", *omop.events.RESOLVED_COLUMNS]
+    df = df.sort_values("cost_id")
+    assert df["registry"].tolist() == [
+        "Measurement",
+        "ConditionOccurrence",
+        "Measurement",
+    ]
+    assert df["person_id"].tolist()[:2] == [1, 1]
+    assert df["concept_id"].tolist()[:2] == [3004501, 201826]
+    assert df["end_date"].isna().tolist() == [True, False, True]
+    # the event doesn't exist
+    assert pd.isna(df["person_id"].iloc[2])
+
+    omop.Measurement.filter(measurement_id=2).update(
+        measurement_event_id=1, meas_event_field_concept=field
+    )
+    df = omop.events.resolve(omop.Measurement)
+    assert df[["measurement_id", "registry", "event_id"]].values.tolist() == [
+        [2, "ConditionOccurrence", 1]
+    ]
+
+    omop.FactRelationship(
+        domain_concept_id_1=condition,
+        fact_id_1=1,
+        domain_concept_id_2=measurement,
+        fact_id_2=3,
+        relationship_concept=field,
+    ).save()
+    df = omop.events.resolve(omop.FactRelationship, "fact_id_2")
+    assert df[["registry", "person_id"]].values.tolist() == [["Measurement", 2]]
+    with pytest.raises(ValueError):
+        omop.events.resolve(omop.FactRelationship, "fact_id_3")
+    assert omop.events.resolve(omop.Cost.filter(cost_id=4)).empty
@@ -0,0 +1,54 @@
+import omop
+import pytest
+
+
+@pytest.fixture
+def facts(concept):
+    drug = concept(13, "Drug", concept_class="Domain")
+    condition = concept(19, "Condition", concept_class="Domain")
+    has_indication = concept(44818899, "Has indication")
+    indication_of = concept(44818900, "Indication of")
+    for domain_1, fact_1, relationship, domain_2, fact_2 in [
+        (drug, 1, has_indication, condition, 10),
+        (drug, 2, has_indication, condition, 10),
+        (drug, 2, has_indication, condition, 11),
+        (condition, 10, indication_of, drug, 1),
+        (condition, 10, indication_of, drug, 2),
+        (condition, 11, indication_of, drug, 2),
+        (drug, 3, has_indication, condition, -5),
+    ]:
+        omop.FactRelationship(
+            domain_concept_id_1=domain_1,
+            fact_id_1=fact_1,
+            relationship_concept=relationship,
+            domain_concept_id_2=domain_2,
+            fact_id_2=fact_2,
+        ).save()
+
+
+def test_fact_graph(facts, tmp_path):
+    path = omop.facts.build_graph(tmp_path / "facts")
+    graph = omop.facts.FactGraph(path)
+    assert len(graph) == 6
+    assert sorted(graph.relationships) == [44818899, 44818900]
+
+    df = graph.neighbors(13, [1, 3, 4])
+    assert df.columns.tolist() == omop.facts.NEIGHBOR_COLUMNS
+    assert df.values.tolist() == [[1, 1, 19, 10], [3, 1, 19, -5]]
+
+    # drug 1 reaches drug 2 through condition 10 and condition 11 through drug 2
+    df = graph.neighbors(13, [1], hops=3)
+    assert df.values.tolist() == [
+        [1, 1, 19, 10],
+        [1, 2, 13, 2],
+        [1, 3, 19, 11],
+    ]
+    df = graph.neighbors(13, [1], hops=3, relationships=[44818899])
+    assert df.values.tolist() == [[1, 1, 19, 10]]
+    assert graph.neighbors(19, [1]).empty
+
+
+def test_empty_graph(tmp_path):
+    graph = omop.facts.FactGraph(omop.facts.build_graph(tmp_path / "facts"))
+    assert len(graph) == 0
+    assert graph.neighbors(13, [1], hops=2).empty
@@ -0,0 +1,115 @@
+import numpy as np
+import omop
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def locations(concept):
+    gender = concept(8532, "FEMALE", "Gender")
+    # the decimal columns of the registries only store values below 1
+    for location_id, latitude, longitude in [
+        (1, 0.5, 0.5),
+        (2, 0.52, 0.5),
+        (3, 0.5, 0.7),
+        (4, 0.9, 0.9),
+        (5, None, None),
+    ]:
+        omop.Location(
+            location_id=location_id, latitude=latitude, longitude=longitude
+        ).save()
+    for person_id, location_id in [(1, 1), (2, 3), (3, 4), (4, 1), (5, None)]:
+        omop.Person(
+            person_id=person_id,
+            gender_concept=gender,
+            year_of_birth=1980,
+            race_concept=gender,
+            ethnicity_concept=gender,
+            location_id=location_id,
+        ).save()
+    for care_site_id, location_id in [(1, 2), (2, 5)]:
+        omop.CareSite(care_site_id=care_site_id, location_id=location_id).save()
+
+
+def test_location_index(locations, tmp_path):
+    path = omop.geo.build_index(tmp_path / "geo", cell_size=0.05)
+    index = omop.geo.LocationIndex(path)
+    assert len(index) == 4
+
+    df = index.within_radius([0.5, 0.9], [0.5, 0.9], 5)
+    assert df.columns.tolist() == omop.geo.RADIUS_COLUMNS
+    assert df[["query", "location_id"]].values.tolist() == [[0, 1], [0, 2], [1, 4]]
+    assert df["distance_km"].tolist() == pytest.approx([0, 2.224, 0], abs=1e-3)
+    df = index.within_radius(0.5, 0.5, 25)
+    assert df["location_id"].tolist() == [1, 2, 3]
+
+    df = index.within_box(0.45, 0.45, 0.55, 0.75)
+    assert df.columns.tolist() == omop.geo.BOX_COLUMNS
+    assert df["location_id"].tolist() == [1, 2, 3]
+    # a box across the antimeridian, without the longitudes from 0.55 to 0.65
+    df = index.within_box([0.45, 0.85], [0.65, 0.85], [0.55, 0.95], [0.55, 0.95])
+    assert df.values.tolist() == [[0, 1], [0, 2], [0, 3], [1, 4]]
+
+    df = omop.geo.join(index.within_radius(0.5, 0.5, 25), "Person")
+    assert df[["location_id", "person_id"]].values.tolist() == [
+        [1, 1],
+        [1, 4],
+        [3, 2],
+    ]
+    df = omop.geo.join(index.within_box(0.45, 0.45, 0.55, 0.55), omop.CareSite)
+    assert df.values.tolist() == [[0, 2, 1]]
+    with pytest.raises(ValueError, match="no location"):
+        omop.geo.join(df, "Measurement")
+
+    df = omop.geo.catchment([1, 2], 25, index=index)
+    assert df[["care_site_id", "person_id"]].values.tolist() == [
+        [1, 1],
+        [1, 4],
+        [1, 2],
+    ]
+    assert omop.geo.catchment([2], 25, index=index).empty
+
+
+def test_radius_matches_distances(concept, tmp_path):
+    rng = np.random.default_rng(0)
+    n = 500
+    latitudes = rng.uniform(-0.99, 0.99, n).round(6)
+    longitudes = rng.uniform(-0.99, 0.99, n).round(6)
+    omop.load.merge(
+        omop.Location,
+        pd.DataFrame(
+            {
+                "location_id": np.arange(1, n + 1),
+                "latitude": latitudes,
+                "longitude": longitudes,
+            }
+        ),
+    )
+    index = omop.geo.LocationIndex(
+        omop.geo.build_index(tmp_path / "geo", cell_size=0.1)
+    )
+    points = rng.uniform(-0.99, 0.99, (20, 2))
+    radii = rng.uniform(1, 60, 20)
+    df = index.within_radius(points[:, 0], points[:, 1], radii)
+    distances = omop.geo._haversine(
+        points[:, :1], points[:, 1:], latitudes[None], longitudes[None]
+    )
+    queries, positions = np.nonzero(distances <= radii[:, None])
+    expected = sorted(zip(queries.tolist(), (positions + 1).tolist()))
+    assert sorted(zip(df["query"], df["location_id"])) == expected
+
+    # near the poles, with coordinates that the registry can't store on Postgres
+    latitudes = rng.uniform(70, 90, n)
+    longitudes = rng.uniform(-180, 180, n)
+    path = tmp_path / "polar"
+    omop.geo._write_index(path, np.arange(1, n + 1), latitudes, longitudes, 1.0)
+    index = omop.geo.LocationIndex(path)
+    points = np.column_stack([rng.uniform(75, 89, 20), rng.uniform(-180, 180, 20)])
+    radii = rng.uniform(100, 1500, 20)
+    df = index.within_radius(points[:, 0], points[:, 1], radii)
+    distances = omop.geo._haversine(
+        points[:, :1], points[:, 1:], latitudes[None], longitudes[None]
+    )
+    queries, positions = np.nonzero(distances <= radii[:, None])
+    expected = sorted(zip(queries.tolist(), (positions + 1).tolist()))
+    assert sorted(zip(df["query"], df["location_id"])) == expected
@@ -1,13 +1,5 @@
 import lamindb_setup as ln_setup
-import pytest
 
 
-@pytest.fixture
-def setup_instance():
-    ln_setup.init(storage="./testdb", schema="omop")
-    yield
-    ln_setup.delete("testdb", force=True)
-
-
-def test_migrate_check(setup_instance):
+def test_migrate_check():
     assert ln_setup.migrate.check()
@@ -0,0 +1,123 @@
+import os
+
+import omop
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def person(concept):
+    glucose = concept(3004501, "Glucose", "Measurement")
+    gender = concept(8532, "FEMALE", "Gender")
+    omop.Person(
+        person_id=1,
+        gender_concept=gender,
+        year_of_birth=1980,
+        race_concept=gender,
+        ethnicity_concept=gender,
+    ).save()
+    return glucose
+
+
+def measurements(values: dict[int, float | None]) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "measurement_id": list(values),
+            "person_id": 1,
+            "measurement_concept_id": 3004501,
+            "measurement_type_concept_id": 3004501,
+            "measurement_date": "2020-01-01",
+            "value_as_number": list(values.values()),
+        }
+    )
+
+
+def test_merge(person):
+    result = omop.load.merge("Measurement", measurements({1: 0.1, 2: None, 3: 0.3}))
+    assert result == (3, 0, 0)
+    updated_at = dict(omop.Measurement.filter().values_list("pk", "updated_at"))
+    assert omop.Measurement.get(measurement_id=1).created_by_id is not None
+
+    delta = measurements({2: 0.2, 3: 0.3, 4: None, 1: 0.1})
+    result = omop.load.merge(omop.Measurement, [delta.iloc[:2], delta.iloc[2:]])
+    assert result == (1, 1, 2)
+    values = dict(omop.Measurement.filter().values_list("pk", "updated_at"))
+    assert values[1] == updated_at[1]
+    assert values[3] == updated_at[3]
+    assert values[2] > updated_at[2]
+    assert omop.query.fetch(
+        omop.Measurement.filter().order_by("pk"), ["value_as_number"]
+    )["value_as_number"].tolist()[:3] == [0.1, 0.2, 0.3]
+
+    # columns that are not passed are left untouched
+    delta = measurements({1: None}).drop(columns="value_as_number")
+    delta["unit_source_value"] = "mg/dL"
+    assert omop.load.merge(omop.Measurement, delta) == (0, 1, 0)
+    assert omop.query.fetch(
+        omop.Measurement.filter(pk=1), ["value_as_number", "unit_source_value"]
+    ).iloc[0].tolist() == [0.1, "mg/dL"]
+
+    with pytest.raises(ValueError):
+        omop.load.merge(omop.Measurement, pd.DataFrame({"person_id": [1]}))
+
+
+def test_load_csv(person, tmp_path):
+    path = tmp_path / "measurement.csv"
+    lines = [
+        "MEASUREMENT_ID,PERSON_ID,MEASUREMENT_CONCEPT_ID,MEASUREMENT_TYPE_CONCEPT_ID,MEASUREMENT_DATE,VALUE_AS_NUMBER,UNIT_SOURCE_VALUE"
+    ]
+    for measurement_id in range(40):
+        value = "" if measurement_id % 3 == 0 else f"0.{measurement_id}"
+        lines.append(
+            f"{measurement_id},1,3004501,3004501,2020010{measurement_id % 9 + 1},{value},mg/dL"
+        )
+    path.write_text("\n".join(lines) + "\n")
+
+    result = omop.load.load_csv(
+        omop.Measurement, path, date_format="%Y%m%d", n_workers=2, chunk_bytes=256
+    )
+    assert result == (40, 0, 0)
+    df = omop.query.fetch(omop.Measurement.filter().order_by("pk"))
+    assert df["value_as_number"].isna().sum() == 14
+    assert df["value_as_number"].iloc[1] == 0.1
+    assert df["measurement_date"].dt.day.tolist()[:3] == [1, 2, 3]
+
+    # a completed load is not repeated
+    assert omop.load.load_csv(omop.Measurement, path, chunk_bytes=256) == (0, 0, 0)
+    # loading again from the start doesn't duplicate records
+    result = omop.load.load_csv(
+        omop.Measurement, path, date_format="%Y%m%d", chunk_bytes=512, resume=False
+    )
+    assert result == (0, 0, 40)
+
+
+# resuming with another chunk size splits the rest of the file differently
+@pytest.mark.parametrize("resume_chunk_bytes", [100, 150])
+def test_load_csv_resume(person, tmp_path, resume_chunk_bytes):
+    path = tmp_path / "measurement.tsv"
+    lines = [
+        "measurement_id\tperson_id\tmeasurement_concept_id\tmeasurement_type_concept_id\tmeasurement_date"
+    ]
+    for measurement_id in range(30):
+        lines.append(f"{measurement_id}\t1\t3004501\t3004501\t2020-01-01")
+    lines[-1] = lines[-1].replace("2020-01-01", "2020-13-01")
+    path.write_text("\n".join(lines) + "\n")
+    stat = path.stat()
+
+    with pytest.raises(ValueError):
+        omop.load.load_csv("Measurement", path, sep="\t", n_workers=1, chunk_bytes=100)
+    checkpoint = omop.LoadCheckpoint.get(registry="Measurement")
+    assert checkpoint.byte_offset < stat.st_size
+    n_loaded = omop.Measurement.filter().count()
+    assert checkpoint.last_pk == n_loaded - 1
+
+    # fix the file without changing its size and modification time
+    path.write_text(path.read_text().replace("2020-13-01", "2020-12-01"))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    result = omop.load.load_csv(
+        "Measurement", path, sep="\t", chunk_bytes=resume_chunk_bytes
+    )
+    assert result.n_inserted == 30 - n_loaded
+    assert omop.Measurement.filter().count() == 30
+    checkpoint = omop.LoadCheckpoint.get(registry="Measurement")
+    assert (checkpoint.byte_offset, checkpoint.last_pk) == (stat.st_size, 29)
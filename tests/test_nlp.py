@@ -0,0 +1,82 @@
+import pickle
+import re
+
+import omop
+
+
+def numbers(text):
+    for match in re.finditer(r"\d+", text):
+        yield match.start(), match.group(), 201826
+
+
+def test_dictionary_matcher(events):
+    matcher = omop.nlp.DictionaryMatcher(standard_concept=None)
+    assert list(matcher("History of TYPE 2 diabetes-mellitus; glucose")) == [
+        (11, "TYPE 2 diabetes-mellitus", 201826),
+        (37, "glucose", 3004501),
+    ]
+    assert list(omop.nlp.DictionaryMatcher()("glucose")) == []
+
+
+def test_automaton_matcher(events, tmp_path):
+    path = omop.nlp.build_automaton(tmp_path / "automaton", standard_concept=None)
+    matcher = omop.nlp.AutomatonMatcher(path)
+    assert matcher.meta["n_names"] == len(matcher.concept_ids)
+    dictionary = omop.nlp.DictionaryMatcher(standard_concept=None)
+    for text in [
+        "History of TYPE 2 diabetes-mellitus; glucose",
+        "type 2 diabetes, glucoseglucose glucose",
+        "",
+    ]:
+        assert list(matcher(text)) == list(dictionary(text))
+    # pickled as the path, workers load the automaton from disk
+    assert len(pickle.dumps(matcher)) < 200
+    assert list(pickle.loads(pickle.dumps(matcher))("glucose")) == [
+        (0, "glucose", 3004501)
+    ]
+    # rebuilding replaces the automaton
+    omop.nlp.build_automaton(path)
+    assert list(omop.nlp.AutomatonMatcher(path)("glucose")) == []
+
+
+def test_run(notes):
+    omop.notes.offload(omop.Note.filter(note_id=1))
+    matcher = omop.nlp.DictionaryMatcher(standard_concept=None)
+    result = omop.nlp.run(extractor=matcher, n_workers=1, batch_size=1)
+    assert result == (3, 2)
+    terms = omop.NoteNlp.filter().order_by("note_nlp_id")
+    assert [(t.note_id, t.offset, t.lexical_variant) for t in terms] == [
+        (1, "13", "type 2 diabetes mellitus"),
+        (1, "39", "glucose"),
+    ]
+    term = terms[0]
+    assert term.note_nlp_concept_id == 201826
+    assert term.nlp_system == "omop.nlp.DictionaryMatcher"
+    assert term.term_exists == "Y"
+    assert term.snippet == notes[0]
+
+    # resumes after the checkpoint
+    assert omop.nlp.run(extractor=matcher, n_workers=1) == (0, 0)
+    omop.Note.filter(note_id=2).update(note_text="Glucose 140")
+    assert omop.nlp.run(extractor=matcher, n_workers=1, resume=False) == (3, 3)
+    assert omop.NoteNlp.filter().count() == 3
+
+    # another NLP system
+    assert omop.nlp.run(extractor=numbers, n_workers=1) == (3, 2)
+    assert omop.NoteNlp.filter(nlp_system="test_nlp.numbers").count() == 2
+    assert omop.NoteNlp.filter().count() == 5
+
+    # a run over some notes doesn't advance the checkpoint of all notes
+    assert omop.nlp.run(omop.Note.filter(note_id=3), numbers, n_workers=1) == (1, 0)
+    assert omop.nlp.run(extractor=numbers, n_workers=1, resume=False) == (3, 2)
+    later = omop.Note.filter(note_id__gt=1)
+    assert omop.nlp.run(later, numbers, n_workers=1) == (2, 1)
+    assert omop.nlp.run(later, numbers, n_workers=1) == (0, 0)
+    ids = omop.NoteNlp.filter().values_list("note_nlp_id", flat=True)
+    assert len(set(ids)) == omop.NoteNlp.filter().count() == 5
+
+
+def test_run_spawned(notes, monkeypatch):
+    # workers that are not forked connect to the instance themselves
+    monkeypatch.setattr(omop._utils, "_start_method", lambda: "spawn")
+    assert omop.nlp.run(extractor=numbers, n_workers=1) == (3, 1)
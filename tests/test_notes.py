@@ -0,0 +1,27 @@
+import omop
+
+
+def test_offload(notes):
+    assert omop.notes.offload(batch_size=1) == 2
+    assert set(omop.Note.filter().values_list("note_text", flat=True)) == {""}
+    blob = omop.NoteBlob.get(note_id=2)
+    assert blob.codec == "zstd"
+    assert blob.size == len(notes[1])
+    assert len(blob.data) < blob.size
+    assert omop.notes.texts([1, 2, 3, 4]) == {1: notes[0], 2: notes[1], 3: ""}
+    assert omop.Note.get(note_id=2).text == notes[1]
+    assert omop.notes.offload() == 0
+
+    # a note written after offloading
+    omop.Note.filter(note_id=1).update(note_text="Updated")
+    assert omop.Note.get(note_id=1).text == "Updated"
+    assert omop.notes.offload(omop.Note.filter(note_id__gte=2)) == 0
+    assert omop.notes.offload() == 1
+    assert omop.notes.texts([1]) == {1: "Updated"}
+
+    assert omop.notes.restore(omop.Note.filter(note_id=2)) == 1
+    assert omop.Note.get(note_id=2).note_text == notes[1]
+    assert omop.NoteBlob.filter().count() == 1
+    assert omop.notes.restore() == 1
+    assert omop.notes.texts([1, 2, 3]) == {1: "Updated", 2: notes[1], 3: ""}
+    assert not omop.NoteBlob.filter().exists()
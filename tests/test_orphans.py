@@ -0,0 +1,32 @@
+import omop
+from django.db import connection
+from omop._utils import unfiltered
+
+
+def test_scan_orphans():
+    omop.Concept(
+        concept_id=8,
+        concept_name="Germany",
+        domain_id="Geography",
+        vocabulary_id="OSM",
+        concept_class="Country",
+        concept_code="DE",
+        valid_start_date="1970-01-01",
+        valid_end_date="2099-12-31",
+    ).save()
+    with connection.constraint_checks_disabled():
+        omop.Location(location_id=1, country_concept_id=8).save()
+        omop.Location(location_id=2, country_concept_id=404).save()
+
+    df = omop.integrity.scan(["Location"]).set_index("field")
+    assert df.loc["country_concept", "n_orphans"] == 1
+    assert df.loc["country_concept", "samples"] == [(2, 404)]
+
+    # the first incremental scan checks everything, the second only newer records
+    df = omop.integrity.scan(["Location"], incremental=True)
+    assert df["n_orphans"].sum() == 1
+    df = omop.integrity.scan(["Location"], incremental=True)
+    assert df["n_orphans"].sum() == 0
+
+    unfiltered(omop.Location).delete()
+    unfiltered(omop.Concept).delete()
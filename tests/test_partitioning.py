@@ -0,0 +1,67 @@
+import omop
+import pytest
+from django.db import connection
+
+requires_postgres = pytest.mark.skipif(
+    connection.vendor != "postgresql", reason="partitioning requires Postgres"
+)
+
+
+@pytest.mark.skipif(connection.vendor == "postgresql", reason="tests SQLite")
+def test_partitioning_requires_postgres():
+    assert omop.partitioning.years(omop.Measurement) is None
+    # a no-op on tables that are not partitioned
+    omop.partitioning.create_partitions("Observation", [2020])
+    with pytest.raises(NotImplementedError):
+        omop.partitioning.enable()
+    with pytest.raises(ValueError):
+        omop.partitioning.years(omop.Person)
+
+
+def measurement(measurement_id: int, date: str, glucose) -> omop.Measurement:
+    return omop.Measurement(
+        measurement_id=measurement_id,
+        person_id=1,
+        measurement_concept=glucose,
+        measurement_type_concept=glucose,
+        measurement_date=date,
+    )
+
+
+@requires_postgres
+def test_partitioning(events):
+    glucose = omop.Concept.get(concept_id=3004501)
+    detached = None
+    # views would be dropped with the table
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE VIEW glucose AS SELECT * FROM omop_measurement")
+    with pytest.raises(ValueError, match="referenced by glucose"):
+        omop.partitioning.enable(["Measurement"])
+    with connection.cursor() as cursor:
+        cursor.execute("DROP VIEW glucose")
+    omop.partitioning.enable(["Measurement"])
+    try:
+        assert omop.partitioning.years("Measurement") == [2020]
+        assert omop.Measurement.filter().count() == 3
+
+        # partitions of new years are created on save
+        measurement(10, "2015-06-01", glucose).save()
+        assert omop.partitioning.years("Measurement") == [2015, 2020]
+
+        detached = omop.partitioning.detach("Measurement", 2015)
+        assert detached.startswith("omop_measurement_y2015_detached_")
+        assert omop.partitioning.years("Measurement") == [2020]
+        assert omop.Measurement.filter().count() == 3
+
+        # the year gets a new partition despite the detached table
+        measurement(11, "2015-07-01", glucose).save()
+        assert omop.partitioning.years("Measurement") == [2015, 2020]
+        assert omop.Measurement.filter(measurement_date__year=2015).count() == 1
+        assert omop.partitioning.detach("Measurement", 2015, drop=True) is None
+    finally:
+        omop.partitioning.disable(["Measurement"])
+        if detached is not None:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE IF EXISTS "{detached}"')
+    assert omop.partitioning.years("Measurement") is None
+    assert omop.Measurement.filter().count() == 3
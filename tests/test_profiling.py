@@ -0,0 +1,35 @@
+import re
+
+import omop
+
+
+def test_profile(events, tmp_path):
+    with omop.profiling.profile() as profile:
+        queryset = omop.Measurement.filter().order_by("measurement_id")
+        measurements = list(queryset) + list(queryset.all())
+        names = [m.measurement_concept.concept_name for m in measurements]
+        omop.Measurement.filter(measurement_id=3).update(value_as_number=0.5)
+    assert names == ["Glucose"] * 6
+
+    summary = profile.summary()
+    assert summary.loc["Measurement", "n_queries"] == 3
+    assert summary.loc["Measurement", "rows"] == 3 + 3 + 1
+    assert summary.loc["Concept", "n_queries"] == 6
+    assert summary.loc["Concept", "rows"] == 6
+    assert (summary["seconds"] > 0).all()
+
+    suspects = profile.n_plus_one()
+    assert suspects["registry"].tolist() == ["Concept"]
+    assert suspects["n_queries"].tolist() == [6]
+    # comprehensions have no frame of their own as of Python 3.12
+    assert re.fullmatch(
+        r"(<listcomp>|test_profile) \(test_profiling.py:\d+\)", suspects["location"][0]
+    )
+    assert profile.n_plus_one(threshold=7).empty
+
+    folded = profile.to_folded(tmp_path / "queries.folded").splitlines()
+    assert (tmp_path / "queries.folded").read_text().splitlines() == folded
+    stack, weight = folded[0].rsplit(" ", 1)
+    assert stack.split(";")[-2].startswith("test_profile (test_profiling.py:")
+    assert stack.split(";")[-1].startswith("Measurement: SELECT")
+    assert int(weight) >= 0
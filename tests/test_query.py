@@ -0,0 +1,70 @@
+import numpy as np
+import omop
+import pyarrow as pa
+import pytest
+
+
+@pytest.fixture
+def measurements(concept):
+    glucose = concept(3004501, "Glucose", "Measurement")
+    gender = concept(8532, "FEMALE", "Gender")
+    omop.Person(
+        person_id=1,
+        gender_concept=gender,
+        year_of_birth=1980,
+        race_concept=gender,
+        ethnicity_concept=gender,
+    ).save()
+    for measurement_id in range(5):
+        omop.Measurement(
+            measurement_id=measurement_id,
+            person_id=1,
+            measurement_concept=glucose,
+            measurement_type_concept=glucose,
+            measurement_date=f"2020-01-0{measurement_id + 1}",
+            value_as_number=None if measurement_id == 4 else measurement_id / 10,
+        ).save()
+
+
+def test_stream(measurements):
+    queryset = omop.Measurement.filter(measurement_id__lt=4)
+    batches = list(
+        omop.query.stream(
+            queryset,
+            ["measurement_id", "value_as_number", "measurement_date"],
+            batch_size=3,
+        )
+    )
+    assert [len(df) for df in batches] == [3, 1]
+    assert batches[0]["value_as_number"].dtype == np.float64
+    assert batches[0]["measurement_date"].dt.year.tolist() == [2020] * 3
+
+    batches = list(
+        omop.query.stream(
+            omop.Measurement,
+            ["unit_concept_id", "person__year_of_birth"],
+            format="arrow",
+        )
+    )
+    assert isinstance(batches[0], pa.RecordBatch)
+    assert batches[0].column("unit_concept_id").null_count == 5
+    assert batches[0].column("person__year_of_birth").to_pylist() == [1980] * 5
+
+    with pytest.raises(ValueError):
+        omop.query.stream(omop.Measurement, format="polars")
+
+
+def test_fetch(measurements):
+    df = omop.query.fetch(omop.Measurement.filter().order_by("measurement_id"))
+    assert len(df) == 5
+    assert df.columns[0] == "measurement_id"
+    assert df["value_as_number"].dtype == np.float64
+    assert df["value_as_number"].isna().sum() == 1
+    assert df["unit_concept_id"].dtype == "Int64"
+    assert str(df["measurement_date"].iloc[-1].date()) == "2020-01-05"
+
+    table = omop.query.fetch(
+        omop.Measurement.filter(measurement_id__gt=10), ["person_id"], format="arrow"
+    )
+    assert isinstance(table, pa.Table)
+    assert table.num_rows == 0
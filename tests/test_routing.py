@@ -0,0 +1,65 @@
+import shutil
+
+import omop
+import pytest
+from django.db import connections, transaction
+
+
+def person(person_id, gender):
+    return omop.Person(
+        person_id=person_id,
+        gender_concept=gender,
+        year_of_birth=1980,
+        race_concept=gender,
+        ethnicity_concept=gender,
+    )
+
+
+@pytest.fixture
+def replica(concept, tmp_path):
+    person(1, concept(8532, "FEMALE", "Gender")).save()
+    path = tmp_path / "replica.sqlite"
+    shutil.copy(connections["default"].settings_dict["NAME"], path)
+    omop.routing.configure([f"sqlite:///{path}"], sticky_seconds=60)
+    yield
+    omop.routing.reset()
+
+
+def test_routing(replica, tmp_path, monkeypatch):
+    assert omop.routing.replicas() == ["omop_replica_0"]
+    with omop.routing.session():
+        assert omop.Person.filter().db == "omop_replica_0"
+        first = omop.Person.get(person_id=1)
+        assert first._state.db == "omop_replica_0"
+        # the replica lags behind, the session reads its own write from the primary
+        person(2, first.gender_concept).save()
+        assert omop.Person.filter().count() == 2
+    with omop.routing.session():
+        assert omop.Person.filter().count() == 1
+        with omop.routing.primary():
+            assert omop.Person.filter().count() == 2
+        with transaction.atomic():
+            assert omop.Person.filter().count() == 2
+        first.year_of_birth = 1981
+        first.save(using="default")
+        assert omop.Person.get(person_id=1).year_of_birth == 1981
+    # a new session reads from the replica again
+    with omop.routing.session():
+        assert omop.Person.filter().count() == 1
+
+    omop.routing.reset()
+    assert omop.routing.replicas() == []
+    assert omop.Person.filter().db == "default"
+    with pytest.raises(ValueError):
+        omop.routing.configure([])
+
+    # the replicas of the environment, only after an explicit call
+    monkeypatch.setenv(
+        "OMOP_READ_REPLICAS", f" sqlite:///{tmp_path / 'replica.sqlite'},"
+    )
+    assert omop.routing.replicas() == []
+    omop.routing.configure()
+    assert omop.routing.replicas() == ["omop_replica_0"]
+    monkeypatch.delenv("OMOP_READ_REPLICAS")
+    with pytest.raises(ValueError):
+        omop.routing.configure()
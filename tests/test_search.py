@@ -0,0 +1,48 @@
+import omop
+import pytest
+
+
+@pytest.fixture
+def vocabulary(concept):
+    english = concept(4180186, "English language", "Language")
+    diabetes = concept(
+        201826, "Type 2 diabetes mellitus", "Condition", standard_concept="S"
+    )
+    concept(201254, "Type 1 diabetes mellitus", "Condition", standard_concept="S")
+    concept(4193704, "Type 2 diabetes mellitus without complication", "Condition")
+    concept(3004410, "Hemoglobin A1c", "Measurement", standard_concept="S")
+    omop.ConceptSynonym(
+        concept=diabetes,
+        concept_synonym_name="Diabetes type 2",
+        language_concept=english,
+    ).save()
+    yield
+    omop.search.drop_index()
+
+
+def test_similarity():
+    assert omop.search.similarity("word", "word") == 1.0
+    assert omop.search.similarity("word", "two words") == pytest.approx(4 / 11)
+    assert omop.search.similarity("", "word") == 0.0
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_search(vocabulary, in_memory):
+    if not in_memory:
+        assert omop.search.build_index() == "fts5"
+    df = omop.search.search("diabetes type 2")
+    assert df.columns.tolist() == omop.search.RESULT_COLUMNS
+    assert df["concept_id"].tolist()[0] == 201826
+    assert df["matched_name"][0] == "Diabetes type 2"
+    assert df["score"][0] == 1.0
+    assert df["score"].is_monotonic_decreasing
+    assert 3004410 not in df["concept_id"].tolist()
+
+    # a typo
+    df = omop.search.search("diabetis mellitus type 2", standard_concept="S", limit=1)
+    assert df["concept_id"].tolist() == [201826]
+    df = omop.search.search("hemoglobin", domain_id="Condition")
+    assert df.empty
+    df = omop.search.search("hemoglobin", domain_id="Measurement")
+    assert df["concept_name"].tolist() == ["Hemoglobin A1c"]
+    assert omop.search.search("zz").empty
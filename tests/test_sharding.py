@@ -0,0 +1,91 @@
+import omop
+import pandas as pd
+import pytest
+from django.db import IntegrityError, connection
+
+
+@pytest.fixture
+def persons(concept):
+    glucose = concept(3004501, "Glucose", "Measurement")
+    gender = concept(8532, "FEMALE", "Gender")
+    for person_id in range(1, 4):
+        omop.Person(
+            person_id=person_id,
+            gender_concept=gender,
+            year_of_birth=1980 + person_id,
+            race_concept=gender,
+            ethnicity_concept=gender,
+        ).save()
+    return glucose
+
+
+def measurement(measurement_id: int, person_id: int, glucose) -> omop.Measurement:
+    return omop.Measurement(
+        measurement_id=measurement_id,
+        person_id=person_id,
+        measurement_concept=glucose,
+        measurement_type_concept=glucose,
+        measurement_date="2020-01-01",
+    )
+
+
+def test_sharding(persons):
+    for measurement_id, person_id in enumerate([1, 1, 2, 3]):
+        measurement(measurement_id, person_id, persons).save()
+    with pytest.raises(ValueError):
+        omop.sharding.enable(1)
+
+    omop.sharding.enable(2)
+    try:
+        assert omop.sharding.n_shards() == 2
+        if connection.vendor == "sqlite":
+            # reads have to choose a shard
+            with pytest.raises(ValueError, match="split into 2 shards"):
+                omop.Measurement.filter().count()
+            assert omop.Person.get(person_id=1).measurement_set.count() == 2
+        else:
+            assert omop.Measurement.filter().count() == 4
+        # Postgres assigns persons to shards by its own hash function
+        assert sorted(
+            queryset.count() for queryset in omop.sharding.shards("Measurement")
+        ) == [1, 3]
+        assert omop.sharding.for_person(omop.Measurement, 1).count() == 2
+        # joins into the instance database
+        assert (
+            omop.sharding.for_person(omop.Measurement, 2)
+            .filter(
+                person__year_of_birth=1982, measurement_concept__concept_name="Glucose"
+            )
+            .count()
+            == 1
+        )
+
+        # writes are routed to the shard of the person
+        measurement(4, 2, persons).save()
+        result = omop.load.merge(
+            omop.Measurement,
+            pd.DataFrame(
+                {
+                    "measurement_id": [5, 6],
+                    "person_id": [2, 3],
+                    "measurement_concept_id": 3004501,
+                    "measurement_type_concept_id": 3004501,
+                    "measurement_date": "2021-01-01",
+                }
+            ),
+        )
+        assert result == (2, 0, 0)
+        counts = omop.sharding.map_shards(
+            lambda queryset: queryset.count(), "Measurement"
+        )
+        assert sum(counts) == 7
+        assert counts == [
+            queryset.count() for queryset in omop.sharding.shards("Measurement")
+        ]
+        assert len(omop.sharding.shards(omop.Person)) == 1
+        with pytest.raises(IntegrityError):
+            measurement(7, None, persons).save()
+    finally:
+        omop.sharding.disable()
+    assert omop.sharding.n_shards() == 1
+    assert omop.Measurement.filter().count() == 7
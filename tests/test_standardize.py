@@ -0,0 +1,75 @@
+import omop
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def vocabulary(concept):
+    english = concept(4180186, "English language", "Language")
+    concept(3004410, "Hemoglobin A1c", "Measurement", standard_concept="S")
+    glucose = concept(
+        3004501,
+        "Glucose [Mass/volume] in Serum or Plasma",
+        "Measurement",
+        standard_concept="S",
+    )
+    concept(3000963, "Hemoglobin", "Measurement", standard_concept="S")
+    concept(4184637, "Hemoglobin A1c measurement", "Measurement")
+    omop.ConceptSynonym(
+        concept=glucose, concept_synonym_name="Serum glucose", language_concept=english
+    ).save()
+    yield
+    omop.standardize.clear_cache()
+
+
+def test_normalize():
+    values = ["Hemoglobin-A1c ", "  HbA1c", "glucose  (serum)"]
+    assert omop.standardize.normalize(values).tolist() == [
+        "hemoglobin a1c",
+        "hba1c",
+        "glucose serum",
+    ]
+
+
+def test_standardize(vocabulary):
+    values = pd.Series(
+        [
+            "HEMOGLOBIN A1C",
+            "hemoglobin-a1c",
+            "serum glucose",
+            "Hemoglobin A1c",
+            "hemoglobin a1c measurment",
+            "xyz",
+            None,
+        ]
+    )
+    df = omop.standardize.standardize(values, domain_id="Measurement")
+    assert df.columns.tolist() == omop.standardize.RESULT_COLUMNS
+    df = df.set_index("source_value")
+    assert len(df) == 5 + 1
+    assert df.loc["HEMOGLOBIN A1C", "concept_id"] == 3004410
+    assert df.loc["hemoglobin-a1c", "match_type"] == "exact"
+    assert df.loc["hemoglobin-a1c", "score"] == 1.0
+    assert df.loc["serum glucose", "concept_id"] == 3004501
+    assert df.loc["serum glucose", "match_type"] == "synonym"
+    assert df.loc["serum glucose", "matched_name"] == "Serum glucose"
+    assert df.loc["serum glucose", "concept_name"].startswith("Glucose")
+    # the non-standard concept is not indexed
+    assert df.loc["hemoglobin a1c measurment", "concept_id"] == 3004410
+    assert df.loc["hemoglobin a1c measurment", "match_type"] == "fuzzy"
+    assert 0.5 <= df.loc["hemoglobin a1c measurment", "score"] < 1.0
+    assert pd.isna(df.loc["xyz", "concept_id"])
+    assert pd.isna(df.loc["xyz", "match_type"])
+
+    # all concepts, and without fuzzy matches
+    standardizer = omop.standardize.Standardizer(standard_concept=None, fuzzy=False)
+    df = standardizer.standardize(["Hemoglobin A1c Measurement", "hemoglobn"])
+    assert df["concept_id"].tolist()[0] == 4184637
+    assert pd.isna(df["concept_id"][1])
+
+    # filters without any concepts
+    standardizer = omop.standardize.Standardizer(domain_id="Drug")
+    df = standardizer.standardize(["hemoglobin", "xyz"])
+    assert df["source_value"].tolist() == ["hemoglobin", "xyz"]
+    assert df["concept_id"].isna().all()
+    assert df["match_type"].isna().all()